@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Benchmarks of xsdcc.py and the interpreter on generated schemas.
+
+Every case generates an XML schema from a few parameters, compiles its root
+element phase by phase and validates generated instance documents with the
+fxparser extension module (make fxparser.so).  Each case runs in a fresh
+process so that its peak memory can be measured.  The results are written
+as JSON."""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from xsdcc import XSCompiler
+
+NAMESPACE = "urn:bench"
+
+# the parameters of a case and their defaults:
+#  depth          nesting depth of the element levels
+#  width          number of alternative child elements per level
+#  occurs         maxOccurs of the repeated item element of every level
+#  substitutions  members of the substitution group used by the leaves
+#  extensions     length of the complexType extension chain
+#  shared         number of named types shared between the levels
+#  counter        --counter-threshold of the compiler, None to unroll
+DEFAULTS = dict(depth=3, width=3, occurs=1, substitutions=0, extensions=0, shared=0, counter=None)
+
+CASES = [
+	("baseline", dict()),
+	("deep", dict(depth=6, width=2)),
+	("wide", dict(width=24)),
+	("occurs", dict(occurs=12)),
+	("occurs-counter", dict(occurs=40, counter=8)),
+	("substitutions", dict(substitutions=16)),
+	("extensions", dict(extensions=8)),
+	("shared", dict(shared=4, substitutions=4)),
+]
+
+def mkSchema(p):
+	"""Returns the text of the schema for the parameters p, its root element
+	is root and the content of level d is the type Level<d>."""
+	lines = ['<?xml version="1.0"?>',
+	         '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="%s" xmlns="%s" elementFormDefault="qualified">' % (NAMESPACE, NAMESPACE),
+	         ' <xs:element name="root" type="Level0"/>']
+	if p["substitutions"] > 0:
+		lines.append(' <xs:element name="expr" abstract="true"/>')
+		for i in range(0, p["substitutions"]):
+			lines.append(' <xs:element name="s%d" substitutionGroup="expr" type="xs:string"/>' % i)
+	for i in range(0, p["extensions"]):
+		if i == 0:
+			lines.append(' <xs:complexType name="Base0"><xs:sequence><xs:element name="b0" type="xs:string" minOccurs="0"/></xs:sequence></xs:complexType>')
+		else:
+			lines.append(' <xs:complexType name="Base%d"><xs:complexContent><xs:extension base="Base%d"><xs:sequence>'
+			             '<xs:element name="b%d" type="xs:string" minOccurs="0"/></xs:sequence></xs:extension></xs:complexContent></xs:complexType>' % (i, i - 1, i))
+	for i in range(0, p["shared"]):
+		lines.append(' <xs:complexType name="Shared%d"><xs:sequence><xs:element name="v%d" type="xs:string" minOccurs="0"/>%s</xs:sequence></xs:complexType>' % (
+			i, i, '<xs:element ref="expr" minOccurs="0" maxOccurs="unbounded"/>' if p["substitutions"] > 0 else ""))
+	for d in range(0, p["depth"] + 1):
+		lines.append(' <xs:complexType name="Level%d"><xs:sequence>' % d)
+		if d < p["depth"]:
+			lines.append('  <xs:choice minOccurs="0" maxOccurs="unbounded">')
+			for i in range(0, p["width"]):
+				lines.append('   <xs:element name="c%d_%d" type="Level%d"/>' % (d, i, d + 1))
+			lines.append('  </xs:choice>')
+		elif p["substitutions"] > 0:
+			lines.append('  <xs:element ref="expr" minOccurs="0" maxOccurs="unbounded"/>')
+		if p["occurs"] > 1:
+			lines.append('  <xs:element name="items" minOccurs="0"><xs:complexType><xs:sequence>'
+			             '<xs:element name="item" type="xs:string" maxOccurs="%d"/></xs:sequence></xs:complexType></xs:element>' % p["occurs"])
+		if p["extensions"] > 0:
+			lines.append('  <xs:element name="ext" type="Base%d" minOccurs="0"/>' % (p["extensions"] - 1))
+		if p["shared"] > 0:
+			lines.append('  <xs:element name="shared" type="Shared%d" minOccurs="0"/>' % (d % p["shared"]))
+		lines.append(' </xs:sequence></xs:complexType>')
+	lines.append('</xs:schema>')
+	return "\n".join(lines) + "\n"
+
+def mkDocument(p, rnd, size):
+	"""Returns an instance document of the schema for p with about size
+	elements."""
+	out = ['<root xmlns="%s">' % NAMESPACE]
+	budget = [size]
+	def emit(name, text="x"):
+		budget[0] -= 1
+		out.append("<%s>%s</%s>" % (name, text, name))
+	def level(d):
+		if d < p["depth"]:
+			# the root level takes everything left, inner ones a few children
+			count = budget[0] if d == 0 else rnd.randint(0, 3)
+			while count > 0 and budget[0] > 0:
+				name = "c%d_%d" % (d, rnd.randrange(0, p["width"]))
+				budget[0] -= 1
+				out.append("<%s>" % name)
+				level(d + 1)
+				out.append("</%s>" % name)
+				count -= 1
+		elif p["substitutions"] > 0:
+			for i in range(0, rnd.randint(0, 3)):
+				emit("s%d" % rnd.randrange(0, p["substitutions"]))
+		if p["occurs"] > 1 and rnd.random() < 0.5:
+			out.append("<items>")
+			for i in range(0, rnd.randint(1, p["occurs"])):
+				emit("item")
+			out.append("</items>")
+		if p["extensions"] > 0 and rnd.random() < 0.5:
+			out.append("<ext>")
+			for i in range(0, p["extensions"]):
+				if rnd.random() < 0.5: emit("b%d" % i)
+			out.append("</ext>")
+		if p["shared"] > 0 and rnd.random() < 0.5:
+			out.append("<shared>")
+			emit("v%d" % (d % p["shared"]))
+			for i in range(0, rnd.randint(0, 2) if p["substitutions"] > 0 else 0):
+				emit("s%d" % rnd.randrange(0, p["substitutions"]))
+			out.append("</shared>")
+	level(0)
+	out.append("</root>")
+	return "".join(out)
+
+@contextmanager
+def quiet():
+	"""Discards what the compiler prints."""
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, "w")
+	try:
+		yield
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+def runCase(case):
+	"""Compiles and runs one case, returns its results."""
+	name, params, options = case
+	p = dict(DEFAULTS)
+	p.update(params)
+	directory = tempfile.mkdtemp(prefix="xsdcc-bench-")
+	try:
+		schemaPath = os.path.join(directory, "bench.xsd")
+		with open(schemaPath, "w") as f:
+			f.write(mkSchema(p))
+		phases = dict()
+		cc = XSCompiler()
+		cc.counterThreshold = p["counter"]
+		root = "{%s}root" % NAMESPACE
+		with quiet():
+			start = time.time()
+			cc.loadSchema(schemaPath)
+			phases["loadSchema"] = time.time() - start
+			cc.genElements, cc.providedElements, cc.genTypes, cc.providedTypes = set([root]), set(), set(), set()
+			start = time.time()
+			nfa = cc.createContentModel(cc.Decls[1][root])
+			phases["createContentModel"] = time.time() - start
+			start = time.time()
+			dfa = nfa.determinize(False)
+			phases["determinize"] = time.time() - start
+			start = time.time()
+			minimal = dfa.hopcroft(False)
+			phases["minimize"] = time.time() - start
+			start = time.time()
+			cc.mkTables(minimal)
+			phases["mkTables"] = time.time() - start
+		tablesPath = os.path.join(directory, "root.fxt")
+		cc.writeTables(minimal, tablesPath)
+		tables = cc.tables(minimal)
+		result = dict(name=name, params=p, phases=phases,
+		              states=dict(nfa=len(nfa.compact().reachables()), dfa=len(dfa.reachables()), minimal=len(minimal.reachables())),
+		              transitions=len(tables[4]), elements=len(cc.elements), actions=len(cc.actions),
+		              tables_bytes=os.path.getsize(tablesPath),
+		              interpreter=runInterpreter(p, tablesPath, options))
+		result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		return result
+	finally:
+		shutil.rmtree(directory)
+
+def runInterpreter(p, tablesPath, options):
+	"""Validates the generated documents repeatedly for at least
+	options.minTime seconds, None if the fxparser module is missing."""
+	try:
+		import fxparser
+	except ImportError:
+		return None
+	rnd = random.Random(options.seed)
+	documents = [mkDocument(p, rnd, options.docSize) for i in range(0, options.documents)]
+	schema = fxparser.Schema(tablesPath)
+	invalid = len([doc for doc in documents if not fxparser.validate(schema, doc)[0]])
+	size = sum(map(len, documents))
+	passes = 0
+	start = time.time()
+	while True:
+		for doc in documents:
+			fxparser.validate(schema, doc)
+		passes += 1
+		elapsed = time.time() - start
+		if elapsed >= options.minTime: break
+	return dict(documents=passes * len(documents), bytes=passes * size, seconds=elapsed, invalid=invalid,
+	            documents_per_second=passes * len(documents) / elapsed,
+	            mb_per_second=passes * size / elapsed / (1024 * 1024))
+
+def parseCase(text):
+	"""Parses name:key=value,key=value into a case."""
+	name, _, assignments = text.partition(":")
+	params = dict()
+	for assignment in filter(None, assignments.split(",")):
+		key, _, value = assignment.partition("=")
+		if key not in DEFAULTS:
+			raise argparse.ArgumentTypeError("unknown parameter %s" % key)
+		params[key] = None if value == "None" else int(value)
+	return name, params
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark xsdcc.py and the interpreter on generated schemas")
+	parser.add_argument("--case", action="append", dest="cases", type=parseCase, default=[],
+	                    help="run the case name:param=value,... instead of the predefined ones, parameters are %s" % ", ".join(sorted(DEFAULTS)))
+	parser.add_argument("--documents", type=int, dest="documents", default=20,
+	                    help="number of instance documents per case")
+	parser.add_argument("--doc-size", type=int, dest="docSize", default=2000,
+	                    help="approximate number of elements per document")
+	parser.add_argument("--min-time", type=float, dest="minTime", default=1.0,
+	                    help="minimum seconds to spend validating per case")
+	parser.add_argument("--seed", type=int, dest="seed", default=1,
+	                    help="seed of the document generator")
+	parser.add_argument("-o", "--output", dest="output", default=None,
+	                    help="file to write the JSON results to instead of stdout")
+	arguments = parser.parse_args()
+
+	cases = [(name, params, arguments) for name, params in (arguments.cases or CASES)]
+	# a fresh process per case keeps the peak memory of the cases apart
+	pool = multiprocessing.Pool(1, maxtasksperchild=1)
+	results = []
+	for result in pool.imap(runCase, cases):
+		sys.stderr.write("%s: %s\n" % (result["name"], ", ".join(["%s %.3fs" % (phase, result["phases"][phase]) for phase in
+		                 ("loadSchema", "createContentModel", "determinize", "minimize", "mkTables")])))
+		results.append(result)
+	pool.close()
+	pool.join()
+
+	report = dict(version=1, time=time.time(), python=sys.version.split()[0], cases=results)
+	if arguments.output is None:
+		json.dump(report, sys.stdout, indent=1, sort_keys=True)
+		sys.stdout.write("\n")
+	else:
+		with open(arguments.output, "w") as f:
+			json.dump(report, f, indent=1, sort_keys=True)
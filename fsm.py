@@ -1,42 +1,130 @@
 #!/usr/bin/python
 # encoding=UTF-8
 
-from collections import deque, Iterable
-from itertools import chain
-import copy
+from collections import deque, Iterable, OrderedDict
+from itertools import groupby
+from operator import itemgetter
+from array import array
+
+class ActionTable(object):
+	"""Interns action sequences, so that they can be referred to and compared
+	by an integer id.  The empty sequence always has id 0."""
+	__slots__ = ("ids", "sequences")
+
+	def __init__(self):
+		self.ids = {(): 0}
+		self.sequences = [()]
+
+	def intern(self, actions):
+		actions = tuple(actions)
+		try:
+			return self.ids[actions]
+		except KeyError:
+			self.ids[actions] = len(self.sequences)
+			self.sequences.append(actions)
+			return len(self.sequences) - 1
+
+	def __getitem__(self, sequenceId):
+		return self.sequences[sequenceId]
+
+	def pack(self, sequenceIds):
+		"""Returns the sequences sequenceIds stored in one array and the offset
+		of each sequence in it.  Longer sequences are stored first, so that a
+		sequence which is a suffix of a stored one shares its actions."""
+		actions = []
+		offsets = dict()
+		suffixes = dict()
+		for sequenceId in sorted(set(sequenceIds), key=lambda sequenceId: (-len(self.sequences[sequenceId]), self.sequences[sequenceId])):
+			sequence = self.sequences[sequenceId]
+			if sequence not in suffixes:
+				for i in range(0, len(sequence) + 1):
+					suffixes.setdefault(sequence[i:], len(actions) + i)
+				actions.extend(sequence)
+			offsets[sequenceId] = suffixes[sequence]
+		return actions, offsets
+
+actionTable = ActionTable()
+
+# ids of the actions that take effect every time a path executes them, like
+# counter operations, which are not merged with an earlier occurrence
+repeatableActions = set()
+
+def newActions(present, actions):
+	"""Returns the actions not in present and the repeatable ones, which a
+	path accumulating actions adds to present."""
+	return [action for action in actions if action in repeatableActions or action not in present]
+
+def mergeActions(present, actions):
+	"""Returns the actions of another path to the same place not in present.
+	Repeatable actions are only executed on the first path."""
+	return [action for action in actions if action not in repeatableActions and action not in present]
+
+class CopyCounter(object):
+	"""Counts the copies particle instantiates from its templates and their
+	states and transitions."""
+	__slots__ = ("copies", "states", "transitions")
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.copies = self.states = self.transitions = 0
+
+	def add(self, copies, states, transitions):
+		"""Counts copies of a template with the given numbers of states and
+		transitions."""
+		self.copies += copies
+		self.states += copies * states
+		self.transitions += copies * transitions
+
+copyCounter = CopyCounter()
 
 class Transition(object):
+	__slots__ = ("label", "target", "actions")
+
 	def __init__(self, label, target, actions=[]):
 		self.label = label
 		self.target = target
 		self.actions = list(actions)
 
 	def appendActions(self, actions):
-		self.actions.extend([action for action in actions if action not in self.actions])
+		self.actions.extend(newActions(set(self.actions), actions))
 
 	def prependActions(self, actions):
-		self.actions[:0] = [action for action in actions if action not in self.actions]
+		self.actions[:0] = newActions(set(self.actions), actions)
 
 class State(object):
+	__slots__ = ("onleave", "transitions", "id")
+
 	def __init__(self):
 		self.onleave = list()
-		self.transitions = set()
+		# the transitions by their label and target, which addTransition
+		# merges into one
+		self.transitions = dict()
 		self.id = None
 
 	def addTransition(self, label, target, actions=[]):
-		trans = set([t for t in self.transitions if t.label == label and t.target == target])
-		if len(trans) > 0:
-			for t in trans: t.appendActions(actions)
+		t = self.transitions.get((label, target))
+		if t is not None:
+			t.actions.extend(mergeActions(set(t.actions), actions))
 		else:
-			self.transitions.add(Transition(label, target, list(actions)))
+			self.transitions[(label, target)] = Transition(label, target, list(actions))
 
 class Fsm(object):
+	__slots__ = ("entry", "accepts")
+
 	def __init__(self):
 		self.entry = None
 		self.accepts = set()
 
+	def compact(self):
+		return CompactFsm.fromFsm(self)
+
+	def toFsm(self):
+		return self
+
 	def onenter(self, actions):
-		for t in self.entry.transitions:
+		for t in self.entry.transitions.itervalues():
 			t.prependActions(actions)
 		return self
 
@@ -48,7 +136,7 @@ class Fsm(object):
 	def onfinal(self, actions):
 		states = self.reachables()
 		for state in states:
-			trans = [t for t in state.transitions if t.target in self.accepts]
+			trans = [t for t in state.transitions.itervalues() if t.target in self.accepts]
 			for t in trans: t.appendActions(actions)
 		return self
 
@@ -58,12 +146,14 @@ class Fsm(object):
 		return self
 
 	def concat(self, b):
+		b = b.toFsm()
 		for state in self.accepts:
 			state.addTransition(None, b.entry, state.onleave)
 		self.accepts = b.accepts
 		return self
 
 	def union(self, b):
+		b = b.toFsm()
 		entry = State()
 		entry.addTransition(None, self.entry)
 		entry.addTransition(None, b.entry)
@@ -82,38 +172,27 @@ class Fsm(object):
 		self.accepts = set([final])
 		return self
 
+	def countStates(self):
+		return len(self.reachables())
+
 	def reachables(self):
 		states = list()
+		seen = set([self.entry])
 		queue = deque([self.entry])
 		while len(queue) > 0:
 			state = queue.popleft()
 			states.append(state)
-			for trans in state.transitions:
-				if trans.target not in states and trans.target not in queue:
+			for trans in state.transitions.itervalues():
+				if trans.target not in seen:
+					seen.add(trans.target)
 					queue.append(trans.target)
 		return states
 
-	@staticmethod
-	def closure(states):
-		if not isinstance(states, Iterable): states = [states]
-		states = list(states)
-		actions = [list() for i in range(0, len(states))]
-		queue = deque(states)
-		while len(queue) > 0:
-			state = queue.popleft()
-			# states reachable from [state] via epsilon transitions
-			eps_trans = [trans for trans in state.transitions if trans.label is None]
-			for trans in eps_trans:
-				if trans.target not in states:
-					states.append(trans.target)
-					actions.append(list(actions[states.index(state)]))
-					queue.append(trans.target)
-				actions[states.index(trans.target)].extend([a for a in trans.actions if a not in actions[states.index(trans.target)]])
-#		print "  closure has length %d: %s" % (len(states), actions)
-		return states, actions
-
 class XMLFsm(Fsm):
+	__slots__ = ()
+
 	def element(self, elementId, content, onenter=[], onleave=[]):
+		content = content.toFsm()
 		entry = State()
 		final = State()
 		entry.addTransition(elementId, content.entry, onenter)
@@ -123,17 +202,28 @@ class XMLFsm(Fsm):
 		self.entry = entry
 		self.accepts = set([final])
 		return self
+
+	def symbol(self, label, onenter=[]):
+		"""A single transition on label, such as the invocation of another
+		machine."""
+		self.entry = State()
+		final = State()
+		self.entry.addTransition(label, final, onenter)
+		self.accepts = set([final])
+		return self
 		
 	def choice(self, fsms, onenter=[], onleave=[]):
+		fsms = [fsm.toFsm() for fsm in fsms]
 		self.entry = State()
 		self.accepts = set()
 		for fsm in fsms:
 			self.entry.addTransition(None, fsm.entry, list(onenter))
-			self.accepts = self.accepts.union(fsm.accepts)
+			self.accepts.update(fsm.accepts)
 		self.onleave(list(onleave))
 		return self
 
 	def sequence(self, fsms, onenter=[], onleave=[]):
+		fsms = [fsm.toFsm() for fsm in fsms]
 		fsms.reverse()
 		self.entry = fsms[0].entry
 		self.accepts = fsms[0].accepts
@@ -147,228 +237,1079 @@ class XMLFsm(Fsm):
 		self.onleave(list(onleave))
 		return self
 
-	def particle(term, minOccurs, maxOccurs):
+	def particle(term, minOccurs, maxOccurs, counter=None):
+		return particle(term, minOccurs, maxOccurs, counter)
+
+	def dump(self):
+		self.compact().dump()
+
+	def determinize(self, verbose = True, simplify = True):
+		return self.compact().determinize(verbose, simplify)
+
+	def simplify(self, verbose = True):
+		return self.compact().simplify(verbose)
+
+	def reduce(self, verbose = True):
+		return self.compact().reduce(verbose)
+
+	def minimize(self, verbose = True):
+		return self.compact().minimize(verbose)
+
+	def hopcroft(self, verbose = True):
+		return self.compact().hopcroft(verbose)
+
+def joinActions(a, b):
+	"""Returns the actions a followed by those of b not in a, the way the
+	epsilon closure accumulates the actions along a path."""
+	return a + tuple(newActions(set(a), b))
+
+def addActions(positions, position, actions):
+	"""Maps position to actions unless another path to it was added before,
+	which is the shorter one as the epsilon closure would find it first."""
+	if position not in positions:
+		positions[position] = actions
+
+class GlushkovFsm(object):
+	"""Position automaton of a content model, which has no epsilon
+	transitions.  Every labeled transition of the content model is a
+	position and a state at once.  first maps the positions that can be
+	reached first and follow[p] those that can follow position p to the
+	actions pending from the epsilon transitions on the way, None if there
+	are none, and the actions of the labeled transition itself.  last maps
+	the positions that can be reached last to the actions executed after
+	them.  null holds the actions of the empty path, None if there is none.
+
+	The combinators follow XMLFsm, including where onenter applies: to the
+	paths leaving the entry, which excludes the empty path of a bare entry
+	that accepts by itself, but includes the paths that return to the entry,
+	as the loop of kleene does.  via maps the positions returning to the
+	entry to the actions executed up to it, their paths on from the entry
+	are only added by settle once another state has become the entry.  For
+	content models that satisfy the Unique Particle Attribution rule the
+	automaton is deterministic."""
+	__slots__ = ("labels", "follow", "first", "last", "null", "bare", "via")
+
+	def __init__(self):
+		self.labels = list()
+		self.follow = list()
+		self.first = dict()
+		self.last = dict()
+		self.null = None
+		self.bare = False
+		self.via = dict()
+
+	@staticmethod
+	def fromFsm(fsm):
+		"""Returns the position automaton of an automaton without epsilon
+		transitions, with a position per state and label it is entered by."""
+		fsm = fsm.compact()
+		glushkov = GlushkovFsm()
+		positions = dict()
+		order = list()
+		def position(state, label):
+			if not positions.has_key((state, label)):
+				positions[(state, label)] = len(order)
+				order.append((state, label))
+				glushkov.labels.append(label)
+				glushkov.follow.append(dict())
+			return positions[(state, label)]
+		for label, target, actions in fsm.transitions(fsm.entry):
+			addActions(glushkov.first, position(target, label), (None, actions))
+		for p, (state, label) in enumerate(order):
+			if state == fsm.entry:
+				# the transitions of the entry are those of first
+				glushkov.via[p] = ()
+				continue
+			for label, target, actions in fsm.transitions(state):
+				addActions(glushkov.follow[p], position(target, label), (None, actions))
+			if fsm.final[state]:
+				glushkov.last[p] = actionTable[fsm.leave[state]]
+		if fsm.final[fsm.entry]:
+			glushkov.null = actionTable[fsm.leave[fsm.entry]]
+			# as with CompactFsm.onenter, the leave actions of the entry are
+			# not affected by onenter
+			glushkov.bare = True
+		return glushkov
+
+	def compact(self):
+		"""Returns the automaton with the entry as state 0 and position p as
+		state p + 1."""
+		if len(self.via) > 0:
+			return self.copy().settle().compact()
+		fsm = CompactFsm()
+		fsm.addState(self.null is not None,
+		             [(self.labels[q], q + 1, actionTable.intern((pending or ()) + actions)) for q, (pending, actions) in sorted(self.first.iteritems())],
+		             actionTable.intern(self.null or ()))
+		for p in xrange(0, len(self.labels)):
+			fsm.addState(p in self.last,
+			             [(self.labels[q], q + 1, actionTable.intern((pending or ()) + actions)) for q, (pending, actions) in sorted(self.follow[p].iteritems())],
+			             actionTable.intern(self.last.get(p, ())))
+		return fsm
+
+	def toFsm(self):
+		return self
+
+	def countStates(self):
+		return len(self.labels) + 1
+
+	def copy(self):
+		fsm = GlushkovFsm()
+		fsm.labels = list(self.labels)
+		fsm.follow = [dict(follow) for follow in self.follow]
+		fsm.first = dict(self.first)
+		fsm.last = dict(self.last)
+		fsm.null = self.null
+		fsm.bare = self.bare
+		fsm.via = dict(self.via)
+		return fsm
+
+	def dump(self):
+		self.compact().dump()
+
+	def reduce(self, verbose = True):
+		"""Returns an automaton with the positions merged that have the same
+		label and the same actions on every way to go on, which executes
+		the same actions wherever it is embedded, or this one.  Positions are
+		not merged if two with the same label can follow the same one, as
+		merging them could drop one of the ways to get there."""
+		for positions in [self.first] + self.follow:
+			labels = [self.labels[q] for q in positions]
+			if len(set(labels)) < len(labels):
+				return self
+		block = [(label, self.last.get(p), self.via.get(p)) for p, label in enumerate(self.labels)]
+		blocks = -1
+		while True:
+			signatures = dict()
+			refined = list()
+			for p in xrange(0, len(self.labels)):
+				signature = (block[p], frozenset([(block[q], actions) for q, actions in self.follow[p].iteritems()]))
+				refined.append(signatures.setdefault(signature, len(signatures)))
+			block = refined
+			if len(signatures) == blocks:
+				break
+			blocks = len(signatures)
+		if blocks == len(self.labels):
+			return self
+		result = GlushkovFsm()
+		result.labels = [None] * blocks
+		result.follow = [None] * blocks
+		for p in xrange(0, len(self.labels)):
+			if result.follow[block[p]] is None:
+				result.labels[block[p]] = self.labels[p]
+				result.follow[block[p]] = dict([(block[q], actions) for q, actions in self.follow[p].iteritems()])
+			if self.last.has_key(p):
+				result.last[block[p]] = self.last[p]
+		result.first = dict([(block[q], actions) for q, actions in self.first.iteritems()])
+		result.via = dict([(block[p], actions) for p, actions in self.via.iteritems()])
+		result.null = self.null
+		result.bare = self.bare
+		if verbose: print "Position automaton reduced from %d to %d positions" % (len(self.labels), blocks)
+		return result
+
+	def settle(self):
+		"""Adds the paths through the entry, which onenter does not reach
+		any more once the entry is an inner state."""
+		for p, before in self.via.iteritems():
+			self.link({p: before}, self.first)
+			if self.null is not None:
+				addActions(self.last, p, joinActions(before, self.null))
+		self.via = dict()
+		return self
+
+	def add(self, fsm):
+		"""Adds the positions of fsm, whose entry becomes an inner state, and
+		returns its first and last positions as they are numbered here."""
+		fsm.settle()
+		offset = len(self.labels)
+		self.labels.extend(fsm.labels)
+		for follow in fsm.follow:
+			self.follow.append(dict([(q + offset, actions) for q, actions in follow.iteritems()]))
+		return (dict([(q + offset, actions) for q, actions in fsm.first.iteritems()]),
+		        dict([(p + offset, actions) for p, actions in fsm.last.iteritems()]))
+
+	def link(self, last, first):
+		"""Lets each position of first follow each one of last."""
+		for p, before in last.iteritems():
+			follow = self.follow[p]
+			for q, (pending, actions) in first.iteritems():
+				addActions(follow, q, (joinActions(before, pending or ()), actions))
+
+	def empty(self):
+		self.__init__()
+		self.null = ()
+		self.bare = True
+		return self
+
+	def symbol(self, label, onenter=[]):
+		"""A single position on label, such as the invocation of another
+		machine."""
+		self.__init__()
+		self.labels.append(label)
+		self.follow.append(dict())
+		self.first[0] = (None, tuple(onenter))
+		self.last[0] = ()
+		return self
+
+	def element(self, elementId, content, onenter=[], onleave=[]):
+		self.symbol(elementId, onenter)
+		first, last = self.add(content)
+		close = len(self.labels)
+		self.labels.append(0)
+		self.follow.append(dict())
+		onleave = tuple(onleave)
+		self.link({0: ()}, first)
+		self.link(dict([(p, actions + onleave) for p, actions in last.iteritems()]), {close: (None, ())})
+		if content.null is not None:
+			self.link({0: ()}, {close: (content.null + onleave, ())})
+		self.last = {close: ()}
+		return self
+
+	def choice(self, fsms, onenter=[], onleave=[]):
+		self.__init__()
+		onenter = tuple(onenter)
+		for fsm in fsms:
+			first, last = self.add(fsm)
+			for q, (pending, actions) in first.iteritems():
+				addActions(self.first, q, (joinActions(onenter, pending or ()), actions))
+			self.last.update(last)
+			if fsm.null is not None and self.null is None:
+				self.null = joinActions(onenter, fsm.null)
+		return self.onleave(onleave)
+
+	def sequence(self, fsms, onenter=[], onleave=[]):
+		self.empty()
+		for fsm in fsms:
+			self.concat(fsm)
+		return self.onenter(onenter).onleave(onleave)
+
+	def concat(self, b):
+		# the paths through the entry continue into b by way of null
+		first, last = self.add(b)
+		self.link(self.last, first)
+		if self.null is not None:
+			for q, (pending, actions) in first.iteritems():
+				addActions(self.first, q, (joinActions(self.null, pending or ()), actions))
+		if b.null is not None:
+			for p, actions in self.last.iteritems():
+				addActions(last, p, joinActions(actions, b.null))
+		self.last = last
+		self.null = None if self.null is None or b.null is None else joinActions(self.null, b.null)
+		self.bare = False
+		return self
+
+	def kleene(self):
+		# the loop returns to a new entry, which is left for another
+		# iteration or without actions
+		self.settle()
+		self.first = self.entered()
+		self.via = self.last
+		self.last = dict()
+		self.null = ()
+		self.bare = False
+		return self
+
+	def optional(self):
+		# skipping is the shortest path, whether or not the content is
+		# nullable itself
+		self.null = ()
+		self.bare = False
+		return self
+
+	def entered(self):
+		"""Returns first as seen from a new entry with an epsilon transition
+		to the current one."""
+		return dict([(q, (pending or (), actions)) for q, (pending, actions) in self.first.iteritems()])
+
+	def onenter(self, actions):
+		# prepended to the transitions leaving the entry, which are labeled
+		# for the positions without pending actions
+		prepend = lambda current: tuple(newActions(current, actions)) + current
+		for q, (pending, own) in self.first.items():
+			self.first[q] = (None, prepend(own)) if pending is None else (prepend(pending), own)
+		if self.null is not None and not self.bare:
+			self.null = prepend(self.null)
+		return self
+
+	def onleave(self, actions):
+		actions = tuple(actions)
+		for p in self.last:
+			self.last[p] += actions
+		if self.null is not None:
+			self.null += actions
+		return self
+
+	def particle(self, minOccurs, maxOccurs, counter=None):
+		"""Repeats the content model like particle, copies get fresh
+		positions."""
+		if minOccurs == 1 and maxOccurs == 1:
+			self.settle()
+			self.first = self.entered()
+			self.bare = False
+			return self
+		transitions = len(self.first) + sum(map(len, self.follow))
+		if counter is not None:
+			copyCounter.add(1, len(self.labels) + 1, transitions)
+			enter, iterate, leave = map(tuple, counter)
+			self.settle()
+			self.link(dict([(p, joinActions(actions, iterate)) for p, actions in self.last.iteritems()]), self.first)
+			self.first = dict([(q, (joinActions(joinActions(enter, iterate), pending or ()), actions)) for q, (pending, actions) in self.first.iteritems()])
+			self.last = dict([(p, joinActions(actions, leave)) for p, actions in self.last.iteritems()])
+			self.null = joinActions(enter, leave)
+			self.bare = False
+			return self
+		copyCounter.add(minOccurs + (1 if maxOccurs == "unbounded" else maxOccurs - minOccurs), len(self.labels) + 1, transitions)
 		if maxOccurs == "unbounded":
-			a = (copy.deepcopy(term)).kleene()
+			tail = self.copy().kleene()
 		else:
-			a = type(term)().empty()
-			leave = a.entry
+			tail = GlushkovFsm().empty()
 			for i in range(0, maxOccurs - minOccurs):
-				c = copy.deepcopy(term)
-				c.concat(a)
-				c.entry.addTransition(None, leave)
-				a = c
+				tail = self.copy().concat(tail).optional()
 		if minOccurs > 0:
-			b = type(term)().empty()
+			result = GlushkovFsm().empty()
 			for i in range(0, minOccurs):
-				c = copy.deepcopy(term)
-				b.concat(c)
-			if maxOccurs == "unbounded" or maxOccurs - minOccurs > 0:
-				b.concat(a)
-			return b
-		return a
+				result.concat(self.copy())
+			if maxOccurs == "unbounded" or maxOccurs > minOccurs:
+				result.concat(tail)
+			return result
+		return tail
+
+class CompactFsm(object):
+	"""Array backed automaton with integer states.  The transitions of state s
+	are stored at offsets[s]:offsets[s + 1] of the labels, targets and actions
+	arrays, ordered by label.  Action lists, including the per state leave
+	actions, are ids into actionTable."""
+	__slots__ = ("entry", "final", "leave", "offsets", "labels", "targets", "actions")
+
+	def __init__(self):
+		self.entry = 0
+		self.final = bytearray()
+		self.leave = array("l")
+		self.offsets = array("l", [0])
+		self.labels = list()
+		self.targets = array("l")
+		self.actions = array("l")
+
+	@staticmethod
+	def fromFsm(fsm):
+		states = fsm.reachables()
+		index = dict((state, i) for i, state in enumerate(states))
+		compact = CompactFsm()
+		compact.entry = index[fsm.entry]
+		for state in states:
+			compact.addState(state in fsm.accepts,
+			                 [(t.label, index[t.target], actionTable.intern(t.actions)) for t in state.transitions.itervalues()],
+			                 actionTable.intern(state.onleave))
+		return compact
+
+	def toFsm(self):
+		states = [State() for s in xrange(0, len(self.final))]
+		fsm = XMLFsm()
+		for s in xrange(0, len(self.final)):
+			states[s].onleave = list(actionTable[self.leave[s]])
+			for t in xrange(self.offsets[s], self.offsets[s + 1]):
+				states[s].addTransition(self.labels[t], states[self.targets[t]], actionTable[self.actions[t]])
+			if self.final[s]:
+				fsm.accepts.add(states[s])
+		fsm.entry = states[self.entry]
+		return fsm
+
+	def compact(self):
+		return self
+
+	def copy(self):
+		fsm = CompactFsm()
+		fsm.entry = self.entry
+		fsm.final = bytearray(self.final)
+		fsm.leave = array("l", self.leave)
+		fsm.offsets = array("l", self.offsets)
+		fsm.labels = list(self.labels)
+		fsm.targets = array("l", self.targets)
+		fsm.actions = array("l", self.actions)
+		return fsm
+
+	def relabel(self, labels, actions):
+		"""Returns a copy with the labels and actions renumbered by the given
+		mappings, epsilon transitions are left as they are."""
+		remap = lambda sequenceId: actionTable.intern([actions[a] for a in actionTable[sequenceId]])
+		fsm = CompactFsm()
+		fsm.entry = self.entry
+		for s in xrange(0, len(self.final)):
+			fsm.addState(self.final[s],
+			             [(None if label is None else labels[label], target, remap(actionId)) for label, target, actionId in
+			              zip(self.labels[self.offsets[s]:self.offsets[s + 1]], self.targets[self.offsets[s]:self.offsets[s + 1]],
+			                  self.actions[self.offsets[s]:self.offsets[s + 1]])],
+			             remap(self.leave[s]))
+		return fsm
+
+	def __getstate__(self):
+		# action ids are only valid within one process, so the sequences are
+		# pickled and interned again when loading
+		return (self.entry, str(self.final), [actionTable[a] for a in self.leave], self.offsets.tolist(),
+		        self.labels, self.targets.tolist(), [actionTable[a] for a in self.actions])
+
+	def __setstate__(self, state):
+		entry, final, leave, offsets, labels, targets, actions = state
+		self.entry = entry
+		self.final = bytearray(final)
+		self.leave = array("l", map(actionTable.intern, leave))
+		self.offsets = array("l", offsets)
+		self.labels = labels
+		self.targets = array("l", targets)
+		self.actions = array("l", map(actionTable.intern, actions))
+
+	def addState(self, final, transitions, onleave=0):
+		"""Appends a state with the given (label, target, actions id) transitions
+		and returns its number."""
+		for label, target, actions in sorted(transitions, key=itemgetter(0)):
+			self.labels.append(label)
+			self.targets.append(target)
+			self.actions.append(actions)
+		self.offsets.append(len(self.targets))
+		self.final.append(bool(final))
+		self.leave.append(onleave)
+		return len(self.final) - 1
+
+	@property
+	def accepts(self):
+		return set([s for s in xrange(0, len(self.final)) if self.final[s]])
+
+	def isFinal(self, state):
+		return bool(self.final[state])
+
+	def countStates(self):
+		return len(self.final)
+
+	def isDeterministic(self):
+		"""Whether no reachable state has epsilon transitions or several
+		transitions with the same label."""
+		for state in self.reachables():
+			labels = self.labels[self.offsets[state]:self.offsets[state + 1]]
+			if None in labels or len(set(labels)) < len(labels):
+				return False
+		return True
+
+	def transitions(self, state):
+		for t in xrange(self.offsets[state], self.offsets[state + 1]):
+			yield self.labels[t], self.targets[t], actionTable[self.actions[t]]
+
+	def reachables(self, entries=None):
+		"""Returns the states reachable from entries, by default from the
+		entry state, in breadth first order."""
+		states = []
+		seen = bytearray(len(self.final))
+		for entry in [self.entry] if entries is None else entries:
+			if not seen[entry]:
+				seen[entry] = 1
+				states.append(entry)
+		for state in states:
+			for t in xrange(self.offsets[state], self.offsets[state + 1]):
+				if not seen[self.targets[t]]:
+					seen[self.targets[t]] = 1
+					states.append(self.targets[t])
+		return states
+
+	def onenter(self, actions):
+		for t in xrange(self.offsets[self.entry], self.offsets[self.entry + 1]):
+			current = actionTable[self.actions[t]]
+			self.actions[t] = actionTable.intern(newActions(current, actions) + list(current))
+		return self
+
+	def onleave(self, actions):
+		for s in xrange(0, len(self.final)):
+			if self.final[s]:
+				self.leave[s] = actionTable.intern(actionTable[self.leave[s]] + tuple(actions))
+		return self
+
+	def onfinal(self, actions):
+		for t in xrange(0, len(self.targets)):
+			if self.final[self.targets[t]]:
+				current = actionTable[self.actions[t]]
+				self.actions[t] = actionTable.intern(current + tuple(newActions(current, actions)))
+		return self
+
+	def concat(self, b):
+		return self.toFsm().concat(b)
+
+	def union(self, b):
+		return self.toFsm().union(b)
+
+	def kleene(self):
+		return self.toFsm().kleene()
+
+	def particle(self, minOccurs, maxOccurs, counter=None):
+		return particle(self, minOccurs, maxOccurs, counter)
 
 	def dump(self):
 		states = self.reachables()
-		for idx in range(0, len(states)):
-			state = states[idx]
+		index = dict((state, i) for i, state in enumerate(states))
+		for idx, state in enumerate(states):
 			line = ""
-			line += "%s\t%s%d%s| " % ("entry:" if state == self.entry else "", "[" if state in self.accepts else " ", idx, "]" if state in self.accepts else " ")
-			for label in set([t.label for t in state.transitions]):
+			line += "%s\t%s%d%s| " % ("entry:" if state == self.entry else "", "[" if self.final[state] else " ", idx, "]" if self.final[state] else " ")
+			for label, transitions in groupby(self.transitions(state), key=itemgetter(0)):
 				line += "%s -> " % label
-				targets = [t.target for t in state.transitions if t.label == label]
-				for target in targets:
-					actions = list()
-					for a in [t.actions for t in state.transitions if t.label == label and t.target == target]:
-						actions.extend(a)
-					line += "%d / %s | " % (states.index(target), ", ".join(["%d" % action for action in actions]))
+				for label, target, actions in transitions:
+					line += "%d / %s | " % (index[target], ", ".join(["%d" % action for action in actions]))
 			print line
 
-	def determinize(self, verbose = True):
-		NFAstates = self.reachables()
-		if verbose: print "Determinizing NFA of size %d" % len(NFAstates)
-		states, actions = XMLFsm.closure(self.entry)
-		sets = [states]
-		queue = deque([(0, actions)])
-		DFAstates = [State()]
-		DFA = XMLFsm()
-		DFA.entry = DFAstates[0]
-		if len([x for x in states if x in self.accepts]) > 0:
-			DFA.accepts.add(DFAstates[0])
+	def closure(self, states):
+		states = list(states)
+		index = dict((state, i) for i, state in enumerate(states))
+		actions = [list() for i in range(0, len(states))]
+		queue = deque(states)
 		while len(queue) > 0:
-			i, actions = queue.popleft()
+			state = queue.popleft()
+			# states reachable from [state] via epsilon transitions
+			for t in xrange(self.offsets[state], self.offsets[state + 1]):
+				if self.labels[t] is not None:
+					continue
+				target = self.targets[t]
+				if not index.has_key(target):
+					index[target] = len(states)
+					states.append(target)
+					actions.append(list(actions[index[state]]))
+					queue.append(target)
+					target_actions = actions[-1]
+					target_actions.extend(newActions(target_actions, actionTable[self.actions[t]]))
+				else:
+					target_actions = actions[index[target]]
+					target_actions.extend(mergeActions(target_actions, actionTable[self.actions[t]]))
+		return states, actions
+
+	def closures(self, states, cache):
+		"""Epsilon closure of states, memoized in cache.  Single states are
+		cached by themselves, sets of states by the order they are given in,
+		as that order determines the accumulated actions.  The returned lists
+		are shared with the cache and must not be modified."""
+		key = states[0] if len(states) == 1 else tuple(states)
+		if not cache.has_key(key):
+			cache[key] = self.closure(states)
+		return cache[key]
+
+	def leaveActions(self, states, actions):
+		"""Actions a transition leaving the set of states would have to execute:
+		the pending closure actions of the first final state followed by the
+		distinct leave actions of the final states.  None if no state is final."""
+		finals = [k for k in range(0, len(states)) if self.final[states[k]]]
+		if len(finals) == 0:
+			return None
+		leave = list(actions[finals[0]])
+		sequences = list()
+		for k in finals:
+			if self.leave[states[k]] not in sequences:
+				sequences.append(self.leave[states[k]])
+				leave.extend(actionTable[self.leave[states[k]]])
+		return actionTable.intern(leave)
+
+	def simplify(self, verbose = True):
+		"""Returns an automaton accepting the same paths with fewer states:
+		chains of states left by a single epsilon transition are contracted,
+		states no final state is reachable from are dropped and states with
+		the same finality, leave actions and transitions are merged.  Every
+		path keeps its labels and the order of its actions.  Actions of
+		epsilon transitions stay on epsilon transitions, so they remain
+		pending until the next element event."""
+		states = self.reachables()
+		# the end of the chain of single epsilon transitions leaving each
+		# state and the combined actions of the chain
+		chains = dict()
+		for state in states:
+			path = [state]
+			actions = list()
+			while True:
+				t = self.offsets[path[-1]]
+				if (self.final[path[-1]] or self.offsets[path[-1] + 1] - t != 1 or self.labels[t] is not None or
+				    self.targets[t] in path):
+					break
+				actions.extend(newActions(actions, actionTable[self.actions[t]]))
+				path.append(self.targets[t])
+			chains[state] = (path[-1], actionTable.intern(actions))
+
+		def skip(label, target, actions):
+			end, chain = chains[target]
+			if label is None:
+				current = actionTable[actions]
+				return label, end, actionTable.intern(current + tuple(newActions(current, actionTable[chain])))
+			# a labeled transition would execute the actions of the chain too
+			# early, so it only skips chains without actions
+			return label, end if chain == 0 else target, actions
+
+		entry = chains[self.entry][0] if chains[self.entry][1] == 0 else self.entry
+		rows = dict()
+		queue = deque([entry])
+		rows[entry] = None
+		while len(queue) > 0:
+			state = queue.popleft()
+			rows[state] = [skip(self.labels[t], self.targets[t], self.actions[t]) for t in xrange(self.offsets[state], self.offsets[state + 1])]
+			for label, target, actions in rows[state]:
+				if not rows.has_key(target):
+					rows[target] = None
+					queue.append(target)
+
+		# the states a final state is reachable from, and the entry
+		sources = dict()
+		for state in rows:
+			for label, target, actions in rows[state]:
+				sources.setdefault(target, list()).append(state)
+		live = set([state for state in rows if self.final[state]])
+		queue = deque(live)
+		while len(queue) > 0:
+			for source in sources.get(queue.popleft(), ()):
+				if source not in live:
+					live.add(source)
+					queue.append(source)
+		live.add(entry)
+		for state in live:
+			rows[state] = [t for t in rows[state] if t[1] in live]
+
+		# states with the same finality, leave actions and transitions are
+		# merged, and the sources of merged states are examined again until
+		# all states differ.  Each block is represented by its first state.
+		block = dict((state, state) for state in live)
+		members = dict((state, [state]) for state in live)
+		representatives = dict()
+		queue = deque(sorted(live))
+		while len(queue) > 0:
+			state = queue.popleft()
+			if block[state] != state:
+				continue
+			signature = (self.final[state], self.leave[state] if self.final[state] else 0,
+			             frozenset([(label, block[target], actions) for label, target, actions in rows[state]]))
+			representative = representatives.setdefault(signature, state)
+			if block[representative] != representative:
+				representatives[signature] = representative = state
+			if representative == state:
+				continue
+			for member in members.pop(state):
+				block[member] = representative
+				members[representative].append(member)
+				queue.extend([source for source in sources.get(member, ()) if source in live])
+
+		result = CompactFsm()
+		index = {block[entry]: 0}
+		order = [block[entry]]
+		for state in order:
+			transitions = list()
+			for label, target, actions in rows[state]:
+				if not index.has_key(block[target]):
+					index[block[target]] = len(order)
+					order.append(block[target])
+				if (label, index[block[target]], actions) not in transitions:
+					transitions.append((label, index[block[target]], actions))
+			result.addState(self.final[state], transitions, self.leave[state])
+		if verbose: print "NFA simplified from %d states and %d transitions to %d states and %d transitions" % (
+			len(states), sum([self.offsets[s + 1] - self.offsets[s] for s in states]), len(result.final), len(result.labels))
+		return result
+
+	def determinize(self, verbose = True, simplify = True):
+		"""Subset construction, after simplify unless simplify is False.  The
+		transition on a label executes the actions pending on the first NFA
+		state with a transition on it followed by the actions of all those
+		transitions, and leads to the closure of their targets taken in the
+		order they are found.  Content models violating the Unique Particle
+		Attribution rule can have several targets on a label, whose actions
+		are accumulated in that order.  Earlier versions took the targets in
+		the order of a set of state objects, so the actions of such content
+		models may be ordered differently than before, for example
+		[10, 9, 9, 2, 5] instead of [10, 9, 2, 9, 5].  Neither order is
+		defined by the schema, and the transitions of the XMLFsm states are
+		hashed by their targets as well, which orders the branches of an
+		ambiguous choice by the addresses of their objects."""
+		if simplify:
+			return self.simplify(verbose).determinize(verbose, False)
+		if verbose: print "Determinizing NFA of size %d" % len(self.reachables())
+		cache = dict()
+		states, actions = self.closures([self.entry], cache)
+		# DFA states are keyed by the set of NFA states they represent together
+		# with the actions pending on them, the lists keep the closure order
+		# which determines the action order
+		sets = [states]
+		pending = [actions]
+		setIndex = {frozenset(zip(states, map(tuple, actions))): 0}
+		leave = [self.leaveActions(states, actions)]
+		DFA = CompactFsm()
+		i = 0
+		# DFA states are numbered in the order they are discovered, so they can
+		# be appended to the arrays in the order they are processed
+		while i < len(sets):
+			actions = pending[i]
+			pending[i] = None
+			labels = list()
 			transitions = dict()
+			seen = set()
 			tactions = dict()
 			# for every NFA state from active set
-			for state in sets[i]:
+			for k, state in enumerate(sets[i]):
 				# collect non-epsilon transitions
-				for trans in state.transitions:
-					if trans.label is not None:
+				for t in xrange(self.offsets[state], self.offsets[state + 1]):
+					label = self.labels[t]
+					if label is not None:
 						# as key -> list of target states
-						if not transitions.has_key(trans.label):
-							transitions[trans.label] = set()
-							tactions[trans.label] = list( actions[ sets[i].index(state) ] )
-						if trans.target not in transitions[trans.label]:
-							transitions[trans.label].add(trans.target)
-						tactions[trans.label].extend(trans.actions)
-
-			for label, targets in transitions.iteritems():
-				targets, actions = XMLFsm.closure(targets)
-				if targets not in sets:
+						if not transitions.has_key(label):
+							labels.append(label)
+							transitions[label] = list()
+							tactions[label] = list(actions[k])
+						if (label, self.targets[t]) not in seen:
+							seen.add((label, self.targets[t]))
+							transitions[label].append(self.targets[t])
+						tactions[label].extend(actionTable[self.actions[t]])
+
+			row = list()
+			for label in labels:
+				targets, actions = self.closures(transitions[label], cache)
+				key = frozenset(zip(targets, map(tuple, actions)))
+				if not setIndex.has_key(key):
 					j = len(sets)
-					queue.append((j, actions))
+					setIndex[key] = j
 					sets.append(targets)
-					DFAstates.append(State())
-					if len([x for x in targets if x in self.accepts]) > 0:
-						DFA.accepts.add(DFAstates[j])
-#						onleave_actions = [list(target.onleave) for target in targets if target in self.accepts]
-#						print "actions when leaving state %d: %s" % (j, onleave_actions)
-#						for a in onleave_actions:
-#							DFAstates[j].onleave.extend(a)
+					pending.append(actions)
+					leave.append(self.leaveActions(targets, actions))
 				else:
-					j = sets.index(targets)
-				DFAstates[i].addTransition(label, DFAstates[j], tactions[label])
+					j = setIndex[key]
+				row.append((label, j, actionTable.intern(tactions[label])))
+			DFA.addState(leave[i] is not None, row, leave[i] or 0)
+			i += 1
 		return DFA
 
+	def reduce(self, verbose = True):
+		"""Returns an automaton with fewer states that executes the same
+		actions as this one wherever it is embedded, or this one.  Only the
+		states in between are determinized and minimized, as the surrounding
+		automaton adds its actions to the transitions leaving the entry, to
+		the final states and to the transitions leaving them: the states
+		around the entry, which epsilon transitions lead to from it, are kept
+		as they are with their transitions and the final states without.  A
+		DFA state has an epsilon transition to each final state of its
+		closure and to each state around the entry a path returns to, in
+		closure order, so a loop executes the actions added to the entry on
+		every iteration.  The pending actions of the closures would end up on
+		the labeled transitions of the DFA, so automata with actions of their
+		own are not reduced, nor are those where two transitions on the same
+		label can be taken together and the DFA would grow.  Content models
+		satisfying the Unique Particle Attribution rule execute the same
+		actions when the other content models around them do too."""
+		reachables = self.reachables()
+		for state in reachables:
+			if self.leave[state] or any(self.actions[self.offsets[state]:self.offsets[state + 1]]):
+				return self
+		cache = dict()
+		around = self.closures([self.entry], cache)[0]
+		excluded = set(around)
+		# the DFA of the states in between, state 0 is the target of the
+		# transitions to the final states and the states around the entry,
+		# labeled with their closure order and the state so minimization
+		# keeps them apart
+		DFA = CompactFsm()
+		DFA.addState(False, [])
+		sets = [None]
+		setIndex = dict()
+
+		def row(states, skipped):
+			"""The DFA states the labeled transitions leaving states except
+			the skipped ones lead to, None if several of them share a label."""
+			transitions = dict()
+			for state in states:
+				if state in skipped:
+					continue
+				for t in xrange(self.offsets[state], self.offsets[state + 1]):
+					label = self.labels[t]
+					if label is None:
+						continue
+					if transitions.has_key(label):
+						return None
+					transitions[label] = self.targets[t]
+			targets = dict()
+			for label, target in transitions.iteritems():
+				closure = tuple(self.closures([target], cache)[0])
+				if not setIndex.has_key(closure):
+					setIndex[closure] = len(sets)
+					sets.append(closure)
+				targets[label] = setIndex[closure]
+			return targets
+
+		def exits(states):
+			"""The final states in between and the states around the entry
+			that states reach, in closure order."""
+			returns = set()
+			for state in states:
+				if state not in excluded:
+					for t in xrange(self.offsets[state], self.offsets[state + 1]):
+						if self.labels[t] is None and self.targets[t] in excluded:
+							returns.add(self.targets[t])
+			return [(k, state) for k, state in enumerate(states) if state in returns or (self.final[state] and state not in excluded)]
+
+		entries = row(around, ())
+		if entries is None:
+			return self
+		i = 1
+		while i < len(sets):
+			transitions = row(sets[i], excluded)
+			if transitions is None:
+				return self
+			DFA.addState(False, [(label, target, 0) for label, target in transitions.iteritems()] + [(label, 0, 0) for label in exits(sets[i])])
+			i += 1
+		states = DFA.reachables([0] + entries.values())
+		block, blocks = DFA.partition(states)
+		DFA.entry = 0
+		DFA = DFA.quotient(states, block, blocks)
+
+		result = CompactFsm()
+		index = dict((state, k) for k, state in enumerate(around))
+		order = list(around)
+		def number(node):
+			if not index.has_key(node):
+				index[node] = len(order)
+				order.append(node)
+			return index[node]
+		for node in order:
+			if not isinstance(node, tuple):
+				result.addState(self.final[node],
+				                [(label, number(target) if label is None else number(("between", block[entries[label]])), 0)
+				                 for label, target in zip(self.labels[self.offsets[node]:self.offsets[node + 1]],
+				                                          self.targets[self.offsets[node]:self.offsets[node + 1]])])
+			elif node[0] == "between":
+				result.addState(False,
+				                [(None, number(label[1] if label[1] in excluded else ("final", label[1])), 0) if isinstance(label, tuple) else
+				                 (label, number(("between", target)), 0)
+				                 for label, target in zip(DFA.labels[DFA.offsets[node[1]]:DFA.offsets[node[1] + 1]],
+				                                          DFA.targets[DFA.offsets[node[1]]:DFA.offsets[node[1] + 1]])])
+			else:
+				result.addState(True, [])
+		if verbose: print "NFA reduced from %d to %d states" % (len(reachables), len(result.final))
+		return result if len(result.final) < len(reachables) else self
+
+	def quotient(self, states, block, blocks):
+		"""Builds the automaton that has one state per block, where block[s]
+		is the block of state s and states lists the states to consider."""
+		representatives = [None] * blocks
+		for state in states:
+			if representatives[block[state]] is None:
+				representatives[block[state]] = state
+		result = CompactFsm()
+		for state in representatives:
+			result.addState(self.final[state],
+			                [(self.labels[t], block[self.targets[t]], self.actions[t]) for t in xrange(self.offsets[state], self.offsets[state + 1])],
+			                self.leave[state])
+		result.entry = block[self.entry]
+		return result
+
 	def minimize(self, verbose = True):
-		marked = []
-		unmarked = []
+		"""Moore's partition refinement: states stay together as long as they
+		agree on acceptance and on (label, actions, target block) of every
+		transition."""
 		states = self.reachables()
 		if verbose: print "Minimizing DFA of size %d" % len(states)
-		F = [states.index(x) for x in self.accepts]
-		for p in range(0, len(states) - 1):
-			for q in range(p + 1, len(states)):
-				if (p in F) != (q in F):
-					marked.append([p, q])
-				else:
-					unmarked.append([p, q])
-		oldlength = -1
-
-		list2dict = lambda src: dict((t.label, [s.target for s in src if s.label == t.label]) for t in src)
-
-		while len(unmarked) != oldlength:
-			oldlength = len(unmarked)
-			for pq in unmarked:
-				p = states[pq[0]]
-				q = states[pq[1]]
-				mark = False
-#				if len(p.transitions) != len(q.transitions):
-#					mark = True
-#				else:
-				if True:
-					if len(p.transitions) < len(q.transitions): p, q = q, p
-					ptrans = list2dict(p.transitions)
-					qtrans = list2dict(q.transitions)
-
-					for label, targets in ptrans.iteritems():
-						ptarget = states.index(reduce(lambda x, y: y if x is None else x, targets))
-						if qtrans.has_key(label):
-							qtarget = states.index(reduce(lambda x, y: y if x is None else x, qtrans[label]))
-							pacts = list(chain.from_iterable(t.actions for t in p.transitions if t.label == label and t.target == states[ptarget]))
-							qacts = list(chain.from_iterable(t.actions for t in q.transitions if t.label == label and t.target == states[qtarget]))
-#						print "for label %s and states (%d, %d): %s %s= %s" % (label, ptarget, qtarget, pacts, "!" if pacts != qacts else "=", qacts)
-							if ([ptarget, qtarget] in marked) or ([qtarget, ptarget] in marked) or (pacts != qacts):
-								mark = True
-								break
-						else:
-							mark = True
-							break
-				if mark:
-					marked.append(pq)
-					unmarked.remove(pq)
-		if verbose: print "Remaining unmarked: %s" % unmarked
-		merge = []
-
-		for pq in unmarked:
-			inserted = False
-			for l in merge:
-				if (pq[0] in l) or (pq[1] in l):
-					if pq[0] not in l: l.append(pq[0])
-					if pq[1] not in l: l.append(pq[1])
-					inserted = True
-					break
-			if not inserted:
-				merge.append(pq)
-
-#		print "Merge: %s" % merge
-		state2set = dict()
-		set_num = 0
-		for pq in unmarked:
-			pe = state2set.has_key(pq[0])
-			qe = state2set.has_key(pq[1])
-			if pe and not qe:
-				state2set[pq[1]] = state2set[pq[0]]
-			elif not pe and qe:
-				state2set[pq[0]] = state2set[pq[1]]
-			elif not pe and not qe:
-				state2set[pq[0]] = set_num
-				state2set[pq[1]] = set_num
-				set_num += 1
-
-		for i in range(0, len(states)):
-			if not state2set.has_key(i):
-				state2set[i] = set_num
-				set_num += 1
-
-		sets = []
-		set2states = dict()
-		for i in range(0, set_num):
-			set2states[i] = [k for k, v in state2set.items() if v == i]
-			sets.append(State())
-
-		for set, state_list in set2states.iteritems():
-			for state in state_list:
-				for label, targets in list2dict(states[state].transitions).iteritems():
-					if len([t for t in sets[set].transitions if t.label == label]) == 0:
-						target = states.index(reduce(lambda x, y: y if x is None else x, targets))
-						pacts = list(chain.from_iterable(t.actions for t in states[state].transitions if t.label == label and t.target == states[target]))
-#						print "Adding transition to DFA for label %s -> %d / %s" % (label, states[target].id, pacts)
-						sets[set].addTransition(label, sets[state2set[target]], pacts)
+		block = dict((state, (self.final[state], self.leave[state])) for state in states)
+		blocks = -1
+		while True:
+			signatures = dict()
+			refined = dict()
+			for state in states:
+				signature = (block[state], tuple([(self.labels[t], self.actions[t], block[self.targets[t]]) for t in xrange(self.offsets[state], self.offsets[state + 1])]))
+				if not signatures.has_key(signature):
+					signatures[signature] = len(signatures)
+				refined[state] = signatures[signature]
+			block = refined
+			if len(signatures) == blocks:
 				break
-		optDFA = XMLFsm()
-		optDFA.entry = sets[state2set[states.index(self.entry)]]
-		for state in [sets[state2set[states.index(i)]] for i in self.accepts]:
-			optDFA.accepts.add(state)
-		if verbose: print "DFA reduced from %d to %d states (%.1f)" % (len(states), len(sets), 100.0 * len(sets) / len(states))
+			blocks = len(signatures)
+		optDFA = self.quotient(states, block, blocks)
+		if verbose: print "DFA reduced from %d to %d states (%.1f)" % (len(states), blocks, 100.0 * blocks / len(states))
 		return optDFA
 
-	def split(self, Bs, B, a):
-		A = ([], [])
-		for b in Bs:
-			for t in b.transitions:
-				if b.label == a:
-					A[int(bool(b in B))].append(b)
-					break
-		return A
-
-	def hopcroft(self):
-		Q = self.reachables()
-		dinv = [dict() for i in range(0, len(Q))]
-		for i in range(0, len(Q)):
-			for trans in Q[i].transitions:
-				target = Q.index(trans.target)
-				if trans.label not in dinv[target]:
-					dinv[target][trans.label] = set()
-				dinv[target][trans.label].add(i)
-		print dinv
-		F = self.accepts
-		P = [ F, set(Q) - F ]
-		W = deque(P[1])
+	def hopcroft(self, verbose = True):
+		states = self.reachables()
+		if verbose: print "Minimizing DFA of size %d" % len(states)
+		block, blocks = self.partition(states)
+		optDFA = self.quotient(states, block, blocks)
+		if verbose: print "DFA reduced from %d to %d states (%.1f)" % (len(states), blocks, 100.0 * blocks / len(states))
+		return optDFA
+
+	def partition(self, states):
+		"""Hopcroft's partition refinement of the deterministic states into
+		blocks of equivalent states.  Returns the block of every state and
+		the number of blocks."""
+		# the alphabet consists of (label, actions) pairs, so two states only stay
+		# equivalent if they execute the same actions on the same labels
+		dinv = dict((state, dict()) for state in states)
+		signatures = dict()
+		for state in states:
+			symbols = list()
+			for t in xrange(self.offsets[state], self.offsets[state + 1]):
+				symbol = (self.labels[t], self.actions[t])
+				symbols.append(symbol)
+				if not dinv[self.targets[t]].has_key(symbol):
+					dinv[self.targets[t]][symbol] = list()
+				dinv[self.targets[t]][symbol].append(state)
+
+			# initial partition: acceptance and the set of defined symbols, which
+			# takes care of the missing (dead state) transitions of a partial DFA
+			signature = (self.final[state], self.leave[state], frozenset(symbols))
+			if not signatures.has_key(signature):
+				signatures[signature] = list()
+			signatures[signature].append(state)
+		P = [set(members) for members in signatures.itervalues()]
+		block = dict()
+		for b in range(0, len(P)):
+			for state in P[b]:
+				block[state] = b
+
+		W = deque(range(0, len(P)))
 		while len(W) > 0:
-			A = W.popleft()
-#		sigma = set([trans.label for trans in [transitions for transitions in [state.transitions for state in A]]])
-			sigma = set()
-			for transitions in [state.transitions for state in A]:
-				for trans in transitions:
-					sigma = sigma.add(trans.label)
-			print "Sigma: %s" % sigma
-			for c in sigma:
-				X = set()
-				for state in A:
-					X.union(dinv[Q.index(state)][c])
-				print "X for label %s: %s" % (c, X)
-		return Q
-			
+			A = list(P[W.popleft()])
+			X = dict()
+			for q in A:
+				for symbol, sources in dinv[q].iteritems():
+					if not X.has_key(symbol):
+						X[symbol] = list()
+					X[symbol].extend(sources)
+			for symbol, sources in X.iteritems():
+				hits = dict()
+				for p in sources:
+					if not hits.has_key(block[p]):
+						hits[block[p]] = set()
+					hits[block[p]].add(p)
+				for b, Y1 in hits.iteritems():
+					if len(Y1) == len(P[b]):
+						continue
+					# keep the larger half in place, the smaller one is a new
+					# block and always has to be processed as a splitter.  Both
+					# ways only take time in the size of Y1, not of P[b]
+					if 2 * len(Y1) <= len(P[b]):
+						P[b].difference_update(Y1)
+					else:
+						Y1, P[b] = P[b] - Y1, Y1
+					P.append(Y1)
+					for state in Y1:
+						block[state] = len(P) - 1
+					W.append(len(P) - 1)
+		return block, len(P)
+
+	@staticmethod
+	def combine(fsms, verbose = True):
+		"""Returns the DFAs fsms as one automaton and the entry state of each
+		in it.  Equivalent states are merged across the machines as well,
+		so content reached from several of them is stored once and machines
+		equal to another one share its entry state."""
+		union = CompactFsm()
+		entries = []
+		for fsm in fsms:
+			fsm = fsm.compact()
+			base = len(union.final)
+			entries.append(base + fsm.entry)
+			for s in xrange(0, len(fsm.final)):
+				union.addState(fsm.final[s],
+				               [(fsm.labels[t], base + fsm.targets[t], fsm.actions[t]) for t in xrange(fsm.offsets[s], fsm.offsets[s + 1])],
+				               fsm.leave[s])
+		union.entry = entries[0]
+		states = union.reachables(entries)
+		block, blocks = union.partition(states)
+		combined = union.quotient(states, block, blocks)
+		if verbose: print "Combined %d DFAs of %d states into %d states (%.1f)" % (len(fsms), len(states), blocks, 100.0 * blocks / max(len(states), 1))
+		return combined, [block[entry] for entry in entries]
+
+class LazyFsm(object):
+	"""Runs an automaton as the DFA determinize would build from it, but
+	builds the DFA states on demand.  A DFA state is the tuple of automaton
+	states in its epsilon closure along with the tuple of actions pending on
+	each.  The transitions of at most size DFA states are kept, the least
+	recently used are evicted."""
+	__slots__ = ("nfa", "size", "cache", "hits", "misses", "evictions")
+
+	def __init__(self, nfa, size=1024):
+		self.nfa = nfa.compact()
+		self.size = size
+		self.cache = OrderedDict()
+		self.hits = self.misses = self.evictions = 0
+
+	def closure(self, states):
+		states, actions = self.nfa.closure(states)
+		return tuple(states), tuple(map(tuple, actions))
+
+	def start(self):
+		return self.closure([self.nfa.entry])
+
+	def isFinal(self, state):
+		return any([self.nfa.final[s] for s in state[0]])
+
+	def row(self, state):
+		"""Returns the transitions of state as a dictionary of label to
+		(target, actions id), computed as in determinize."""
+		try:
+			row = self.cache.pop(state)
+			self.hits += 1
+		except KeyError:
+			self.misses += 1
+			nfa = self.nfa
+			targets = dict()
+			tactions = dict()
+			seen = set()
+			for k, s in enumerate(state[0]):
+				for t in xrange(nfa.offsets[s], nfa.offsets[s + 1]):
+					label = nfa.labels[t]
+					if label is None:
+						continue
+					if not targets.has_key(label):
+						targets[label] = list()
+						tactions[label] = list(state[1][k])
+					if (label, nfa.targets[t]) not in seen:
+						seen.add((label, nfa.targets[t]))
+						targets[label].append(nfa.targets[t])
+					tactions[label].extend(actionTable[nfa.actions[t]])
+			row = dict((label, (self.closure(targets[label]), actionTable.intern(tactions[label]))) for label in targets)
+			if len(self.cache) >= self.size:
+				self.cache.popitem(last=False)
+				self.evictions += 1
+		self.cache[state] = row
+		return row
+
+	def step(self, state, label):
+		"""Returns the target and the actions id of the transition of state on
+		label, None if there is none."""
+		return self.row(state).get(label)
+
+def particle(term, minOccurs, maxOccurs, counter=None):
+	"""Repeats term between minOccurs and maxOccurs ("unbounded") times.  The
+	copies are instantiated from a compact snapshot of term.  If counter is
+	given as a tuple of (enter, iterate, leave) action lists, term is put into
+	a single loop instead and these actions have to enforce the bounds."""
+	if minOccurs == 1 and maxOccurs == 1:
+		return XMLFsm().empty().concat(term)
+	template = term.compact()
+	if counter is not None:
+		copyCounter.add(1, len(template.final), len(template.labels))
+		enter, iterate, leave = counter
+		body = template.toFsm()
+		head = State()
+		final = State()
+		a = XMLFsm()
+		a.entry = State()
+		a.entry.addTransition(None, head, enter)
+		head.addTransition(None, body.entry, iterate)
+		head.addTransition(None, final, leave)
+		for state in body.accepts:
+			state.addTransition(None, head, state.onleave)
+		a.accepts = set([final])
+		return a
+	copyCounter.add(minOccurs + (1 if maxOccurs == "unbounded" else maxOccurs - minOccurs), len(template.final), len(template.labels))
+	if maxOccurs == "unbounded":
+		a = template.toFsm().kleene()
+	else:
+		a = XMLFsm().empty()
+		leave = a.entry
+		for i in range(0, maxOccurs - minOccurs):
+			c = template.toFsm()
+			c.concat(a)
+			c.entry.addTransition(None, leave)
+			a = c
+	if minOccurs > 0:
+		b = XMLFsm().empty()
+		for i in range(0, minOccurs):
+			b.concat(template.toFsm())
+		if maxOccurs == "unbounded" or maxOccurs - minOccurs > 0:
+			b.concat(a)
+		return b
+	return a
+
 if __name__ == "__main__":
 	fsm = XMLFsm().element("A",
             XMLFsm().choice([
@@ -378,5 +1319,5 @@ if __name__ == "__main__":
 	fsm.dump()
 	dfa = fsm.determinize()
 	dfa.dump()
-	dfa = dfa.minimize()
+	dfa = dfa.hopcroft()
 	dfa.dump()
@@ -0,0 +1,561 @@
+/* Python binding of the interpreter.  The actions fired while validating are
+ * collected as (action id, event index) pairs of 32 bit integers into an
+ * Actions object which exposes them through the buffer protocol.
+ */
+#include <Python.h>
+#include <pthread.h>
+#include "xmlparser.h"
+
+#if PY_MAJOR_VERSION >= 3
+#define FX_PY_BUFFER_FLAGS Py_TPFLAGS_DEFAULT
+#else
+#define FX_PY_BUFFER_FLAGS (Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER)
+#endif
+
+/* the pairs collected by fx_collect, nomem is set if growing failed */
+struct fx_collected {
+	uint32_t *pairs;
+	Py_ssize_t len;
+	Py_ssize_t alloc;
+	int nomem;
+};
+
+static void fx_collect(void *data, uint32_t event, int len, const uint16_t *actions)
+{
+	struct fx_collected *c = data;
+	uint32_t *pairs;
+	int i;
+
+	if (c->len + len > c->alloc) {
+		Py_ssize_t alloc = c->alloc ? 2 * c->alloc : 256;
+		while (alloc < c->len + len)
+			alloc *= 2;
+		if ((pairs = realloc(c->pairs, alloc * 2 * sizeof(uint32_t))) == NULL) {
+			c->nomem = 1;
+			return;
+		}
+		c->pairs = pairs;
+		c->alloc = alloc;
+	}
+	for (i = 0; i < len; i++) {
+		c->pairs[2 * c->len] = actions[i];
+		c->pairs[2 * c->len + 1] = event;
+		c->len++;
+	}
+}
+
+static void fx_do_nothing(int len, const uint16_t *actions)
+{
+}
+
+/* documents are parsed without the GIL and look up registered machines, so
+ * they hold the registry for reading while register() and unregister() hold
+ * it for writing
+ */
+static pthread_rwlock_t fx_registry_lock = PTHREAD_RWLOCK_INITIALIZER;
+
+/* the Parsers not closed yet.  Their stacks may hold any registered machine
+ * across calls, so machines are not unregistered while there are some.
+ */
+static int fx_open_parsers;
+
+static int fx_register_locked(const fx_schema *schema)
+{
+	int result;
+
+	Py_BEGIN_ALLOW_THREADS
+	pthread_rwlock_wrlock(&fx_registry_lock);
+	result = fx_register(schema);
+	pthread_rwlock_unlock(&fx_registry_lock);
+	Py_END_ALLOW_THREADS
+	return result;
+}
+
+static void fx_unregister_locked(const fx_schema *schema)
+{
+	Py_BEGIN_ALLOW_THREADS
+	pthread_rwlock_wrlock(&fx_registry_lock);
+	fx_unregister(schema);
+	pthread_rwlock_unlock(&fx_registry_lock);
+	Py_END_ALLOW_THREADS
+}
+
+/* Actions: a read-only sequence of (action, event) pairs */
+
+typedef struct {
+	PyObject_HEAD
+	uint32_t *pairs;
+	Py_ssize_t len;
+	Py_ssize_t shape[2];
+	Py_ssize_t strides[2];
+} ActionsObject;
+
+static PyTypeObject ActionsType;
+
+/* takes over the pairs of c, leaving it empty */
+static PyObject *fx_actions_new(struct fx_collected *c)
+{
+	ActionsObject *self;
+
+	if (c->nomem)
+		return PyErr_NoMemory();
+	if ((self = PyObject_New(ActionsObject, &ActionsType)) == NULL)
+		return NULL;
+	self->pairs = c->pairs;
+	self->len = c->len;
+	self->shape[0] = c->len;
+	self->shape[1] = 2;
+	self->strides[0] = 2 * sizeof(uint32_t);
+	self->strides[1] = sizeof(uint32_t);
+	c->pairs = NULL;
+	c->len = c->alloc = 0;
+	return (PyObject *)self;
+}
+
+static void Actions_dealloc(ActionsObject *self)
+{
+	free(self->pairs);
+	PyObject_Del(self);
+}
+
+static Py_ssize_t Actions_length(ActionsObject *self)
+{
+	return self->len;
+}
+
+static PyObject *Actions_item(ActionsObject *self, Py_ssize_t i)
+{
+	if (i < 0 || i >= self->len) {
+		PyErr_SetString(PyExc_IndexError, "index out of range");
+		return NULL;
+	}
+	return Py_BuildValue("(II)", self->pairs[2 * i], self->pairs[2 * i + 1]);
+}
+
+static int Actions_getbuffer(ActionsObject *self, Py_buffer *view, int flags)
+{
+	static uint32_t empty[2];
+
+	if (flags & PyBUF_WRITABLE) {
+		PyErr_SetString(PyExc_BufferError, "Actions are read-only");
+		return -1;
+	}
+	view->buf = self->pairs != NULL ? self->pairs : empty;
+	view->obj = (PyObject *)self;
+	Py_INCREF(self);
+	view->len = self->len * 2 * sizeof(uint32_t);
+	view->readonly = 1;
+	view->itemsize = sizeof(uint32_t);
+	view->format = (flags & PyBUF_FORMAT) ? "I" : NULL;
+	view->ndim = 2;
+	view->shape = (flags & PyBUF_ND) ? self->shape : NULL;
+	view->strides = (flags & PyBUF_STRIDES) == PyBUF_STRIDES ? self->strides : NULL;
+	view->suboffsets = NULL;
+	view->internal = NULL;
+	return 0;
+}
+
+static PySequenceMethods Actions_as_sequence = {
+	(lenfunc)Actions_length,
+	0, 0,
+	(ssizeargfunc)Actions_item,
+};
+
+static PyBufferProcs Actions_as_buffer = {
+#if PY_MAJOR_VERSION < 3
+	0, 0, 0, 0,
+#endif
+	(getbufferproc)Actions_getbuffer,
+	0,
+};
+
+static PyTypeObject ActionsType = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"fxparser.Actions",
+	sizeof(ActionsObject),
+	0,
+	(destructor)Actions_dealloc,
+	0, 0, 0, 0, 0, 0,
+	&Actions_as_sequence,
+	0, 0, 0, 0, 0, 0,
+	&Actions_as_buffer,
+	FX_PY_BUFFER_FLAGS,
+	"(action, event) pairs of unsigned 32 bit integers, also available as a\n"
+	"two-dimensional buffer of format 'I'.",
+};
+
+/* Schema: tables loaded from a file written by xsdcc.py --tables-dir */
+
+typedef struct {
+	PyObject_HEAD
+	fx_schema *schema;
+	int registered;
+	PyObject *owner;	/* the Schema loading the tables of a root, NULL if self */
+} SchemaObject;
+
+static PyTypeObject SchemaType;
+
+static int Schema_init(SchemaObject *self, PyObject *args, PyObject *kwds)
+{
+	static char *kwlist[] = {"path", NULL};
+	const char *path;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "s", kwlist, &path))
+		return -1;
+	if (self->schema != NULL) {
+		PyErr_SetString(PyExc_RuntimeError, "Schema is already loaded");
+		return -1;
+	}
+	if ((self->schema = fx_load_schema(path, fx_do_nothing)) == NULL) {
+		PyErr_Format(PyExc_IOError, "Unable to load tables %s", path);
+		return -1;
+	}
+	return 0;
+}
+
+/* a registered Schema is referenced by the registry, so it is not deallocated */
+static void Schema_dealloc(SchemaObject *self)
+{
+	if (self->schema != NULL && self->owner == NULL)
+		fx_free_schema(self->schema);
+	Py_XDECREF(self->owner);
+	Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static int fx_check_schema(SchemaObject *self)
+{
+	if (self->schema == NULL) {
+		PyErr_SetString(PyExc_RuntimeError, "Schema is not loaded");
+		return -1;
+	}
+	return 0;
+}
+
+static PyObject *Schema_register(SchemaObject *self)
+{
+	if (fx_check_schema(self) < 0)
+		return NULL;
+	if (self->schema->localname == NULL) {
+		PyErr_SetString(PyExc_ValueError, "tables carry no element name to register");
+		return NULL;
+	}
+	if (!self->registered) {
+		if (fx_register_locked(self->schema) < 0) {
+			PyErr_SetString(PyExc_ValueError, "an element of this name is already registered");
+			return NULL;
+		}
+		Py_INCREF(self);
+		self->registered = 1;
+	}
+	Py_RETURN_NONE;
+}
+
+static PyObject *Schema_unregister(SchemaObject *self)
+{
+	if (self->registered) {
+		if (fx_open_parsers > 0) {
+			PyErr_SetString(PyExc_RuntimeError, "machines cannot be unregistered while a Parser is open");
+			return NULL;
+		}
+		fx_unregister_locked(self->schema);
+		self->registered = 0;
+		Py_DECREF(self);
+	}
+	Py_RETURN_NONE;
+}
+
+static PyObject *Schema_roots(SchemaObject *self)
+{
+	PyObject *roots;
+	SchemaObject *root;
+	int i;
+
+	if (fx_check_schema(self) < 0)
+		return NULL;
+	if (self->owner != NULL) {
+		PyErr_SetString(PyExc_ValueError, "roots() needs the Schema the tables were loaded by");
+		return NULL;
+	}
+	if ((roots = PyList_New(fx_schema_roots(self->schema))) == NULL)
+		return NULL;
+	for (i = 0; i < fx_schema_roots(self->schema); i++) {
+		if (i == 0) {
+			Py_INCREF(self);
+			PyList_SET_ITEM(roots, i, (PyObject *)self);
+			continue;
+		}
+		if ((root = (SchemaObject *)PyType_GenericNew(&SchemaType, NULL, NULL)) == NULL) {
+			Py_DECREF(roots);
+			return NULL;
+		}
+		root->schema = fx_schema_root(self->schema, i);
+		Py_INCREF(self);
+		root->owner = (PyObject *)self;
+		PyList_SET_ITEM(roots, i, (PyObject *)root);
+	}
+	return roots;
+}
+
+static PyMethodDef Schema_methods[] = {
+	{"register", (PyCFunction)Schema_register, METH_NOARGS,
+	 "register()\n\nMakes the machine invocable from '!' keys of other machines.  The Schema\n"
+	 "is kept alive until unregister()."},
+	{"unregister", (PyCFunction)Schema_unregister, METH_NOARGS,
+	 "unregister()\n\nUndoes register(), raises RuntimeError while a Parser is open."},
+	{"roots", (PyCFunction)Schema_roots, METH_NOARGS,
+	 "roots() -> list\n\nThe machine of every element of tables written by xsdcc.py --combine, in\n"
+	 "the order of the --element options, starting with this one.  They share\n"
+	 "the loaded tables."},
+	{NULL}
+};
+
+static PyTypeObject SchemaType = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"fxparser.Schema",
+	sizeof(SchemaObject),
+	0,
+	(destructor)Schema_dealloc,
+	0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+	Py_TPFLAGS_DEFAULT,
+	"Schema(path)\n\nThe tables of one element, as written by xsdcc.py --tables-dir, or of the\n"
+	"first of the elements combined with --combine, see roots().",
+	0, 0, 0, 0, 0, 0,
+	Schema_methods,
+	0, 0, 0, 0, 0, 0, 0,
+	(initproc)Schema_init,
+	0,
+	PyType_GenericNew,
+};
+
+/* validate() and validate_file() */
+
+static PyObject *fx_validate(SchemaObject *schema, xmlTextReaderPtr rd)
+{
+	struct fx_collected c = {NULL, 0, 0, 0};
+	PyObject *actions;
+	int result;
+
+	if (rd == NULL)
+		return PyErr_NoMemory();
+	Py_BEGIN_ALLOW_THREADS
+	pthread_rwlock_rdlock(&fx_registry_lock);
+	result = fx_parse_xml_actions(rd, schema->schema, fx_collect, &c);
+	pthread_rwlock_unlock(&fx_registry_lock);
+	xmlFreeTextReader(rd);
+	Py_END_ALLOW_THREADS
+	if (result < 0) {
+		free(c.pairs);
+		return PyErr_NoMemory();
+	}
+	if ((actions = fx_actions_new(&c)) == NULL) {
+		free(c.pairs);
+		return NULL;
+	}
+	return Py_BuildValue("(NN)", PyBool_FromLong(result == 0), actions);
+}
+
+static PyObject *validate(PyObject *module, PyObject *args)
+{
+	SchemaObject *schema;
+	Py_buffer data;
+	xmlTextReaderPtr rd;
+	PyObject *result;
+
+	if (!PyArg_ParseTuple(args, "O!s*", &SchemaType, &schema, &data))
+		return NULL;
+	if (fx_check_schema(schema) < 0 || data.len > INT_MAX) {
+		if (!PyErr_Occurred())
+			PyErr_SetString(PyExc_OverflowError, "document too large");
+		PyBuffer_Release(&data);
+		return NULL;
+	}
+	rd = xmlReaderForMemory(data.buf, data.len, NULL, NULL, 0);
+	result = fx_validate(schema, rd);
+	PyBuffer_Release(&data);
+	return result;
+}
+
+static PyObject *validate_file(PyObject *module, PyObject *args)
+{
+	SchemaObject *schema;
+	const char *path;
+	xmlTextReaderPtr rd;
+
+	if (!PyArg_ParseTuple(args, "O!s", &SchemaType, &schema, &path))
+		return NULL;
+	if (fx_check_schema(schema) < 0)
+		return NULL;
+	if ((rd = xmlReaderForFile(path, NULL, 0)) == NULL) {
+		PyErr_Format(PyExc_IOError, "Unable to open %s", path);
+		return NULL;
+	}
+	return fx_validate(schema, rd);
+}
+
+/* Parser: incremental validation of a document fed in chunks */
+
+typedef struct {
+	PyObject_HEAD
+	SchemaObject *schema;
+	fx_push *push;
+	struct fx_collected collected;
+	int result;		/* -1 while open */
+} ParserObject;
+
+static int Parser_init(ParserObject *self, PyObject *args, PyObject *kwds)
+{
+	static char *kwlist[] = {"schema", NULL};
+	SchemaObject *schema;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!", kwlist, &SchemaType, &schema))
+		return -1;
+	if (self->push != NULL) {
+		PyErr_SetString(PyExc_RuntimeError, "Parser is already initialized");
+		return -1;
+	}
+	if (fx_check_schema(schema) < 0)
+		return -1;
+	if ((self->push = fx_push_new(schema->schema)) == NULL) {
+		PyErr_NoMemory();
+		return -1;
+	}
+	fx_push_actions(self->push, fx_collect, &self->collected);
+	Py_INCREF(schema);
+	self->schema = schema;
+	self->result = -1;
+	fx_open_parsers++;
+	return 0;
+}
+
+static void Parser_dealloc(ParserObject *self)
+{
+	if (self->push != NULL) {
+		if (self->result < 0)
+			fx_open_parsers--;
+		fx_push_free(self->push);
+	}
+	free(self->collected.pairs);
+	Py_XDECREF(self->schema);
+	Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *fx_parser_chunk(ParserObject *self, const char *chunk, Py_ssize_t size, int terminate)
+{
+	int result;
+
+	if (self->push == NULL) {
+		PyErr_SetString(PyExc_RuntimeError, "Parser is not initialized");
+		return NULL;
+	}
+	if (self->result >= 0) {
+		PyErr_SetString(PyExc_ValueError, "Parser is closed");
+		return NULL;
+	}
+	if (size > INT_MAX) {
+		PyErr_SetString(PyExc_OverflowError, "chunk too large");
+		return NULL;
+	}
+	Py_BEGIN_ALLOW_THREADS
+	pthread_rwlock_rdlock(&fx_registry_lock);
+	result = fx_push_chunk(self->push, chunk, size, terminate);
+	pthread_rwlock_unlock(&fx_registry_lock);
+	Py_END_ALLOW_THREADS
+	if (terminate) {
+		self->result = result;
+		fx_open_parsers--;
+	}
+	if (self->collected.nomem)
+		return PyErr_NoMemory();
+	return PyBool_FromLong(result == 0);
+}
+
+static PyObject *Parser_feed(ParserObject *self, PyObject *args)
+{
+	Py_buffer data;
+	PyObject *result;
+
+	if (!PyArg_ParseTuple(args, "s*", &data))
+		return NULL;
+	result = fx_parser_chunk(self, data.buf, data.len, 0);
+	PyBuffer_Release(&data);
+	return result;
+}
+
+static PyObject *Parser_close(ParserObject *self)
+{
+	return fx_parser_chunk(self, NULL, 0, 1);
+}
+
+static PyObject *Parser_take(ParserObject *self)
+{
+	return fx_actions_new(&self->collected);
+}
+
+static PyMethodDef Parser_methods[] = {
+	{"feed", (PyCFunction)Parser_feed, METH_VARARGS,
+	 "feed(data) -> bool\n\nParses the next chunk, returns False once the document is invalid."},
+	{"close", (PyCFunction)Parser_close, METH_NOARGS,
+	 "close() -> bool\n\nEnds the document, returns whether it is valid."},
+	{"take", (PyCFunction)Parser_take, METH_NOARGS,
+	 "take() -> Actions\n\nReturns the actions fired since the last call."},
+	{NULL}
+};
+
+static PyTypeObject ParserType = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"fxparser.Parser",
+	sizeof(ParserObject),
+	0,
+	(destructor)Parser_dealloc,
+	0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+	Py_TPFLAGS_DEFAULT,
+	"Parser(schema)\n\nValidates a document fed in chunks of bytes.",
+	0, 0, 0, 0, 0, 0,
+	Parser_methods,
+	0, 0, 0, 0, 0, 0, 0,
+	(initproc)Parser_init,
+	0,
+	PyType_GenericNew,
+};
+
+static PyMethodDef fxparser_methods[] = {
+	{"validate", validate, METH_VARARGS,
+	 "validate(schema, data) -> (bool, Actions)\n\nValidates the document in a bytes or buffer object."},
+	{"validate_file", validate_file, METH_VARARGS,
+	 "validate_file(schema, path) -> (bool, Actions)\n\nValidates the document in the file at path."},
+	{NULL}
+};
+
+static PyObject *fx_init_module(PyObject *module)
+{
+	if (module == NULL)
+		return NULL;
+	Py_INCREF(&SchemaType);
+	Py_INCREF(&ParserType);
+	Py_INCREF(&ActionsType);
+	PyModule_AddObject(module, "Schema", (PyObject *)&SchemaType);
+	PyModule_AddObject(module, "Parser", (PyObject *)&ParserType);
+	PyModule_AddObject(module, "Actions", (PyObject *)&ActionsType);
+	xmlInitParser();
+	return module;
+}
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef fxparser_module = {
+	PyModuleDef_HEAD_INIT, "fxparser", "Validating XML documents with tables compiled by xsdcc.py.", -1, fxparser_methods
+};
+
+PyMODINIT_FUNC PyInit_fxparser(void)
+{
+	if (PyType_Ready(&ActionsType) < 0 || PyType_Ready(&SchemaType) < 0 || PyType_Ready(&ParserType) < 0)
+		return NULL;
+	return fx_init_module(PyModule_Create(&fxparser_module));
+}
+#else
+PyMODINIT_FUNC initfxparser(void)
+{
+	if (PyType_Ready(&ActionsType) < 0 || PyType_Ready(&SchemaType) < 0 || PyType_Ready(&ParserType) < 0)
+		return;
+	fx_init_module(Py_InitModule3("fxparser", fxparser_methods, "Validating XML documents with tables compiled by xsdcc.py."));
+}
+#endif
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Compiling generated schemas and running documents through the compiled
+machines for the tests."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from xsdcc import XSCompiler, XSRunner
+
+NAMESPACE = "urn:test"
+
+def schema(declarations, namespace=NAMESPACE):
+	"""Returns the text of a schema in namespace with the given top-level
+	declarations."""
+	return ('<?xml version="1.0"?>\n'
+	        '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="%s" xmlns="%s" elementFormDefault="qualified">\n'
+	        '%s\n</xs:schema>\n' % (namespace, namespace, declarations))
+
+def document(root, children):
+	"""Returns the text of a document with the root element root and the
+	empty child elements named by children."""
+	return '<%s xmlns="%s">%s</%s>\n' % (root, NAMESPACE, "".join(["<%s/>" % child for child in children]), root)
+
+class Workspace(object):
+	"""A temporary directory for schemas, documents and tables."""
+
+	def __init__(self):
+		self.path = tempfile.mkdtemp(prefix="xsdcc-test-")
+
+	def write(self, name, text):
+		path = os.path.join(self.path, name)
+		with open(path, "w") as f:
+			f.write(text)
+		return path
+
+	def close(self):
+		shutil.rmtree(self.path)
+
+def compileElements(paths, elements, **options):
+	"""Compiles the elements named elements in NAMESPACE of the schemas at
+	paths, options are attributes of the compiler like counterThreshold.
+	Returns the compiler and the machine of each element."""
+	cc = XSCompiler()
+	for name, value in options.items():
+		setattr(cc, name, value)
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, "w")
+	try:
+		for path in paths:
+			cc.loadSchema(path)
+		dfas = []
+		for element in elements:
+			obj = "{%s}%s" % (NAMESPACE, element)
+			dfas.append(cc.compileTarget("element", obj, set([obj]), set(), set(), set()))
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+	return cc, dfas
+
+def compileElement(paths, element, **options):
+	"""Compiles the element named element like compileElements, returns the
+	compiler and the machine."""
+	cc, dfas = compileElements(paths, [element], **options)
+	return cc, dfas[0]
+
+def run(cc, dfa, path):
+	"""Runs the document at path with XSRunner, returns whether it was
+	accepted and the names of the fired actions."""
+	runner = XSRunner(cc, dfa)
+	actions = list(runner.actions(path))
+	return runner.valid, actions
+
+def xml2Flags():
+	"""Returns the compiler and linker flags of libxml2, None if gcc or
+	xml2-config are missing."""
+	try:
+		flags = subprocess.check_output(["xml2-config", "--cflags", "--libs"]).split()
+		subprocess.check_output(["gcc", "--version"])
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	return flags
+
+def buildProgram(workspace, name, units):
+	"""Compiles the C units, a dictionary of file name to text, with the
+	interpreter into the program name in workspace and returns its path."""
+	paths = [workspace.write(unit, text) for unit, text in sorted(units.items())]
+	program = os.path.join(workspace.path, name)
+	subprocess.check_call(["gcc", "-DFX_LIBRARY", "-pthread", "-Wno-pointer-sign", "-I", ROOT, "-o", program] + paths +
+	                      [os.path.join(ROOT, "xmlparser.c")] + xml2Flags())
+	return program
+
+def buildInterpreter(workspace):
+	"""Compiles the interpreter with its driver, which runs a document through
+	the first of the tables files named after it, into workspace and returns
+	its path."""
+	program = os.path.join(workspace.path, "xmlparser")
+	subprocess.check_call(["gcc", "-pthread", "-Wno-pointer-sign", "-Wno-deprecated-declarations", "-o", program, os.path.join(ROOT, "xmlparser.c")] + xml2Flags())
+	return program
+
+def interpret(cc, program, path, tables, root=None, push=False):
+	"""Runs the document at path through the tables files with the
+	interpreter program, for combined tables the machine of the element
+	named root, and with the push parser if push is set.  Returns whether it
+	was accepted and the names of the executed actions."""
+	env = dict(os.environ)
+	if root is not None:
+		env["FX_ROOT"] = root
+	with open(path) as document:
+		process = subprocess.Popen([program, "-" if push else path] + tables, stdin=document if push else None,
+		                           stdout=subprocess.PIPE, env=env)
+		lines = process.communicate()[0].splitlines()
+	actions = [cc.actions[int(line.split()[1])] for line in lines if line.startswith("Action ")]
+	return not lines or lines[-1] != "Error parsing document", actions
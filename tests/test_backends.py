@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Every backend accepts the same documents and executes the same actions as
+XSRunner running the machine compiled with the default options: the tables
+run by the interpreter with the reader and the push parser, dense tables,
+NFAs determinized at runtime, machines combined from several elements,
+position automata and the C units of both source styles."""
+
+import itertools
+import os
+import subprocess
+import unittest
+
+from support import Workspace, schema, document, compileElements, run, xml2Flags, buildProgram, buildInterpreter, interpret
+from fsm import CompactFsm
+
+# a counted particle, a repeated choice invoking another element's content
+# and an optional element, with actions on all of them
+DECLARATIONS = """
+ <xs:element name="r">
+  <xs:complexType enter="onR()" leave="onR()"><xs:sequence>
+   <xs:element name="a" minOccurs="0" maxOccurs="4" enter="onA()"/>
+   <xs:choice minOccurs="0" maxOccurs="unbounded" leave="onChoice()">
+    <xs:element name="b" enter="onB()"/>
+    <xs:element ref="n"/>
+   </xs:choice>
+   <xs:element name="c" minOccurs="0" leave="onC()"/>
+  </xs:sequence></xs:complexType>
+ </xs:element>
+ <xs:element name="n" enter="onN()">
+  <xs:complexType><xs:sequence><xs:element name="a" minOccurs="0" enter="onNA()"/></xs:sequence></xs:complexType>
+ </xs:element>"""
+
+# a wildcard and an element it overlaps with in both orders, the first key
+# of a state matching an element wins
+OVERLAPPING = """
+ <xs:element name="w">
+  <xs:complexType><xs:choice maxOccurs="unbounded">
+   <xs:any enter="onAny()"/>
+   <xs:element name="a" enter="onA()"/>
+  </xs:choice></xs:complexType>
+ </xs:element>
+ <xs:element name="v">
+  <xs:complexType><xs:choice maxOccurs="unbounded">
+   <xs:element name="b" enter="onB()"/>
+   <xs:any enter="onAny()"/>
+  </xs:choice></xs:complexType>
+ </xs:element>"""
+
+# the options every machine is compiled with, the counted particle exceeds
+# the counter threshold
+OPTIONS = dict(counterThreshold=3)
+
+DRIVER = """
+#include <string.h>
+#include "xmlparser.h"
+
+extern const fx_schema table_schema;
+int goto_parse(xmlTextReaderPtr rd);
+
+int main(int argc, char **argv)
+{
+	xmlTextReaderPtr rd = xmlReaderForFile(argv[2], NULL, 0);
+	int result = strcmp(argv[1], "table") == 0 ? fx_parse_xml(rd, &table_schema) : goto_parse(rd);
+	printf("%s\\n", result == 0 ? "valid" : "invalid");
+	xmlFreeTextReader(rd);
+	return 0;
+}
+"""
+
+def withoutCounters(result):
+	"""Drops the counter operations from the actions of result, which the C
+	units do not report."""
+	valid, actions = result
+	return valid, [action for action in actions if not action.startswith("counter_")]
+
+@unittest.skipIf(xml2Flags() is None, "needs gcc and xml2-config")
+class BackendTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workspace = Workspace()
+		self.paths = [self.workspace.write("backends.xsd", schema(DECLARATIONS))]
+		self.documents = []
+		children = [[]] + [["a"] * 5]
+		for n in range(1, 4):
+			children.extend(itertools.product(["a", "b", "c", "n"], repeat=n))
+		for i, names in enumerate(children):
+			self.documents.append(self.workspace.write("doc%d.xml" % i, document("r", names)))
+		self.documents.append(self.workspace.write("nested.xml", '<r xmlns="urn:test"><n><a/></n><b/><n/></r>\n'))
+		cc, (dfa,) = compileElements(self.paths, ["r"], **OPTIONS)
+		self.expected = [withoutCounters(run(cc, dfa, doc)) for doc in self.documents]
+		self.assertTrue(any([valid for valid, actions in self.expected]))
+		self.interpreter = buildInterpreter(self.workspace)
+
+	def tearDown(self):
+		self.workspace.close()
+
+	def assertSameRuns(self, name, runDocument):
+		"""Compares the results of runDocument for each document with those
+		of the reference machine."""
+		for doc, expected in zip(self.documents, self.expected):
+			result = withoutCounters(runDocument(doc))
+			self.assertEqual(expected, result, "%s %s: %r, %r" % (name, open(doc).read(), expected, result))
+
+	def assertSameTables(self, name, dense=False, **options):
+		"""Compiles r with options and compares XSRunner and the interpreter
+		running its tables with the reference machine."""
+		options.update(OPTIONS)
+		cc, (dfa,) = compileElements(self.paths, ["r"], **options)
+		tables = os.path.join(self.workspace.path, "%s.fxt" % name)
+		cc.writeTables(dfa, tables, dense, "{urn:test}r")
+		self.assertSameRuns(name + " runner", lambda doc: run(cc, dfa, doc))
+		self.assertSameRuns(name, lambda doc: interpret(cc, self.interpreter, doc, [tables]))
+
+	def testTables(self):
+		self.assertSameTables("tables")
+		cc, (dfa,) = compileElements(self.paths, ["r"], **OPTIONS)
+		tables = os.path.join(self.workspace.path, "push.fxt")
+		cc.writeTables(dfa, tables)
+		self.assertSameRuns("push", lambda doc: interpret(cc, self.interpreter, doc, [tables], push=True))
+
+	def testDense(self):
+		self.assertSameTables("dense", True)
+
+	def testDenseKeyOrder(self):
+		path = self.workspace.write("overlapping.xsd", schema(OVERLAPPING))
+		for element, expected in [("w", ["onAny"] * 3), ("v", ["onAny", "onB", "onAny"])]:
+			# a compiler of its own, so that the keys are numbered in the order of the choice
+			cc, (dfa,) = compileElements([path], [element])
+			doc = self.workspace.write("%s.xml" % element, document(element, ["a", "b", "a"]))
+			self.assertEqual((True, expected), run(cc, dfa, doc))
+			for dense in (False, True):
+				tables = os.path.join(self.workspace.path, "%s%d.fxt" % (element, dense))
+				cc.writeTables(dfa, tables, dense, "{urn:test}%s" % element)
+				self.assertEqual((True, expected), interpret(cc, self.interpreter, doc, [tables]), "%s dense %s" % (element, dense))
+
+	def testLazy(self):
+		self.assertSameTables("lazy", lazy=64)
+		self.assertSameTables("lazy small cache", lazy=2)
+
+	def testGlushkov(self):
+		self.assertSameTables("glushkov", construction="glushkov")
+		self.assertSameTables("glushkov lazy", construction="glushkov", lazy=64)
+
+	def testCombined(self):
+		cc, dfas = compileElements(self.paths, ["r", "n"], **OPTIONS)
+		combined, entries = CompactFsm.combine(dfas, False)
+		roots = [(entry, "{urn:test}%s" % element, None) for entry, element in zip(entries, ["r", "n"])]
+		for dense in (False, True):
+			tables = os.path.join(self.workspace.path, "combined%d.fxt" % dense)
+			cc.writeTables(combined, tables, dense, roots=roots)
+			self.assertSameRuns("combined", lambda doc: interpret(cc, self.interpreter, doc, [tables], root="r"))
+
+	def testSources(self):
+		cc, (dfa,) = compileElements(self.paths, ["r"], **OPTIONS)
+		program = buildProgram(self.workspace, "sources", {"driver.c": DRIVER,
+		                       "table.c": cc.mkSource(dfa, "table", "table"),
+		                       "goto.c": cc.mkSource(dfa, "goto", "goto")})
+		for style in ("table", "goto"):
+			def runSource(doc):
+				lines = subprocess.check_output([program, style, doc]).splitlines()
+				return lines[-1] == "valid", lines[:-1]
+			self.assertSameRuns(style + " source", runSource)
+
+if __name__ == "__main__":
+	unittest.main()
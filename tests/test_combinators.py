@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""The XMLFsm combinators take time linear in the transitions they add, so
+wide choices scale linearly."""
+
+import time
+import unittest
+
+import support  # puts the sources on sys.path
+from fsm import XMLFsm
+
+def choiceTime(n):
+	"""Returns the shortest time of three choices of n symbols."""
+	times = []
+	for i in range(0, 3):
+		symbols = [XMLFsm().symbol(label) for label in xrange(1, n + 1)]
+		start = time.time()
+		XMLFsm().choice(symbols)
+		times.append(time.time() - start)
+	return min(times)
+
+class CombinatorTest(unittest.TestCase):
+
+	def testWideChoice(self):
+		small, large = 4000, 32000
+		smallTime, largeTime = choiceTime(small), choiceTime(large)
+		# eight times the branches, quadratic merging would take 64 times as long
+		self.assertTrue(largeTime < 24 * max(smallTime, 0.001), "%d branches: %.3fs, %d branches: %.3fs" % (small, smallTime, large, largeTime))
+
+	def testMergedTransitions(self):
+		# a transition added again with the same label and target is merged
+		a, b = XMLFsm().symbol(1, [1]), XMLFsm().symbol(1)
+		a.entry.addTransition(1, list(a.accepts)[0], [1, 2])
+		self.assertEqual([[1, 2]], [t.actions for t in a.entry.transitions.itervalues()])
+		b.entry.addTransition(2, list(b.accepts)[0])
+		self.assertEqual([1, 2], sorted([t.label for t in b.entry.transitions.itervalues()]))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Particles compiled with occurrence counters accept the same documents and
+execute the same actions as their unrolled machines."""
+
+import itertools
+import unittest
+
+from support import Workspace, schema, document, compileElement, run
+
+# counted particles in sequence, the first one skipped in some documents
+SEQUENTIAL = """
+ <xs:element name="r">
+  <xs:complexType><xs:sequence>
+   <xs:element name="a" minOccurs="0" maxOccurs="20" enter="onA()"/>
+   <xs:element name="b" minOccurs="0" maxOccurs="20" leave="onB()"/>
+  </xs:sequence></xs:complexType>
+ </xs:element>"""
+
+# a counted sequence containing a counted particle
+NESTED = """
+ <xs:element name="r">
+  <xs:complexType><xs:sequence minOccurs="0" maxOccurs="12" enter="group()">
+   <xs:element name="x"/>
+   <xs:element name="a" minOccurs="0" maxOccurs="11" enter="onA()"/>
+  </xs:sequence></xs:complexType>
+ </xs:element>"""
+
+# counted particles with and without lower bounds around an optional element
+OPTIONAL = """
+ <xs:element name="r">
+  <xs:complexType><xs:sequence>
+   <xs:element name="a" minOccurs="0" maxOccurs="15" enter="onA()"/>
+   <xs:element name="c" minOccurs="0" leave="onC()"/>
+   <xs:element name="b" minOccurs="12" maxOccurs="unbounded"/>
+  </xs:sequence></xs:complexType>
+ </xs:element>"""
+
+# a counted particle without actions of its own, so that the counter
+# operations get the first action ids
+COUNTED = """
+ <xs:element name="r">
+  <xs:complexType><xs:sequence><xs:element name="a" maxOccurs="20"/></xs:sequence></xs:complexType>
+ </xs:element>"""
+
+# an action executed twice on the way to a, which is merged into one
+REPEATED = """
+ <xs:element name="r">
+  <xs:complexType><xs:sequence enter="x()">
+   <xs:sequence enter="x()"><xs:element name="a"/></xs:sequence>
+  </xs:sequence></xs:complexType>
+ </xs:element>"""
+
+# the compiler options the counted machines are compiled with
+MODES = [dict(), dict(construction="glushkov"), dict(lazy=64), dict(construction="glushkov", lazy=64)]
+
+class CounterTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workspace = Workspace()
+
+	def tearDown(self):
+		self.workspace.close()
+
+	def assertSameRuns(self, declarations, documents):
+		"""Compiles the element r of declarations unrolled and with counters
+		in every mode and compares the runs of documents, lists of child
+		element names."""
+		path = self.workspace.write("counters.xsd", schema(declarations))
+		documents = [self.workspace.write("doc%d.xml" % i, document("r", children)) for i, children in enumerate(documents)]
+		unrolled = compileElement([path], "r")
+		expected = [run(*unrolled + (doc,)) for doc in documents]
+		for options in MODES:
+			counted = compileElement([path], "r", counterThreshold=10, **options)
+			self.assertTrue(counted[0].counters() is not None)
+			for doc, result in zip(documents, expected):
+				valid, actions = run(*counted + (doc,))
+				actions = [action for action in actions if not action.startswith("counter_")]
+				self.assertEqual(result, (valid, actions), "%s %s: %r, %r" % (options, open(doc).read(), result, (valid, actions)))
+
+	def testSequential(self):
+		counts = (0, 1, 10, 19, 20, 21)
+		self.assertSameRuns(SEQUENTIAL, [["a"] * i + ["b"] * j for i, j in itertools.product(counts, counts)])
+
+	def testNested(self):
+		documents = [[]]
+		for groups, count in itertools.product((1, 2, 11, 12, 13), (0, 1, 11, 12)):
+			documents.append((["x"] + ["a"] * count) * groups)
+			documents.append((["x"] + ["a"] * count) * (groups - 1) + ["x"])
+		self.assertSameRuns(NESTED, documents)
+
+	def testOptional(self):
+		documents = []
+		for i, c, j in itertools.product((0, 1, 15, 16), (0, 1, 2), (0, 11, 12, 30)):
+			documents.append(["a"] * i + ["c"] * c + ["b"] * j)
+		self.assertSameRuns(OPTIONAL, documents)
+
+	def testSeparateCompilers(self):
+		# the counter actions of one compiler have the ids of other actions
+		# in compilers created after it
+		counted = self.workspace.write("counted.xsd", schema(COUNTED))
+		repeated = self.workspace.write("repeated.xsd", schema(REPEATED))
+		doc = self.workspace.write("doc.xml", document("r", ["a"]))
+		for options in MODES:
+			compileElement([counted], "r", counterThreshold=10, **options)
+			self.assertEqual((True, ["x"]), run(*compileElement([repeated], "r", **options) + (doc,)), options)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Compiling the targets in worker processes writes the same tables as
+compiling them one after the other."""
+
+import os
+import subprocess
+import sys
+import unittest
+
+from support import ROOT, NAMESPACE, Workspace, schema
+
+# counted particles of different bounds, a type shared by several elements
+# and an action entered by two nested groups, which is executed once
+DECLARATIONS = """
+ <xs:complexType name="shared"><xs:sequence>
+  <xs:element name="s" minOccurs="0" maxOccurs="25" enter="onS()"/>
+ </xs:sequence></xs:complexType>
+ <xs:element name="c1"><xs:complexType><xs:sequence><xs:element name="a" maxOccurs="20"/></xs:sequence></xs:complexType></xs:element>
+ <xs:element name="c2" type="shared"/>
+ <xs:element name="c3"><xs:complexType><xs:sequence><xs:element name="b" maxOccurs="30" leave="onB()"/></xs:sequence></xs:complexType></xs:element>
+ <xs:element name="c4"><xs:complexType><xs:sequence><xs:element name="d" type="shared" maxOccurs="40"/></xs:sequence></xs:complexType></xs:element>
+ <xs:element name="x">
+  <xs:complexType><xs:sequence enter="x()">
+   <xs:sequence enter="x()"><xs:element name="a"/></xs:sequence>
+  </xs:sequence></xs:complexType>
+ </xs:element>"""
+
+ELEMENTS = ["c1", "c2", "c3", "c4", "x"]
+
+class JobsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workspace = Workspace()
+		self.path = self.workspace.write("jobs.xsd", schema(DECLARATIONS))
+
+	def tearDown(self):
+		self.workspace.close()
+
+	def compileTables(self, jobs):
+		"""Compiles the elements with jobs worker processes, returns the
+		contents of their tables files."""
+		directory = os.path.join(self.workspace.path, "tables%d" % jobs)
+		os.mkdir(directory)
+		arguments = [sys.executable, os.path.join(ROOT, "xsdcc.py"), "--schema", self.path, "--counter-threshold", "10",
+		             "--no-cache", "--jobs", str(jobs), "--tables-dir", directory]
+		for element in ELEMENTS:
+			arguments.extend(["--element", "{%s}%s" % (NAMESPACE, element)])
+		with open(os.devnull, "w") as devnull:
+			subprocess.check_call(arguments, stdout=devnull)
+		return dict((name, open(os.path.join(directory, name), "rb").read()) for name in os.listdir(directory))
+
+	def testSameTables(self):
+		tables = self.compileTables(1)
+		self.assertEqual(sorted(["%s.fxt" % element for element in ELEMENTS]), sorted(tables))
+		self.assertEqual(tables, self.compileTables(2))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""The partition refinement of CompactFsm splits blocks in time proportional
+to the smaller half, so it scales with n log n on DFAs whose blocks lose
+one state at a time."""
+
+import time
+import unittest
+
+import support  # puts the sources on sys.path
+from fsm import CompactFsm
+
+def chain(n):
+	"""Returns the minimal DFA of a^(n-1), a chain of n states on one label,
+	which the refinement splits off one state per round."""
+	fsm = CompactFsm()
+	for state in xrange(0, n):
+		fsm.addState(state == n - 1, [] if state == n - 1 else [(1, state + 1, 0)])
+	fsm.entry = 0
+	return fsm
+
+def partitionTime(fsm):
+	"""Returns the blocks of the states of fsm and the shortest time of
+	three partitions."""
+	states = fsm.reachables()
+	times = []
+	for i in range(0, 3):
+		start = time.time()
+		block, blocks = fsm.partition(states)
+		times.append(time.time() - start)
+	return blocks, min(times)
+
+class PartitionTest(unittest.TestCase):
+
+	def testChains(self):
+		small, large = 4000, 32000
+		blocks, smallTime = partitionTime(chain(small))
+		self.assertEqual(small, blocks)
+		blocks, largeTime = partitionTime(chain(large))
+		self.assertEqual(large, blocks)
+		# eight times the states, quadratic splitting would take 64 times as long
+		self.assertTrue(largeTime < 24 * max(smallTime, 0.001), "%d states: %.3fs, %d states: %.3fs" % (small, smallTime, large, largeTime))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Intermediate reductions of content models execute the same actions as the
+unreduced content models, also where the surrounding content model adds its
+own actions to a reduced one."""
+
+import itertools
+import unittest
+
+from support import Workspace, schema, document, compileElement, run
+
+# actions of a group reference around a reduced group
+GROUP = """
+ <xs:element name="r">
+  <xs:complexType><xs:sequence enter="onR()">
+   <xs:group ref="G" minOccurs="0" maxOccurs="unbounded" enter="onG()" leave="onG()"/>
+   <xs:element name="c" minOccurs="0" enter="onG()"/>
+  </xs:sequence></xs:complexType>
+ </xs:element>
+ <xs:group name="G">
+  <xs:sequence><xs:element name="a"/><xs:element name="b" minOccurs="0"/></xs:sequence>
+ </xs:group>"""
+
+# actions of a type entered again by the loop of its reduced content
+LOOP = """
+ <xs:element name="r" type="L"/>
+ <xs:complexType name="L" enter="onL()" leave="onL()">
+  <xs:sequence maxOccurs="unbounded">
+   <xs:element name="a"/>
+   <xs:choice minOccurs="0"><xs:element name="b"/><xs:element name="c"/></xs:choice>
+  </xs:sequence>
+ </xs:complexType>"""
+
+# actions of a reused group itself and of its references
+SHARED = """
+ <xs:element name="r">
+  <xs:complexType><xs:sequence enter="onR()">
+   <xs:group ref="G" minOccurs="0" enter="onG()"/>
+   <xs:element name="c" minOccurs="0"/>
+   <xs:group ref="G" minOccurs="0" maxOccurs="2" leave="onR()"/>
+  </xs:sequence></xs:complexType>
+ </xs:element>
+ <xs:group name="G">
+  <xs:sequence enter="onG()">
+   <xs:choice minOccurs="0" leave="onB()"><xs:sequence minOccurs="0"><xs:element name="a" enter="onB()"/></xs:sequence></xs:choice>
+   <xs:element name="b"/>
+  </xs:sequence>
+ </xs:group>"""
+
+# the compiler options the machines are compiled with
+MODES = [dict(), dict(construction="glushkov"), dict(lazy=64), dict(construction="glushkov", lazy=64)]
+
+def unreduced(fsm, node, reason):
+	"""Replaces XSCompiler.reduce to leave the content models as they are."""
+	return fsm if hasattr(fsm, "copy") else fsm.compact()
+
+class ReductionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workspace = Workspace()
+
+	def tearDown(self):
+		self.workspace.close()
+
+	def assertSameRuns(self, declarations, names, length):
+		"""Compiles the element r of declarations with and without
+		intermediate reductions in every mode and compares the runs of the
+		documents with up to length children named by names."""
+		path = self.workspace.write("reductions.xsd", schema(declarations))
+		documents = list()
+		for n in range(0, length + 1):
+			for children in itertools.product(names, repeat=n):
+				documents.append(self.workspace.write("doc%d.xml" % len(documents), document("r", children)))
+		for options in MODES:
+			expected = compileElement([path], "r", reduce=unreduced, **options)
+			reduced = compileElement([path], "r", minimizeThreshold=1, **options)
+			self.assertTrue(reduced[0].minimizations > 0)
+			for doc in documents:
+				result = run(*reduced + (doc,))
+				self.assertEqual(run(*expected + (doc,)), result, "%s %s: %r" % (options, open(doc).read(), result))
+
+	def testGroup(self):
+		self.assertSameRuns(GROUP, ["a", "b", "c"], 4)
+
+	def testLoop(self):
+		self.assertSameRuns(LOOP, ["a", "b", "c"], 4)
+
+	def testShared(self):
+		self.assertSameRuns(SHARED, ["a", "b", "c"], 4)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""The direct-coded machines written by mkSource match elements by their
+namespace and local name."""
+
+import subprocess
+import unittest
+
+from support import NAMESPACE, Workspace, schema, document, compileElement, run, xml2Flags, buildProgram
+
+OTHER = "urn:other"
+
+# an element of another namespace with the local name of one of NAMESPACE
+DECLARATIONS = """
+ <xs:element name="r">
+  <xs:complexType><xs:sequence>
+   <xs:element ref="o:a" xmlns:o="%s" minOccurs="0" enter="other()"/>
+   <xs:element name="a" minOccurs="0" maxOccurs="3" enter="own()"/>
+   <xs:any minOccurs="0" leave="any()"/>
+  </xs:sequence></xs:complexType>
+ </xs:element>
+ <xs:element name="s" substitutionGroup="r"/>""" % OTHER
+
+# documents and the actions their goto-style machine fires
+DOCUMENTS = [
+	('<r xmlns="%s"/>' % NAMESPACE, []),
+	('<r xmlns="%s"><a xmlns="%s"/></r>' % (NAMESPACE, OTHER), ["other"]),
+	('<r xmlns="%s"><a/><a/></r>' % NAMESPACE, ["own", "own"]),
+	('<r xmlns="%s"><a xmlns="%s"/><a/><b/></r>' % (NAMESPACE, OTHER), ["other", "own", "any"]),
+	('<r xmlns="%s"><a xmlns="%s"/><a xmlns="%s"/></r>' % (NAMESPACE, OTHER, OTHER), ["other", "any"]),
+	('<r xmlns="%s"><a/><a xmlns="%s"/></r>' % (NAMESPACE, OTHER), ["own", "any"]),
+	('<r xmlns="%s"><a xmlns=""/></r>' % NAMESPACE, ["any"]),
+	('<r xmlns="%s"><a/><a/><a/><a/></r>' % NAMESPACE, ["own", "own", "own", "any"]),
+]
+
+# counted sequences nested deeper than the initial size of the counter stacks
+DEPTH = 40
+NESTED = """
+ <xs:element name="r">
+  <xs:complexType>%s<xs:element name="a" enter="onA()"/>%s</xs:complexType>
+ </xs:element>""" % ('<xs:sequence maxOccurs="11">' * DEPTH, "</xs:sequence>" * DEPTH)
+
+# prints the fired actions apart from the trace of the interpreter
+ACTION = '#define FX_ACTION(name) printf("\\nfired %s\\n", #name)\n'
+
+DRIVER = """
+#include <string.h>
+#include "xmlparser.h"
+
+extern const fx_schema table_schema;
+int goto_parse(xmlTextReaderPtr rd);
+
+int main(int argc, char **argv)
+{
+	xmlTextReaderPtr rd = xmlReaderForFile(argv[2], NULL, 0);
+	int result = strcmp(argv[1], "table") == 0 ? fx_parse_xml(rd, &table_schema) : goto_parse(rd);
+	printf("%s\\n", result == 0 ? "valid" : "invalid");
+	xmlFreeTextReader(rd);
+	return 0;
+}
+"""
+
+def outcome(output):
+	"""Returns the fired actions and the result printed by the driver."""
+	lines = output.splitlines()
+	return [line for line in lines if line.startswith("fired ")] + lines[-1:]
+
+@unittest.skipIf(xml2Flags() is None, "needs gcc and xml2-config")
+class SourceTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workspace = Workspace()
+		self.paths = [self.workspace.write("test.xsd", schema(DECLARATIONS)),
+		              self.workspace.write("other.xsd", schema(' <xs:element name="a"/>', OTHER))]
+
+	def tearDown(self):
+		self.workspace.close()
+
+	def testNamespaces(self):
+		cc, dfa = compileElement(self.paths, "r")
+		program = buildProgram(self.workspace, "styles", {"driver.c": DRIVER,
+		                       "table.c": ACTION + cc.mkSource(dfa, "table", "table"),
+		                       "goto.c": ACTION + cc.mkSource(dfa, "goto", "goto")})
+		for i, (text, actions) in enumerate(DOCUMENTS):
+			doc = self.workspace.write("doc%d.xml" % i, text)
+			result = outcome(subprocess.check_output([program, "goto", doc], stderr=subprocess.STDOUT))
+			self.assertEqual(["fired %s" % action for action in actions] + ["valid"], result, "%s %r" % (text, result))
+
+	def testNestedCounters(self):
+		path = self.workspace.write("nested.xsd", schema(NESTED))
+		cc, dfa = compileElement([path], "r", counterThreshold=10)
+		program = buildProgram(self.workspace, "nested", {"driver.c": DRIVER,
+		                       "table.c": ACTION + cc.mkSource(dfa, "table", "table"),
+		                       "goto.c": ACTION + cc.mkSource(dfa, "goto", "goto")})
+		for i, children in enumerate([[], ["a"], ["a", "b"], ["b"]]):
+			doc = self.workspace.write("nested%d.xml" % i, document("r", children))
+			valid, actions = run(cc, dfa, doc)
+			self.assertEqual(valid, children == ["a"])
+			table = outcome(subprocess.check_output([program, "table", doc], stderr=subprocess.STDOUT))
+			self.assertEqual(table, ["fired %s" % action for action in actions if not action.startswith("counter_")] +
+			                 ["valid" if valid else "invalid"])
+			self.assertEqual(table, outcome(subprocess.check_output([program, "goto", doc], stderr=subprocess.STDOUT)))
+
+	def testSubstitutionGroup(self):
+		cc, dfa = compileElement(self.paths, "r", preservedSubsts=set(["{%s}r" % NAMESPACE]))
+		cc.mkSource(dfa, "table", "table")
+		self.assertRaises(BaseException, cc.mkSource, dfa, "goto", "goto")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,89 +1,1487 @@
 #include <stdint.h>
+#include <inttypes.h>
+#include <stdarg.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stddef.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <pthread.h>
+#include <libxml/parser.h>
 #include <libxml/xmlreader.h>
+#include "xmlparser.h"
 
-typedef struct fx_schema fx_schema;
+/* binary tables as written by xsdcc.py --tables-dir, all numbers are little
+ * endian and every section starts at an offset aligned to 8 bytes
+ */
+#define FX_TABLES_MAGIC "FXSM"
+#define FX_TABLES_VERSION 6
 
-struct element {
+enum fx_tables_section {
+	FX_SECTION_OFFSETS = 0,
+	FX_SECTION_KEYS,
+	FX_SECTION_TARGETS,
+	FX_SECTION_ACTIONS_OFFSETS,
+	FX_SECTION_ACTIONS,
+	FX_SECTION_ELEMENTS,
+	FX_SECTION_NAMESPACES,
+	FX_SECTION_COUNTERS,
+	FX_SECTION_STRINGS,
+	FX_SECTIONS_V1,			/* version 1 ends here */
+	FX_SECTION_CLASSES = FX_SECTIONS_V1,
+	FX_SECTION_ROWS,
+	FX_SECTION_BASE,
+	FX_SECTION_NEXT,
+	FX_SECTION_CHECK,
+	FX_SECTIONS_V2,			/* version 2 ends here */
+	FX_SECTION_REGISTRATION = FX_SECTIONS_V2,
+	FX_SECTIONS_V3,			/* version 3 ends here */
+	FX_SECTION_LAZY = FX_SECTIONS_V3,
+	FX_SECTIONS_V4,			/* version 4 ends here */
+	FX_SECTION_ACTIONS_ENDS = FX_SECTIONS_V4,
+	FX_SECTIONS_V5,			/* version 5 ends here */
+	FX_SECTION_ROOTS = FX_SECTIONS_V5,
+	FX_SECTIONS
+};
+
+/* the registration section holds string offsets, FX_NO_STRING for none */
+enum fx_tables_registration {
+	FX_REGISTRATION_NAMESPACE = 0,
+	FX_REGISTRATION_LOCALNAME,
+	FX_REGISTRATION_GROUP_NAMESPACE,
+	FX_REGISTRATION_GROUP,
+	FX_REGISTRATION_LEN
+};
+
+#define FX_NO_STRING 0xffffffffu
+
+struct fx_tables_header {
+	char magic[4];
+	uint16_t version;
+	uint16_t type;
+	uint32_t start;
+	uint32_t first_final;
+	struct {
+		uint32_t offset;
+		uint32_t count;
+	} sections[FX_SECTIONS];
+};
+
+/* a root of combined tables, the first one is also described by the header
+ * and the registration section
+ */
+struct fx_tables_root {
+	uint32_t start;
+	uint32_t names[FX_REGISTRATION_LEN];	/* like the registration section */
+};
+
+struct fx_tables_element {
+	uint32_t name;		/* offset into the strings section */
 	uint8_t namespaceId;
-	const xmlChar *localname;
+	uint8_t pad[3];
+};
+
+/* a schema loaded from a binary tables file, the arrays point into the
+ * read-only mapping which can be shared between processes
+ */
+struct fx_loaded_schema {
+	fx_schema schema;
+	struct fx_dense dense;
+	void *map;
+	size_t size;
+	const xmlChar **namespaces;
+	int nroots;
+	fx_schema *roots;		/* the roots after the first one */
+	struct element elements[];
 };
 
-struct fx_schema {
-	int type;
-	int start;
-	const struct element *elements;
-	const uint16_t *keys;
-	const uint16_t *keys_offsets;
-	const uint16_t *actions;
-	const uint16_t *actions_offsets;
-	const uint16_t *targets;
-	uint16_t first_final;
-	void (*do_actions)(int, const uint16_t*);
+/* the element table of a schema interned into the dictionary of a reader, so
+ * that names can be matched by pointer.  States with more than
+ * FX_LINEAR_KEYS keys, sorted by element id and without wildcard or
+ * substitution keys, are searched via the hash of the name pointer instead
+ * of a linear scan.
+ */
+#define FX_LINEAR_KEYS 8
+
+struct fx_interned {
+	const fx_schema *schema;
+	const xmlChar **names;
+	const xmlChar **namespaces;	/* NULL if the schema has no namespaces */
+	uint8_t *sorted;
+	uint16_t *hash;			/* element id + 1, 0 for free slots */
+	uint32_t hash_mask;
+	uint16_t *specials;		/* ids of wildcard and substitution elements */
+	int nspecials;
+	struct fx_profile *profile;	/* NULL unless profiling */
+	struct fx_lazy *lazy;		/* NULL unless the schema is an NFA */
+};
+
+/* the DFA states of an NFA, built on demand the way determinize in xsdcc.py
+ * builds them.  A state is the epsilon closure of a list of NFA states along
+ * with the actions pending on each NFA state, stored as the state, the number
+ * of actions and the actions for every NFA state of the closure.  The keys of
+ * a DFA state are the labels of its NFA states in ascending order, the
+ * actions of a key are the actions pending on the first NFA state with the
+ * label followed by the actions of all its transitions on the label.  The
+ * target of a key is computed when it is first taken and remembered along
+ * with the generation of the target slot, which changes when the slot is
+ * reused.
+ */
+struct fx_lazy_state {
+	uint16_t *set;
+	int set_len;
+	uint32_t hash;
+	int next;			/* next slot in the hash chain, -1 at the end */
+	uint64_t used;			/* clock of the last use */
+	uint32_t generation;
+	int final;
+	int nkeys;
+	uint16_t *keys;
+	uint16_t *actions;
+	int *actions_offsets;
+	int *targets;			/* slot of the target of each key, -1 if unknown */
+	uint32_t *generations;
+};
+
+/* at most schema->lazy states are cached per parser, the least recently used
+ * state not referenced by the parser stack is evicted for a new one.  Only
+ * invocations nested deeper than that can grow the cache beyond.
+ */
+struct fx_lazy {
+	struct fx_lazy_state *slots;
+	int nslots;			/* slots holding a state */
+	int size;			/* slots allocated */
+	int *buckets;			/* hash chains of the slots, -1 if empty */
+	uint32_t mask;
+	uint64_t clock;
+	int *index;			/* position of an NFA state in a closure, -1 if absent */
+	int *labels;			/* position of a label in a new state, -1 if absent */
 };
 
+/* a growing array of actions or NFA states */
+struct fx_list {
+	uint16_t *v;
+	int len;
+	int size;
+};
+
+/* hit counts of a schema while profiling, indexed by state and by
+ * transition.  The counts are not synchronized between threads, the list
+ * of profiles is guarded by fx_profiles_lock.
+ */
+struct fx_profile {
+	const fx_schema *schema;
+	uint64_t *states;
+	uint64_t *transitions;
+};
+
+static struct fx_profile **fx_profiles;
+static int fx_nprofiles;
+static pthread_mutex_t fx_profiles_lock = PTHREAD_MUTEX_INITIALIZER;
+static int fx_profiling;
+
+static fx_trace_hook fx_hook;
+static void *fx_hook_data;
+
+#if FX_TRACE > 0
+static void fx_trace(int level, const char *fmt, ...)
+{
+	char message[256];
+	va_list ap;
+
+	va_start(ap, fmt);
+	if (fx_hook == NULL) {
+		vprintf(fmt, ap);
+	} else {
+		vsnprintf(message, sizeof(message), fmt, ap);
+		fx_hook(fx_hook_data, level, message);
+	}
+	va_end(ap);
+}
+
+#define FX_TRACE_AT(level, ...) do { if ((level) <= FX_TRACE) fx_trace((level), __VA_ARGS__); } while (0)
+#else
+#define FX_TRACE_AT(level, ...) do { } while (0)
+#endif
+
+void fx_set_trace_hook(fx_trace_hook hook, void *data)
+{
+	fx_hook = hook;
+	fx_hook_data = data;
+}
+
 struct stack {
 	const fx_schema *schema;
 	int state;
 	void *result;
+	const struct fx_interned *in;
 };
 
-fx_schema *lookupSubstitution(const xmlChar* name)
+/* the complete interpreter state of one document, names are interned either
+ * through a reader or directly into the dictionary of a push parser.  The
+ * stack of invoked machines, the counter stack and the interned schemas grow
+ * on demand.
+ */
+struct fx_parser {
+	xmlTextReaderPtr rd;
+	xmlDictPtr dict;
+	struct stack *ss;
+	int sp;
+	int stack_size;
+	uint32_t *counters;
+	int csp;
+	int counters_size;
+	struct fx_interned **interned;
+	int ninterned;
+	fx_action_hook hook;		/* replaces do_actions of the schemas if set */
+	void *hook_data;
+	uint32_t events;		/* element events seen so far */
+};
+
+/* the registry of machines that can be invoked by '!' keys, a hash table of
+ * chains keyed by namespace and local name
+ */
+struct fx_registered {
+	const fx_schema *schema;
+	uint32_t hash;
+	struct fx_registered *next;
+};
+
+static struct fx_registered **fx_registry;
+static uint32_t fx_registry_mask;
+static uint32_t fx_nregistered;
+
+#define FX_MAX_GROUP_DEPTH 32
+#define FX_STACK_SIZE 16
+
+struct fx_push {
+	struct fx_parser parser;
+	xmlParserCtxtPtr ctxt;
+	int failed;
+};
+
+static const void *fx_section(const struct fx_tables_header *hdr, size_t hdr_size, size_t size, int section, size_t elsize)
 {
+	uint32_t offset = hdr->sections[section].offset;
+	uint32_t count = hdr->sections[section].count;
+
+	if (offset % 8 != 0 || offset < hdr_size || offset > size || count > (size - offset) / elsize)
+		return NULL;
+	return (const char *)hdr + offset;
+}
+
+static int fx_check(const uint16_t *values, uint32_t count, uint32_t limit)
+{
+	uint32_t i;
+	for (i = 0; i < count; i++)
+		if (values[i] >= limit)
+			return -1;
+	return 0;
+}
+
+/* the string at offset in the strings section, NULL for FX_NO_STRING */
+static const xmlChar *fx_tables_string(const char *strings, uint32_t offset)
+{
+	return offset != FX_NO_STRING ? (const xmlChar *)strings + offset : NULL;
+}
+
+/* maps the tables file at path and returns a schema running on it, or NULL
+ * if the file can not be read or is not a valid tables file
+ */
+fx_schema *fx_load_schema(const char *path, void (*do_actions)(int, const uint16_t*))
+{
+	int fd;
+	struct stat st;
+	void *map;
+	const struct fx_tables_header *hdr;
+	const struct fx_tables_element *elements;
+	const char *strings;
+	struct fx_loaded_schema *ls;
+	uint32_t i, nsections, nstates, nkeys, nactions, nelements, nnamespaces, nstrings, nclasses, lazy;
+	const uint32_t *namespaces;
+	const void *sections[FX_SECTIONS];
+	uint32_t count[FX_SECTIONS];
+	size_t hdr_size;
+	static const size_t elsize[FX_SECTIONS] = {
+		sizeof(uint16_t), sizeof(uint16_t), sizeof(uint16_t), sizeof(uint16_t), sizeof(uint16_t),
+		sizeof(struct fx_tables_element), sizeof(uint32_t), sizeof(struct fx_counter), 1,
+		sizeof(uint16_t), sizeof(uint16_t), sizeof(uint16_t), sizeof(uint16_t), sizeof(uint16_t),
+		sizeof(uint32_t), sizeof(uint32_t), sizeof(uint16_t), sizeof(struct fx_tables_root)
+	};
+	static const uint32_t nsections_of[FX_TABLES_VERSION + 1] = {
+		0, FX_SECTIONS_V1, FX_SECTIONS_V2, FX_SECTIONS_V3, FX_SECTIONS_V4, FX_SECTIONS_V5, FX_SECTIONS
+	};
+	const struct fx_tables_root *roots;
+	uint32_t k, nroots;
+	const uint16_t *actions_offsets, *actions_ends;
+	const uint32_t *registration;
+	const xmlChar *names[FX_REGISTRATION_LEN];
+
+	if ((fd = open(path, O_RDONLY)) < 0)
+		return NULL;
+	if (fstat(fd, &st) < 0 || st.st_size < (off_t)offsetof(struct fx_tables_header, sections)) {
+		close(fd);
+		return NULL;
+	}
+	map = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+	close(fd);
+	if (map == MAP_FAILED)
+		return NULL;
+
+	/* older versions have a prefix of the sections */
+	hdr = map;
+	if (memcmp(hdr->magic, FX_TABLES_MAGIC, 4) != 0 || hdr->version < 1 || hdr->version > FX_TABLES_VERSION)
+		goto invalid;
+	nsections = nsections_of[hdr->version];
+	hdr_size = offsetof(struct fx_tables_header, sections) + nsections * sizeof(hdr->sections[0]);
+	if ((size_t)st.st_size < hdr_size)
+		goto invalid;
+	for (i = 0; i < FX_SECTIONS; i++) {
+		sections[i] = NULL;
+		count[i] = 0;
+		if (i < nsections) {
+			if ((sections[i] = fx_section(hdr, hdr_size, st.st_size, i, elsize[i])) == NULL)
+				goto invalid;
+			count[i] = hdr->sections[i].count;
+		}
+	}
+
+	/* check all references, so the interpreter can trust the tables */
+	nstates   = count[FX_SECTION_OFFSETS];
+	nkeys     = count[FX_SECTION_KEYS];
+	nactions  = count[FX_SECTION_ACTIONS];
+	nelements = count[FX_SECTION_ELEMENTS];
+	nnamespaces = count[FX_SECTION_NAMESPACES];
+	namespaces = sections[FX_SECTION_NAMESPACES];
+	nstrings  = count[FX_SECTION_STRINGS];
+	strings   = sections[FX_SECTION_STRINGS];
+	elements  = sections[FX_SECTION_ELEMENTS];
+	if (count[FX_SECTION_LAZY] > 1)
+		goto invalid;
+	lazy = count[FX_SECTION_LAZY] > 0 ? ((const uint32_t *)sections[FX_SECTION_LAZY])[0] : 0;
+	if (count[FX_SECTION_LAZY] > 0 && (lazy == 0 || count[FX_SECTION_CLASSES] > 0))
+		goto invalid;
+	/* NFAs may have epsilon keys beyond the elements */
+	for (i = 0; lazy && i < nkeys; i++)
+		if (((const uint16_t *)sections[FX_SECTION_KEYS])[i] >= nelements &&
+		    ((const uint16_t *)sections[FX_SECTION_KEYS])[i] != FX_EPSILON)
+			goto invalid;
+	if (nstates < 2 || count[FX_SECTION_TARGETS] != nkeys ||
+	    count[FX_SECTION_ACTIONS_OFFSETS] != nkeys + 1 ||
+	    hdr->start < 1 || hdr->start >= nstates - 1 || hdr->first_final > nstates - 1 ||
+	    nstrings == 0 || strings[nstrings - 1] != '\0' ||
+	    fx_check(sections[FX_SECTION_OFFSETS], nstates, nkeys + 1) ||
+	    (!lazy && fx_check(sections[FX_SECTION_KEYS], nkeys, nelements)) ||
+	    fx_check(sections[FX_SECTION_TARGETS], nkeys, nstates - 1) ||
+	    fx_check(sections[FX_SECTION_ACTIONS_OFFSETS], nkeys + 1, nactions + 1))
+		goto invalid;
+	for (i = 0; i + 1 < nstates; i++)
+		if (((const uint16_t *)sections[FX_SECTION_OFFSETS])[i] > ((const uint16_t *)sections[FX_SECTION_OFFSETS])[i + 1])
+			goto invalid;
+	/* without ends the actions of a transition end where the next ones start */
+	actions_offsets = sections[FX_SECTION_ACTIONS_OFFSETS];
+	actions_ends = count[FX_SECTION_ACTIONS_ENDS] > 0 ? sections[FX_SECTION_ACTIONS_ENDS] : actions_offsets + 1;
+	if (count[FX_SECTION_ACTIONS_ENDS] > 0 && count[FX_SECTION_ACTIONS_ENDS] != nkeys)
+		goto invalid;
+	for (i = 0; i < nkeys; i++)
+		if (actions_offsets[i] > actions_ends[i] || actions_ends[i] > nactions)
+			goto invalid;
+	if (count[FX_SECTION_COUNTERS] > 0 &&
+	    fx_check(sections[FX_SECTION_ACTIONS], nactions, count[FX_SECTION_COUNTERS]))
+		goto invalid;
+	if (nelements > 0xffff || nstates > 0x10000)
+		goto invalid;
+	for (i = 0; i < nelements; i++)
+		if (elements[i].name >= nstrings || elements[i].namespaceId >= nnamespaces)
+			goto invalid;
+	for (i = 0; i < nnamespaces; i++)
+		if (namespaces[i] >= nstrings)
+			goto invalid;
+	registration = sections[FX_SECTION_REGISTRATION];
+	if (count[FX_SECTION_REGISTRATION] != 0 && count[FX_SECTION_REGISTRATION] != FX_REGISTRATION_LEN)
+		goto invalid;
+	for (i = 0; i < FX_REGISTRATION_LEN; i++) {
+		names[i] = NULL;
+		if (count[FX_SECTION_REGISTRATION] > 0 && registration[i] != FX_NO_STRING) {
+			if (registration[i] >= nstrings)
+				goto invalid;
+			names[i] = (const xmlChar *)strings + registration[i];
+		}
+	}
+	roots = sections[FX_SECTION_ROOTS];
+	nroots = count[FX_SECTION_ROOTS];
+	for (i = 0; i < nroots; i++) {
+		if (roots[i].start < 1 || roots[i].start >= nstates - 1)
+			goto invalid;
+		for (k = 0; k < FX_REGISTRATION_LEN; k++)
+			if (roots[i].names[k] != FX_NO_STRING && roots[i].names[k] >= nstrings)
+				goto invalid;
+	}
+	if (count[FX_SECTION_CLASSES] > 0) {
+		const uint16_t *classes = sections[FX_SECTION_CLASSES];
+		const uint16_t *base = sections[FX_SECTION_BASE];
+		const uint16_t *check = sections[FX_SECTION_CHECK];
+		for (nclasses = 0, i = 0; i < count[FX_SECTION_CLASSES]; i++)
+			if (classes[i] >= nclasses)
+				nclasses = classes[i] + 1;
+		if (count[FX_SECTION_CLASSES] != nelements || count[FX_SECTION_ROWS] != nstates - 1 ||
+		    count[FX_SECTION_NEXT] != count[FX_SECTION_CHECK] ||
+		    fx_check(sections[FX_SECTION_ROWS], nstates - 1, count[FX_SECTION_BASE]))
+			goto invalid;
+		for (i = 0; i < count[FX_SECTION_BASE]; i++)
+			if (base[i] + nclasses > count[FX_SECTION_NEXT])
+				goto invalid;
+		for (i = 0; i < count[FX_SECTION_CHECK]; i++)
+			if (check[i] != 0xffff && (check[i] >= count[FX_SECTION_BASE] ||
+			                           ((const uint16_t *)sections[FX_SECTION_NEXT])[i] >= nkeys))
+				goto invalid;
+	}
+
+	if ((ls = malloc(sizeof(*ls) + nelements * sizeof(struct element) + nnamespaces * sizeof(xmlChar *) +
+	                 (nroots > 1 ? nroots - 1 : 0) * sizeof(fx_schema))) == NULL)
+		goto invalid;
+	ls->namespaces = (const xmlChar **)&ls->elements[nelements];
+	ls->nroots = nroots > 1 ? nroots : 1;
+	ls->roots = (fx_schema *)&ls->namespaces[nnamespaces];
+	for (i = 0; i < nelements; i++) {
+		ls->elements[i].namespaceId = elements[i].namespaceId;
+		ls->elements[i].localname = (const xmlChar *)strings + elements[i].name;
+	}
+	for (i = 0; i < nnamespaces; i++)
+		ls->namespaces[i] = (const xmlChar *)strings + namespaces[i];
+	ls->map = map;
+	ls->size = st.st_size;
+	ls->schema = (fx_schema){
+		hdr->type,
+		hdr->start,
+		ls->elements,
+		sections[FX_SECTION_KEYS],
+		sections[FX_SECTION_OFFSETS],
+		sections[FX_SECTION_ACTIONS],
+		sections[FX_SECTION_ACTIONS_OFFSETS],
+		sections[FX_SECTION_TARGETS],
+		hdr->first_final,
+		do_actions,
+		count[FX_SECTION_COUNTERS] > 0 ? sections[FX_SECTION_COUNTERS] : NULL,
+		ls->namespaces,
+		nelements,
+		nstates - 1,
+		count[FX_SECTION_CLASSES] > 0 ? &ls->dense : NULL,
+		names[FX_REGISTRATION_NAMESPACE],
+		names[FX_REGISTRATION_LOCALNAME],
+		names[FX_REGISTRATION_GROUP_NAMESPACE],
+		names[FX_REGISTRATION_GROUP],
+		lazy,
+		actions_ends
+	};
+	ls->dense = (struct fx_dense){
+		sections[FX_SECTION_CLASSES],
+		sections[FX_SECTION_ROWS],
+		sections[FX_SECTION_BASE],
+		sections[FX_SECTION_NEXT],
+		sections[FX_SECTION_CHECK]
+	};
+	/* the other roots share everything but the start state and registration */
+	for (i = 1; i < nroots; i++) {
+		fx_schema *root = &ls->roots[i - 1];
+		*root = ls->schema;
+		root->start = roots[i].start;
+		root->namespace = fx_tables_string(strings, roots[i].names[FX_REGISTRATION_NAMESPACE]);
+		root->localname = fx_tables_string(strings, roots[i].names[FX_REGISTRATION_LOCALNAME]);
+		root->group_namespace = fx_tables_string(strings, roots[i].names[FX_REGISTRATION_GROUP_NAMESPACE]);
+		root->group = fx_tables_string(strings, roots[i].names[FX_REGISTRATION_GROUP]);
+	}
+	return &ls->schema;
+
+invalid:
+	munmap(map, st.st_size);
 	return NULL;
 }
 
-int fx_parse_xml(xmlTextReaderPtr rd, const fx_schema *schema)
+/* the number of machines in the tables of schema, as returned by
+ * fx_load_schema, more than 1 for tables written by xsdcc.py --combine
+ */
+int fx_schema_roots(const fx_schema *schema)
 {
-	int ret, i, trans;
-	int fake_close = 0;
-	xmlReaderTypes ev_type;
-	uint8_t keys_len;
-	const uint16_t *keys;
-	fx_schema *schemaToInvoke;
-	struct {
-		struct stack ss[16];
-		int sp;
-	} stack;
+	return ((const struct fx_loaded_schema *)schema)->nroots;
+}
 
-	stack.sp = 0;
-	stack.ss[stack.sp] = (struct stack){schema, schema->start, NULL};
+/* the machine for the i-th element of combined tables, sharing the tables
+ * of schema, which is the first one.  It is valid until schema is freed.
+ */
+fx_schema *fx_schema_root(fx_schema *schema, int i)
+{
+	struct fx_loaded_schema *ls = (struct fx_loaded_schema *)schema;
+	if (i < 0 || i >= ls->nroots)
+		return NULL;
+	return i == 0 ? schema : &ls->roots[i - 1];
+}
 
-read:
-	if (fake_close) {
-		fake_close = 0;
-		ev_type = XML_READER_TYPE_END_ELEMENT;
-	} else {
-		if ((ret = xmlTextReaderRead(rd)) != 1) {
-			/* error reading the next event, either EOF or I/O error */
-			goto IO_error;
+void fx_free_schema(fx_schema *schema)
+{
+	struct fx_loaded_schema *ls = (struct fx_loaded_schema *)schema;
+	munmap(ls->map, ls->size);
+	free(ls);
+}
+
+static uint32_t fx_name_hash(const xmlChar *ns, const xmlChar *localname)
+{
+	uint32_t h = 2166136261u;
+	for (; ns != NULL && *ns; ns++)
+		h = (h ^ *ns) * 16777619u;
+	h = (h ^ '}') * 16777619u;
+	for (; *localname; localname++)
+		h = (h ^ *localname) * 16777619u;
+	return h;
+}
+
+/* namespaces are equal if both are empty or NULL */
+static int fx_same_name(const xmlChar *ns1, const xmlChar *localname1, const xmlChar *ns2, const xmlChar *localname2)
+{
+	return xmlStrEqual(localname1, localname2) &&
+	       xmlStrEqual(ns1 != NULL ? ns1 : BAD_CAST "", ns2 != NULL ? ns2 : BAD_CAST "");
+}
+
+static const fx_schema *fx_registered(const xmlChar *ns, const xmlChar *localname)
+{
+	uint32_t h;
+	const struct fx_registered *r;
+
+	if (fx_nregistered == 0)
+		return NULL;
+	h = fx_name_hash(ns, localname);
+	for (r = fx_registry[h & fx_registry_mask]; r != NULL; r = r->next)
+		if (r->hash == h && fx_same_name(ns, localname, r->schema->namespace, r->schema->localname))
+			return r->schema;
+	return NULL;
+}
+
+/* makes schema invocable by its element name, which must not be registered
+ * already.  Registering is not synchronized with running documents.
+ */
+int fx_register(const fx_schema *schema)
+{
+	uint32_t i, size;
+	struct fx_registered *r, *next, **registry;
+
+	if (schema->localname == NULL || fx_registered(schema->namespace, schema->localname) != NULL)
+		return -1;
+	if (fx_nregistered >= fx_registry_mask) {
+		size = fx_registry == NULL ? 64 : 2 * (fx_registry_mask + 1);
+		if ((registry = calloc(size, sizeof(*registry))) == NULL)
+			return -1;
+		for (i = 0; fx_registry != NULL && i <= fx_registry_mask; i++)
+			for (r = fx_registry[i]; r != NULL; r = next) {
+				next = r->next;
+				r->next = registry[r->hash & (size - 1)];
+				registry[r->hash & (size - 1)] = r;
+			}
+		free(fx_registry);
+		fx_registry = registry;
+		fx_registry_mask = size - 1;
+	}
+	if ((r = malloc(sizeof(*r))) == NULL)
+		return -1;
+	r->schema = schema;
+	r->hash = fx_name_hash(schema->namespace, schema->localname);
+	r->next = fx_registry[r->hash & fx_registry_mask];
+	fx_registry[r->hash & fx_registry_mask] = r;
+	fx_nregistered++;
+	return 0;
+}
+
+void fx_unregister(const fx_schema *schema)
+{
+	struct fx_registered **r, *found;
+
+	if (fx_nregistered == 0 || schema->localname == NULL)
+		return;
+	for (r = &fx_registry[fx_name_hash(schema->namespace, schema->localname) & fx_registry_mask]; *r != NULL; r = &(*r)->next)
+		if ((*r)->schema == schema) {
+			found = *r;
+			*r = found->next;
+			free(found);
+			fx_nregistered--;
+			return;
+		}
+}
+
+/* returns the machine registered for the element ns:localname if it is the
+ * element head_ns:head or a member of its substitution group, NULL otherwise.
+ * A NULL head_ns matches any namespace.
+ */
+const fx_schema *lookupSubstitution(const xmlChar *ns, const xmlChar *localname,
+                                    const xmlChar *head_ns, const xmlChar *head)
+{
+	const fx_schema *schema, *member;
+	int depth;
+
+	if ((schema = fx_registered(ns, localname)) == NULL)
+		return NULL;
+	for (member = schema, depth = 0; member != NULL && depth < FX_MAX_GROUP_DEPTH; depth++) {
+		if (head_ns == NULL ? xmlStrEqual(member->localname, head) :
+		    fx_same_name(member->namespace, member->localname, head_ns, head))
+			return schema;
+		if (member->group == NULL)
+			return NULL;
+		if (head_ns == NULL ? xmlStrEqual(member->group, head) :
+		    fx_same_name(member->group_namespace, member->group, head_ns, head))
+			return schema;
+		member = fx_registered(member->group_namespace, member->group);
+	}
+	return NULL;
+}
+
+/* the end of the actions of transition trans */
+static int fx_actions_end(const fx_schema *schema, int trans)
+{
+	return schema->actions_ends != NULL ? schema->actions_ends[trans] : schema->actions_offsets[trans + 1];
+}
+
+/* apply the counter operations among actions to the counter stack of p,
+ * growing it if it is full, returns -1 if a bound is violated */
+static int fx_count(struct fx_parser *p, const struct fx_counter *counters, int len, const uint16_t *actions)
+{
+	uint32_t *cs;
+	int i;
+	for (i=0; i < len; i++) {
+		const struct fx_counter *c = &counters[actions[i]];
+		switch (c->op) {
+		case FX_COUNTER_ENTER:
+			if (p->csp + 1 == p->counters_size) {
+				if ((cs = realloc(p->counters, 2 * p->counters_size * sizeof(*cs))) == NULL)
+					return -1;
+				p->counters = cs;
+				p->counters_size *= 2;
+			}
+			p->counters[++p->csp] = 0;
+			break;
+		case FX_COUNTER_ITERATE:
+			if (p->csp < 0 || (c->bound && p->counters[p->csp] >= c->bound))
+				return -1;
+			p->counters[p->csp]++;
+			break;
+		case FX_COUNTER_LEAVE:
+			if (p->csp < 0 || p->counters[p->csp] < c->bound)
+				return -1;
+			p->csp--;
+			break;
+		}
+	}
+	return 0;
+}
+
+static uint32_t fx_hash(const xmlChar *name, uint32_t mask)
+{
+	return ((uintptr_t)name >> 3) * 2654435761u & mask;
+}
+
+static int fx_list_add(struct fx_list *l, uint16_t value)
+{
+	uint16_t *v;
+
+	if (l->len == l->size) {
+		if ((v = realloc(l->v, (l->size ? 2 * l->size : 8) * sizeof(*v))) == NULL)
+			return -1;
+		l->v = v;
+		l->size = l->size ? 2 * l->size : 8;
+	}
+	l->v[l->len++] = value;
+	return 0;
+}
+
+static int fx_list_contains(const struct fx_list *l, uint16_t value)
+{
+	int i;
+	for (i = 0; i < l->len; i++)
+		if (l->v[i] == value)
+			return 1;
+	return 0;
+}
+
+static int fx_cmp_u16(const void *a, const void *b)
+{
+	return (int)*(const uint16_t *)a - (int)*(const uint16_t *)b;
+}
+
+static uint32_t fx_set_hash(const uint16_t *set, int len)
+{
+	uint32_t h = 2166136261u;
+	int i;
+	for (i = 0; i < len; i++)
+		h = (h ^ set[i]) * 16777619u;
+	return h;
+}
+
+static void fx_lazy_state_free(struct fx_lazy_state *ls)
+{
+	free(ls->set);
+	free(ls->keys);
+	free(ls->actions);
+	free(ls->actions_offsets);
+	free(ls->targets);
+	free(ls->generations);
+}
+
+static void fx_lazy_free(struct fx_lazy *lz)
+{
+	int i;
+
+	if (lz == NULL)
+		return;
+	for (i = 0; i < lz->nslots; i++)
+		fx_lazy_state_free(&lz->slots[i]);
+	free(lz->slots);
+	free(lz->buckets);
+	free(lz->index);
+	free(lz->labels);
+	free(lz);
+}
+
+static struct fx_lazy *fx_lazy_new(const fx_schema *schema)
+{
+	struct fx_lazy *lz;
+	uint32_t i;
+
+	if ((lz = calloc(1, sizeof(*lz))) == NULL)
+		return NULL;
+	for (lz->mask = 1; lz->mask < schema->lazy && lz->mask < (1u << 20); lz->mask <<= 1);
+	lz->buckets = malloc(lz->mask * sizeof(int));
+	lz->mask--;
+	lz->index = malloc(schema->states_len * sizeof(int));
+	lz->labels = malloc(schema->elements_len * sizeof(int));
+	if (lz->buckets == NULL || lz->index == NULL || lz->labels == NULL) {
+		fx_lazy_free(lz);
+		return NULL;
+	}
+	for (i = 0; i <= lz->mask; i++)
+		lz->buckets[i] = -1;
+	for (i = 0; i < schema->states_len; i++)
+		lz->index[i] = -1;
+	for (i = 0; i < schema->elements_len; i++)
+		lz->labels[i] = -1;
+	return lz;
+}
+
+/* stores the epsilon closure of the NFA states in the set format of struct
+ * fx_lazy_state, as computed by closure in fsm.py.  Returns -1 if out of
+ * memory.
+ */
+static int fx_closure(struct fx_lazy *lz, const fx_schema *schema, const struct fx_list *states, struct fx_list *set)
+{
+	uint16_t *nfa;
+	struct fx_list *pending, *ta;
+	int i, k, t, n = 0, size = states->len, result = -1;
+
+	nfa = malloc(size * sizeof(*nfa));
+	pending = calloc(size, sizeof(*pending));
+	if (nfa == NULL || pending == NULL)
+		goto out;
+	for (n = 0; n < states->len; n++) {
+		nfa[n] = states->v[n];
+		lz->index[nfa[n]] = n;
+	}
+
+	/* the states are processed in the order they are found */
+	for (i = 0; i < n; i++) {
+		for (t = schema->keys_offsets[nfa[i]]; t < schema->keys_offsets[nfa[i] + 1]; t++) {
+			uint16_t target = schema->targets[t];
+			int found = lz->index[target] >= 0;
+			if (schema->keys[t] != FX_EPSILON)
+				continue;
+			if (!found) {
+				if (n == size) {
+					uint16_t *v = realloc(nfa, 2 * size * sizeof(*nfa));
+					struct fx_list *l;
+					if (v == NULL)
+						goto out;
+					nfa = v;
+					if ((l = realloc(pending, 2 * size * sizeof(*pending))) == NULL)
+						goto out;
+					pending = l;
+					memset(pending + size, 0, size * sizeof(*pending));
+					size *= 2;
+				}
+				/* a new state starts with the actions pending on the state it is reached from */
+				lz->index[target] = n;
+				nfa[n] = target;
+				for (k = 0; k < pending[i].len; k++)
+					if (fx_list_add(&pending[n], pending[i].v[k]) < 0) {
+						n++;
+						goto out;
+					}
+				n++;
+			}
+			/* counter operations are executed on every occurrence along the
+			 * first path to a state, other actions once on any path */
+			ta = &pending[lz->index[target]];
+			for (k = schema->actions_offsets[t]; k < fx_actions_end(schema, t); k++) {
+				uint16_t a = schema->actions[k];
+				if (schema->counters != NULL && schema->counters[a].op != FX_COUNTER_NONE ? found : fx_list_contains(ta, a))
+					continue;
+				if (fx_list_add(ta, a) < 0)
+					goto out;
+			}
+		}
+	}
+
+	set->len = 0;
+	for (i = 0; i < n; i++) {
+		if (fx_list_add(set, nfa[i]) < 0 || fx_list_add(set, pending[i].len) < 0)
+			goto out;
+		for (k = 0; k < pending[i].len; k++)
+			if (fx_list_add(set, pending[i].v[k]) < 0)
+				goto out;
+	}
+	result = 0;
+
+out:
+	for (i = 0; i < n; i++) {
+		lz->index[nfa[i]] = -1;
+		free(pending[i].v);
+	}
+	free(nfa);
+	free(pending);
+	return result;
+}
+
+/* computes the finality and the keys of a new state from its set */
+static int fx_lazy_row(struct fx_lazy *lz, const fx_schema *schema, struct fx_lazy_state *ls)
+{
+	struct fx_list labels = {NULL, 0, 0}, *actions = NULL, *l;
+	int pos, i, k, t, total, result = -1;
+	const uint16_t *set = ls->set;
+
+	ls->final = 0;
+	for (pos = 0; pos < ls->set_len; pos += 2 + set[pos + 1]) {
+		int state = set[pos];
+		if (state >= schema->first_final)
+			ls->final = 1;
+		for (t = schema->keys_offsets[state]; t < schema->keys_offsets[state + 1]; t++) {
+			uint16_t label = schema->keys[t];
+			if (label == FX_EPSILON)
+				continue;
+			if (lz->labels[label] < 0) {
+				/* the actions pending on the first state with the label */
+				if ((l = realloc(actions, (labels.len + 1) * sizeof(*actions))) == NULL)
+					goto out;
+				actions = l;
+				actions[labels.len] = (struct fx_list){NULL, 0, 0};
+				lz->labels[label] = labels.len;
+				if (fx_list_add(&labels, label) < 0)
+					goto out;
+				for (k = 0; k < set[pos + 1]; k++)
+					if (fx_list_add(&actions[labels.len - 1], set[pos + 2 + k]) < 0)
+						goto out;
+			}
+			l = &actions[lz->labels[label]];
+			for (k = schema->actions_offsets[t]; k < fx_actions_end(schema, t); k++)
+				if (fx_list_add(l, schema->actions[k]) < 0)
+					goto out;
 		}
-		ev_type = xmlTextReaderNodeType(rd);
 	}
 
+	for (total = 0, i = 0; i < labels.len; i++)
+		total += actions[i].len;
+	ls->keys = malloc((labels.len + 1) * sizeof(*ls->keys));
+	ls->actions = malloc((total + 1) * sizeof(*ls->actions));
+	ls->actions_offsets = malloc((labels.len + 1) * sizeof(*ls->actions_offsets));
+	ls->targets = malloc((labels.len + 1) * sizeof(*ls->targets));
+	ls->generations = malloc((labels.len + 1) * sizeof(*ls->generations));
+	if (ls->keys == NULL || ls->actions == NULL || ls->actions_offsets == NULL ||
+	    ls->targets == NULL || ls->generations == NULL)
+		goto out;
+	qsort(labels.v, labels.len, sizeof(*labels.v), fx_cmp_u16);
+	ls->actions_offsets[0] = 0;
+	for (i = 0; i < labels.len; i++) {
+		l = &actions[lz->labels[labels.v[i]]];
+		ls->keys[i] = labels.v[i];
+		memcpy(ls->actions + ls->actions_offsets[i], l->v, l->len * sizeof(*l->v));
+		ls->actions_offsets[i + 1] = ls->actions_offsets[i] + l->len;
+		ls->targets[i] = -1;
+	}
+	ls->nkeys = labels.len;
+	result = 0;
+
+out:
+	for (i = 0; i < labels.len; i++) {
+		lz->labels[labels.v[i]] = -1;
+		free(actions[i].v);
+	}
+	free(actions);
+	free(labels.v);
+	return result;
+}
+
+/* whether the stack of p refers to the state in slot */
+static int fx_lazy_pinned(const struct fx_parser *p, const struct fx_interned *in, int slot)
+{
+	int i;
+	for (i = 0; i <= p->sp; i++)
+		if (p->ss[i].in == in && p->ss[i].state == slot)
+			return 1;
+	return 0;
+}
+
+/* returns an empty slot, evicting the least recently used state if the cache
+ * is full, or -1 if out of memory
+ */
+static int fx_lazy_slot(const struct fx_parser *p, const struct fx_interned *in)
+{
+	struct fx_lazy *lz = in->lazy;
+	struct fx_lazy_state *ls;
+	int i, size, victim = -1, *link;
+	uint32_t generation;
+
+	if (lz->nslots == lz->size && lz->size < (int)in->schema->lazy) {
+		size = lz->size ? 2 * lz->size : 16;
+		if (size > (int)in->schema->lazy)
+			size = in->schema->lazy;
+		if ((ls = realloc(lz->slots, size * sizeof(*ls))) == NULL)
+			return -1;
+		lz->slots = ls;
+		lz->size = size;
+	}
+	if (lz->nslots == lz->size) {
+		for (i = 0; i < lz->nslots; i++)
+			if ((victim < 0 || lz->slots[i].used < lz->slots[victim].used) && !fx_lazy_pinned(p, in, i))
+				victim = i;
+		if (victim >= 0) {
+			ls = &lz->slots[victim];
+			for (link = &lz->buckets[ls->hash & lz->mask]; *link != victim; link = &lz->slots[*link].next);
+			*link = ls->next;
+			fx_lazy_state_free(ls);
+			generation = ls->generation + 1;
+			memset(ls, 0, sizeof(*ls));
+			ls->generation = generation;
+			return victim;
+		}
+		/* every cached state is on the stack */
+		if ((ls = realloc(lz->slots, 2 * lz->size * sizeof(*ls))) == NULL)
+			return -1;
+		lz->slots = ls;
+		lz->size *= 2;
+	}
+	memset(&lz->slots[lz->nslots], 0, sizeof(*ls));
+	return lz->nslots++;
+}
+
+/* returns the slot of the state with the given set, adding the state if it is
+ * not cached, or -1 if out of memory.  The set is taken over.
+ */
+static int fx_lazy_lookup(const struct fx_parser *p, const struct fx_interned *in, struct fx_list *set)
+{
+	struct fx_lazy *lz = in->lazy;
+	struct fx_lazy_state *ls;
+	uint32_t h = fx_set_hash(set->v, set->len);
+	int slot;
+
+	for (slot = lz->buckets[h & lz->mask]; slot >= 0; slot = lz->slots[slot].next) {
+		ls = &lz->slots[slot];
+		if (ls->hash == h && ls->set_len == set->len && memcmp(ls->set, set->v, set->len * sizeof(*set->v)) == 0) {
+			free(set->v);
+			return slot;
+		}
+	}
+	if ((slot = fx_lazy_slot(p, in)) < 0) {
+		free(set->v);
+		return -1;
+	}
+	ls = &lz->slots[slot];
+	ls->set = set->v;
+	ls->set_len = set->len;
+	ls->hash = h;
+	ls->used = ++lz->clock;
+	ls->next = lz->buckets[h & lz->mask];
+	lz->buckets[h & lz->mask] = slot;
+	FX_TRACE_AT(2, "  new DFA state %d of %d NFA entries\n", slot, set->len);
+	return fx_lazy_row(lz, in->schema, ls) < 0 ? -1 : slot;
+}
+
+/* the state the NFA of in starts in */
+static int fx_lazy_start(const struct fx_parser *p, const struct fx_interned *in)
+{
+	struct fx_list start = {NULL, 0, 0}, set = {NULL, 0, 0};
+	int result;
+
+	if (fx_list_add(&start, in->schema->start) < 0)
+		return -1;
+	result = fx_closure(in->lazy, in->schema, &start, &set);
+	free(start.v);
+	if (result < 0) {
+		free(set.v);
+		return -1;
+	}
+	return fx_lazy_lookup(p, in, &set);
+}
+
+/* the target of key of the state in slot, which has to be on the stack */
+static int fx_lazy_target(const struct fx_parser *p, const struct fx_interned *in, int slot, int key)
+{
+	struct fx_lazy *lz = in->lazy;
+	const fx_schema *schema = in->schema;
+	struct fx_lazy_state *ls = &lz->slots[slot];
+	struct fx_list targets = {NULL, 0, 0}, set = {NULL, 0, 0};
+	uint16_t label = ls->keys[key];
+	int i, pos, t, target, result = 0;
+
+	target = ls->targets[key];
+	if (target >= 0 && lz->slots[target].generation == ls->generations[key])
+		return target;
+
+	/* the distinct NFA states reached on the label, in the order of the set */
+	for (pos = 0; pos < ls->set_len && result == 0; pos += 2 + ls->set[pos + 1])
+		for (t = schema->keys_offsets[ls->set[pos]]; t < schema->keys_offsets[ls->set[pos] + 1]; t++)
+			if (schema->keys[t] == label && lz->index[schema->targets[t]] < 0) {
+				lz->index[schema->targets[t]] = 0;
+				if ((result = fx_list_add(&targets, schema->targets[t])) < 0)
+					break;
+			}
+	for (i = 0; i < targets.len; i++)
+		lz->index[targets.v[i]] = -1;
+	if (result == 0)
+		result = fx_closure(lz, schema, &targets, &set);
+	free(targets.v);
+	if (result < 0) {
+		free(set.v);
+		return -1;
+	}
+	if ((target = fx_lazy_lookup(p, in, &set)) < 0)
+		return -1;
+	/* the slots may have moved */
+	ls = &lz->slots[slot];
+	ls->targets[key] = target;
+	ls->generations[key] = lz->slots[target].generation;
+	return target;
+}
+
+static void fx_intern_free(struct fx_interned *in)
+{
+	free(in->names);
+	free(in->namespaces);
+	free(in->sorted);
+	free(in->hash);
+	free(in->specials);
+	fx_lazy_free(in->lazy);
+}
+
+/* returns the profile of schema, creating it if seen the first time, or NULL
+ * if out of memory
+ */
+static struct fx_profile *fx_profile(const fx_schema *schema)
+{
+	int i;
+	struct fx_profile *p = NULL, **profiles;
+
+	/* documents may be started by several threads at once */
+	pthread_mutex_lock(&fx_profiles_lock);
+	for (i = 0; i < fx_nprofiles; i++)
+		if (fx_profiles[i]->schema == schema) {
+			p = fx_profiles[i];
+			goto out;
+		}
+	if ((profiles = realloc(fx_profiles, (fx_nprofiles + 1) * sizeof(*profiles))) == NULL)
+		goto out;
+	fx_profiles = profiles;
+	if ((p = malloc(sizeof(*p))) == NULL)
+		goto out;
+	p->states = calloc(schema->states_len, sizeof(uint64_t));
+	p->transitions = calloc(schema->keys_offsets[schema->states_len], sizeof(uint64_t));
+	if (p->states == NULL || p->transitions == NULL) {
+		free(p->states);
+		free(p->transitions);
+		free(p);
+		p = NULL;
+		goto out;
+	}
+	p->schema = schema;
+	fx_profiles[fx_nprofiles++] = p;
+out:
+	pthread_mutex_unlock(&fx_profiles_lock);
+	return p;
+}
+
+/* documents started while profiling is enabled count their state and
+ * transition hits
+ */
+void fx_profile_enable(int enable)
+{
+	fx_profiling = enable;
+}
+
+/* writes the hit counts for xsdcc.py --profile: a line
+ *   schema <root element> states <states_len> transitions <transitions>
+ * for every schema, followed by "state <state> <hits>" and
+ * "transition <transition> <hits>" lines for every state and transition hit
+ */
+int fx_profile_dump(FILE *out)
+{
+	int i, k;
+	uint32_t t;
+
+	pthread_mutex_lock(&fx_profiles_lock);
+	for (i = 0; i < fx_nprofiles; i++) {
+		const struct fx_profile *p = fx_profiles[i];
+		const fx_schema *schema = p->schema;
+		const xmlChar *name = BAD_CAST "-", *ns = BAD_CAST "";
+
+		/* a schema is named after the element accepted by its start state */
+		for (k = schema->keys_offsets[schema->start]; k < schema->keys_offsets[schema->start + 1]; k++)
+			if (schema->keys[k] != 0) {
+				name = schema->elements[schema->keys[k]].localname;
+				if (schema->namespaces != NULL)
+					ns = schema->namespaces[schema->elements[schema->keys[k]].namespaceId];
+				break;
+			}
+		fprintf(out, "schema %s%s%s%s states %d transitions %d\n", ns[0] ? "{" : "", ns, ns[0] ? "}" : "", name,
+		        schema->states_len, schema->keys_offsets[schema->states_len]);
+		for (t = 1; t < schema->states_len; t++)
+			if (p->states[t])
+				fprintf(out, "state %u %" PRIu64 "\n", t, p->states[t]);
+		for (t = 0; t < schema->keys_offsets[schema->states_len]; t++)
+			if (p->transitions[t])
+				fprintf(out, "transition %u %" PRIu64 "\n", t, p->transitions[t]);
+	}
+	pthread_mutex_unlock(&fx_profiles_lock);
+	return ferror(out) ? -1 : 0;
+}
+
+/* releases the hit counts, no document may be parsed while doing so */
+void fx_profile_free(void)
+{
+	int i;
+	for (i = 0; i < fx_nprofiles; i++) {
+		free(fx_profiles[i]->states);
+		free(fx_profiles[i]->transitions);
+		free(fx_profiles[i]);
+	}
+	free(fx_profiles);
+	fx_profiles = NULL;
+	fx_nprofiles = 0;
+}
+
+static const xmlChar *fx_string(const struct fx_parser *p, const xmlChar *str)
+{
+	if (p->rd != NULL)
+		return xmlTextReaderConstString(p->rd, str);
+	return xmlDictLookup(p->dict, str, -1);
+}
+
+static int fx_intern(const struct fx_parser *p, const fx_schema *schema, struct fx_interned *in)
+{
+	int i, k;
+	uint32_t h;
+
+	memset(in, 0, sizeof(*in));
+	in->schema = schema;
+	for (in->hash_mask = 1; in->hash_mask < 2u * schema->elements_len; in->hash_mask <<= 1);
+	in->names = malloc(schema->elements_len * sizeof(xmlChar *));
+	in->sorted = calloc(schema->states_len, 1);
+	in->hash = calloc(in->hash_mask, sizeof(uint16_t));
+	in->hash_mask--;
+	in->specials = malloc(schema->elements_len * sizeof(uint16_t));
+	/* the hit counts refer to DFA states and transitions */
+	in->profile = fx_profiling && !schema->lazy ? fx_profile(schema) : NULL;
+	if (schema->namespaces != NULL)
+		in->namespaces = malloc(schema->elements_len * sizeof(xmlChar *));
+	if (schema->lazy)
+		in->lazy = fx_lazy_new(schema);
+	if (in->names == NULL || in->sorted == NULL || in->hash == NULL || in->specials == NULL ||
+	    (schema->namespaces != NULL && in->namespaces == NULL) || (schema->lazy && in->lazy == NULL)) {
+		fx_intern_free(in);
+		return -1;
+	}
+
+	for (i = 0; i < schema->elements_len; i++) {
+		const xmlChar *ns;
+		in->names[i] = fx_string(p, schema->elements[i].localname);
+		if (in->namespaces != NULL) {
+			ns = schema->namespaces[schema->elements[i].namespaceId];
+			in->namespaces[i] = ns[0] == '\0' ? NULL : fx_string(p, ns);
+		}
+		if (in->names[i] == NULL || (in->namespaces != NULL && ns[0] != '\0' && in->namespaces[i] == NULL)) {
+			fx_intern_free(in);
+			return -1;
+		}
+		for (h = fx_hash(in->names[i], in->hash_mask); in->hash[h]; h = (h + 1) & in->hash_mask);
+		in->hash[h] = i + 1;
+		if (in->names[i][0] == '*' || in->names[i][0] == '!')
+			in->specials[in->nspecials++] = i;
+	}
+
+	for (i = 1; i < schema->states_len && !schema->lazy; i++) {
+		const uint16_t *keys = schema->keys + schema->keys_offsets[i];
+		int len = schema->keys_offsets[i + 1] - schema->keys_offsets[i];
+		in->sorted[i] = len > FX_LINEAR_KEYS;
+		for (k = 0; k < len && in->sorted[i]; k++)
+			if ((k > 0 && keys[k] <= keys[k - 1]) || in->names[keys[k]][0] == '*' || in->names[keys[k]][0] == '!')
+				in->sorted[i] = 0;
+	}
+	return 0;
+}
+
+/* returns the interned table of schema, interning it if seen the first time */
+static const struct fx_interned *fx_interned(struct fx_parser *p, const fx_schema *schema)
+{
+	int i;
+	struct fx_interned *in, **interned;
+
+	for (i = 0; i < p->ninterned; i++)
+		if (p->interned[i]->schema == schema)
+			return p->interned[i];
+	if ((interned = realloc(p->interned, (p->ninterned + 1) * sizeof(*interned))) == NULL)
+		return NULL;
+	p->interned = interned;
+	if ((in = malloc(sizeof(*in))) == NULL)
+		return NULL;
+	if (fx_intern(p, schema, in) < 0) {
+		free(in);
+		return NULL;
+	}
+	p->interned[p->ninterned++] = in;
+	return in;
+}
+
+/* the machine to invoke for the element name:ns on the '!' key id */
+static const fx_schema *fx_invoked(const struct fx_interned *in, const fx_schema *schema, int id,
+                                   const xmlChar *name, const xmlChar *ns)
+{
+	return lookupSubstitution(ns, name, schema->namespaces != NULL ?
+	                          schema->namespaces[schema->elements[id].namespaceId] : NULL,
+	                          in->names[id] + 1);
+}
+
+/* transition of state on element id in the dense layout, or -1 */
+static int fx_dense(const struct fx_dense *d, int state, int id)
+{
+	uint32_t i = d->base[d->rows[state]] + d->classes[id];
+	return d->check[i] == d->rows[state] ? d->next[i] : -1;
+}
+
+/* transition of state on an element in the dense layout, or -1, the id of
+ * the matched element is stored in matched.  Like the keys of a sparse
+ * state, which are ordered by id, the key with the lowest id matching the
+ * element wins, so wildcards and substitution groups registered before
+ * the element take precedence over an exact match.
+ */
+static int fx_dense_match(const struct fx_interned *in, const fx_schema *schema, int state,
+                          const xmlChar *name, const xmlChar *ns, const fx_schema **schemaToInvoke, int *matched)
+{
+	uint32_t h;
+	int i, id, t, exact = -1, exact_t = -1;
+
+	for (h = fx_hash(name, in->hash_mask); in->hash[h]; h = (h + 1) & in->hash_mask) {
+		id = in->hash[h] - 1;
+		if (in->names[id] == name && (in->namespaces == NULL || in->namespaces[id] == ns))
+			if ((t = fx_dense(schema->dense, state, id)) >= 0) {
+				exact = id;
+				exact_t = t;
+				break;
+			}
+	}
+	/* the specials are ordered by id, only those before the exact match
+	 * are tried */
+	for (i = 0; i < in->nspecials && (exact < 0 || in->specials[i] < exact); i++) {
+		id = in->specials[i];
+		if ((t = fx_dense(schema->dense, state, id)) < 0)
+			continue;
+		if (in->names[id][0] == '*') {
+			*matched = id;
+			return t;
+		}
+		if ((*schemaToInvoke = fx_invoked(in, schema, id, name, ns)) != NULL) {
+			*matched = id;
+			return t;
+		}
+	}
+	*matched = exact;
+	return exact_t;
+}
+
+/* index of the key matching name in a sorted state, or -1 */
+static int fx_find(const struct fx_interned *in, const uint16_t *keys, int len, const xmlChar *name, const xmlChar *ns)
+{
+	uint32_t h;
+	int lo, hi, mid, id;
+
+	for (h = fx_hash(name, in->hash_mask); in->hash[h]; h = (h + 1) & in->hash_mask) {
+		id = in->hash[h] - 1;
+		if (in->names[id] != name || (in->namespaces != NULL && in->namespaces[id] != ns))
+			continue;
+		for (lo = 0, hi = len - 1; lo <= hi; ) {
+			mid = (lo + hi) / 2;
+			if (keys[mid] == id)
+				return mid;
+			if (keys[mid] < id)
+				lo = mid + 1;
+			else
+				hi = mid - 1;
+		}
+	}
+	return -1;
+}
+
+/* the dense layout shares transitions with equal target and actions between
+ * states, returns the transition of state on element id itself
+ */
+static int fx_own_transition(const fx_schema *schema, int state, int id, int trans)
+{
+	int t;
+	for (t = schema->keys_offsets[state]; t < schema->keys_offsets[state + 1]; t++)
+		if (schema->keys[t] == id)
+			return t;
+	return trans;
+}
+
+static void fx_parser_free(struct fx_parser *p)
+{
+	int i;
+	for (i = 0; i < p->ninterned; i++) {
+		fx_intern_free(p->interned[i]);
+		free(p->interned[i]);
+	}
+	free(p->interned);
+	free(p->ss);
+	free(p->counters);
+}
+
+/* pushes an invocation of schema, growing the stack if it is full */
+static int fx_parser_push(struct fx_parser *p, const fx_schema *schema)
+{
+	const struct fx_interned *in;
+	struct stack *ss;
+	int start = schema->start;
+
+	if ((in = fx_interned(p, schema)) == NULL)
+		return -1;
+	if (p->sp + 1 == p->stack_size) {
+		if ((ss = realloc(p->ss, 2 * p->stack_size * sizeof(*ss))) == NULL)
+			return -1;
+		p->ss = ss;
+		p->stack_size *= 2;
+	}
+	if (in->lazy != NULL && (start = fx_lazy_start(p, in)) < 0)
+		return -1;
+	p->ss[p->sp + 1] = (struct stack){schema, start, p->ss[p->sp].result, in};
+	p->sp++;
+	return 0;
+}
+
+static int fx_parser_init(struct fx_parser *p, const fx_schema *schema, xmlTextReaderPtr rd, xmlDictPtr dict)
+{
+	const struct fx_interned *in;
+
+	p->rd = rd;
+	p->dict = dict;
+	p->interned = NULL;
+	p->ninterned = 0;
+	p->hook = NULL;
+	p->hook_data = NULL;
+	p->events = 0;
+	p->csp = -1;
+	p->counters_size = FX_COUNTERS_SIZE;
+	if ((p->counters = malloc(p->counters_size * sizeof(*p->counters))) == NULL)
+		return -1;
+	p->sp = 0;
+	p->stack_size = FX_STACK_SIZE;
+	if ((p->ss = malloc(p->stack_size * sizeof(*p->ss))) == NULL) {
+		free(p->counters);
+		return -1;
+	}
+	if ((in = fx_interned(p, schema)) == NULL) {
+		fx_parser_free(p);
+		return -1;
+	}
+	p->ss[p->sp] = (struct stack){schema, schema->start, NULL, in};
+	if (in->lazy != NULL) {
+		p->ss[p->sp].state = -1;
+		if ((p->ss[p->sp].state = fx_lazy_start(p, in)) < 0) {
+			fx_parser_free(p);
+			return -1;
+		}
+	}
+	return 0;
+}
+
+/* whether the machine of a stack entry is in a final state */
+static int fx_final(const struct stack *s)
+{
+	if (s->in->lazy != NULL)
+		return s->in->lazy->slots[s->state].final;
+	return s->state >= s->schema->first_final;
+}
+
+/* whether the document may end in the current state */
+static int fx_parser_final(const struct fx_parser *p)
+{
+	return fx_final(&p->ss[p->sp]);
+}
+
+/* feeds one element event into the state machines, localname and ns must be
+ * interned in the same dictionary as the schemas.  Returns -1 if the event
+ * is not accepted.
+ */
+static int fx_step(struct fx_parser *p, xmlReaderTypes ev_type, const xmlChar *localname, const xmlChar *ns)
+{
+	int i, trans, keys_len, actions_len, target, matched = 0;
+	const uint16_t *keys, *actions;
+	const fx_schema *schema;
+	const struct fx_interned *in;
+	const fx_schema *schemaToInvoke = NULL;
+	struct fx_lazy_state *ls;
+	int *state;
+
 dispatch:
-	schema = stack.ss[stack.sp].schema;
-	int *state = &(stack.ss[stack.sp].state);
-	keys_len = schema->keys_offsets[*state + 1] - schema->keys_offsets[*state];
-	keys     = schema->keys + schema->keys_offsets[*state];
+	schema = p->ss[p->sp].schema;
+	in = p->ss[p->sp].in;
+	state = &(p->ss[p->sp].state);
+	if (in->lazy != NULL) {
+		ls = &in->lazy->slots[*state];
+		ls->used = ++in->lazy->clock;
+		keys_len = ls->nkeys;
+		keys     = ls->keys;
+	} else {
+		keys_len = schema->keys_offsets[*state + 1] - schema->keys_offsets[*state];
+		keys     = schema->keys + schema->keys_offsets[*state];
+	}
+
+	if (in->profile != NULL)
+		in->profile->states[*state]++;
 
-	printf("State %d accepts:\n", *state);
+#if FX_TRACE >= 2
+	FX_TRACE_AT(2, "State %d accepts:\n", *state);
 	for (i=0; i < keys_len; i++) {
 		const xmlChar *keyname = schema->elements[keys[i]].localname;
-		printf("  %s -> %d,", keyname, schema->targets[keys - schema->keys + i]);
+		FX_TRACE_AT(2, "  %s -> %d,", keyname, in->lazy != NULL ? in->lazy->slots[*state].targets[i] :
+		            schema->targets[keys - schema->keys + i]);
 	}
-	puts("\n");
+	FX_TRACE_AT(2, "\n\n");
+#endif
 
 	switch (ev_type) {
-	case XML_READER_TYPE_ELEMENT: {
+	case XML_READER_TYPE_ELEMENT:
 		/* an element name can match a known element,
 		 * a member of a substitution group or a wildcard
 		 */
-		fake_close = xmlTextReaderIsEmptyElement(rd);
-		const xmlChar *localname = xmlTextReaderConstLocalName(rd);
-		printf("Element OPEN %s\n", localname);
+		FX_TRACE_AT(1, "Element OPEN %s\n", localname);
+		if (schema->dense != NULL) {
+			if ((i = fx_dense_match(in, schema, *state, localname, ns, &schemaToInvoke, &matched)) < 0)
+				goto error;
+			keys = schema->keys + i;
+			goto match;
+		}
+		if (in->lazy == NULL && in->sorted[*state]) {
+			if ((i = fx_find(in, keys, keys_len, localname, ns)) < 0)
+				goto error;
+			keys += i;
+			goto match;
+		}
 		for (i=keys_len; i > 0; i--, keys++) {
-			const xmlChar *keyname = schema->elements[*keys].localname;
-			printf("  comparing with %s\n", keyname);
+			const xmlChar *keyname = in->names[*keys];
+			FX_TRACE_AT(2, "  comparing with %s\n", keyname);
 			switch (keyname[0]) {
 			case '/':
 				continue;
@@ -93,73 +1491,232 @@ dispatch:
 				break;
 			case '!':
 				// substitution group
-				if ((schemaToInvoke = lookupSubstitution(localname + 1)) != NULL)
+				if ((schemaToInvoke = fx_invoked(in, schema, *keys, localname, ns)) != NULL)
 					goto match;
 				break;
 			default:
-				// normal element
-				if (xmlStrcmp(localname, keyname) == 0)
+				// normal element, names are interned in the reader's dictionary
+				if (localname == keyname && (in->namespaces == NULL || in->namespaces[*keys] == ns))
 					goto match;
 			}
 		}
-		}
 		goto error;
 
 	case XML_READER_TYPE_END_ELEMENT:
 		/* if element close is supported it is the first in the list
 		 * and has ID=0
 		 */
-		printf("Element CLOSE %s\n", xmlTextReaderConstLocalName(rd));
+		FX_TRACE_AT(1, "Element CLOSE %s\n", localname);
+		if (schema->dense != NULL) {
+			if ((i = fx_dense(schema->dense, *state, 0)) < 0)
+				goto error;
+			matched = 0;
+			keys = schema->keys + i;
+			break;
+		}
 		if (keys_len < 1 || *keys != 0)
 			goto error;
 		break;
 
-	case XML_READER_TYPE_TEXT:
-	case XML_READER_TYPE_CDATA:
-		printf("Text: %s\n", xmlTextReaderConstValue(rd));
-
 	default:
 		/* any other event is unsupported and does nothing */
-		goto read;
+		return 0;
 	}
 
 match:
 	/* found match, execute associated actions */
-	trans = keys - schema->keys;
-	printf("Executing actions for transition %d: ", trans);
-/*	for(i=0; i < schema->actions_offsets[trans + 1] - schema->actions_offsets[trans]; i++)
-		printf("%d, ", schema->actions[schema->actions_offsets[trans] + i]);
+	if (in->lazy != NULL) {
+		/* transitions of lazy states are numbered within their state */
+		trans = keys - in->lazy->slots[*state].keys;
+		if ((target = fx_lazy_target(p, in, *state, trans)) < 0)
+			return -1;
+		ls = &in->lazy->slots[*state];
+		actions_len = ls->actions_offsets[trans + 1] - ls->actions_offsets[trans];
+		actions     = ls->actions + ls->actions_offsets[trans];
+	} else {
+		trans = keys - schema->keys;
+		if (in->profile != NULL)
+			in->profile->transitions[schema->dense != NULL ? fx_own_transition(schema, *state, matched, trans) : trans]++;
+		actions_len = fx_actions_end(schema, trans) - schema->actions_offsets[trans];
+		actions     = schema->actions + schema->actions_offsets[trans];
+		target      = schema->targets[trans];
+	}
+	FX_TRACE_AT(1, "Executing actions for transition %d: ", trans);
+/*	for(i=0; i < actions_len; i++)
+		printf("%d, ", actions[i]);
 	puts("\n");
 */
-	schema->do_actions(schema->actions_offsets[trans + 1] - schema->actions_offsets[trans],
-                       schema->actions + schema->actions_offsets[trans]);
-	*state = schema->targets[trans];
-	printf("  go into state %d\n", *state);
+	/* a transition violating an occurrence bound is not taken */
+	if (schema->counters != NULL &&
+	    fx_count(p, schema->counters, actions_len, actions) < 0) {
+		FX_TRACE_AT(1, "  occurrence bound violated\n");
+		return -1;
+	}
+	if (p->hook != NULL)
+		p->hook(p->hook_data, p->events, actions_len, actions);
+	else
+		schema->do_actions(actions_len, actions);
+	*state = target;
+	FX_TRACE_AT(1, "  go into state %d\n", *state);
 
 	if (schemaToInvoke != NULL) {
-		stack.ss[++stack.sp] = (struct stack){schemaToInvoke, schemaToInvoke->start, stack.ss[stack.sp].result};
+		if (fx_parser_push(p, schemaToInvoke) < 0)
+			return -1;
 		if (schemaToInvoke->type) {
 			schemaToInvoke = NULL;
 			goto dispatch;
 		}
 	}
-	schemaToInvoke = NULL;
-	goto read;
-
-fsm_return:
-	stack.sp--;
-	goto read;
+	p->events++;
+	return 0;
 
 error:
-	/* we need to check if it is a real error */
-	if (*state >= schema->first_final && stack.sp > 0)
-		goto fsm_return;
+	/* a sub-machine in a final state returns, the event belongs to its caller */
+	if (fx_final(&p->ss[p->sp]) && p->sp > 0) {
+		p->sp--;
+		goto dispatch;
+	}
+	return -1;
+}
+
+int fx_parse_xml(xmlTextReaderPtr rd, const fx_schema *schema)
+{
+	return fx_parse_xml_actions(rd, schema, NULL, NULL);
+}
+
+/* like fx_parse_xml, but the actions of every transition are passed to hook
+ * along with the index of the element event, if hook is not NULL
+ */
+int fx_parse_xml_actions(xmlTextReaderPtr rd, const fx_schema *schema, fx_action_hook hook, void *data)
+{
+	int ret, result;
+	struct fx_parser p;
+
+	if (fx_parser_init(&p, schema, rd, NULL) < 0)
+		return -1;
+	p.hook = hook;
+	p.hook_data = data;
+
+	/* stops at EOF or on an I/O error as well as on rejected events */
+	while ((ret = xmlTextReaderRead(rd)) == 1) {
+		const xmlChar *localname = xmlTextReaderConstLocalName(rd);
+		const xmlChar *ns = xmlTextReaderConstNamespaceUri(rd);
+
+		switch (xmlTextReaderNodeType(rd)) {
+		case XML_READER_TYPE_ELEMENT:
+			if (fx_step(&p, XML_READER_TYPE_ELEMENT, localname, ns) < 0)
+				goto out;
+			/* empty elements have no separate close event */
+			if (xmlTextReaderIsEmptyElement(rd) &&
+			    fx_step(&p, XML_READER_TYPE_END_ELEMENT, localname, ns) < 0)
+				goto out;
+			break;
+		case XML_READER_TYPE_END_ELEMENT:
+			if (fx_step(&p, XML_READER_TYPE_END_ELEMENT, localname, ns) < 0)
+				goto out;
+			break;
+		case XML_READER_TYPE_TEXT:
+		case XML_READER_TYPE_CDATA:
+			FX_TRACE_AT(2, "Text: %s\n", xmlTextReaderConstValue(rd));
+			break;
+		default:
+			break;
+		}
+	}
+
+out:
+	result = !(ret == 0 && fx_parser_final(&p));
+	fx_parser_free(&p);
+	return result;
+}
+
+static void fx_push_start(void *ctx, const xmlChar *localname, const xmlChar *prefix, const xmlChar *URI,
+                          int nb_namespaces, const xmlChar **namespaces,
+                          int nb_attributes, int nb_defaulted, const xmlChar **attributes)
+{
+	struct fx_push *push = ctx;
+	if (fx_step(&push->parser, XML_READER_TYPE_ELEMENT, localname, URI) < 0) {
+		push->failed = 1;
+		xmlStopParser(push->ctxt);
+	}
+}
+
+static void fx_push_end(void *ctx, const xmlChar *localname, const xmlChar *prefix, const xmlChar *URI)
+{
+	struct fx_push *push = ctx;
+	if (fx_step(&push->parser, XML_READER_TYPE_END_ELEMENT, localname, URI) < 0) {
+		push->failed = 1;
+		xmlStopParser(push->ctxt);
+	}
+}
+
+static void fx_push_text(void *ctx, const xmlChar *ch, int len)
+{
+	FX_TRACE_AT(2, "Text: %.*s\n", len, ch);
+}
+
+/* creates the context for parsing one document from chunks with
+ * fx_push_chunk, or NULL if out of memory
+ */
+fx_push *fx_push_new(const fx_schema *schema)
+{
+	xmlSAXHandler sax;
+	struct fx_push *push;
+
+	if ((push = malloc(sizeof(*push))) == NULL)
+		return NULL;
+	push->failed = 0;
+
+	/* only the element events are handled, so no tree is built */
+	memset(&sax, 0, sizeof(sax));
+	sax.initialized = XML_SAX2_MAGIC;
+	sax.startElementNs = fx_push_start;
+	sax.endElementNs = fx_push_end;
+	sax.characters = fx_push_text;
+	sax.cdataBlock = fx_push_text;
+	if ((push->ctxt = xmlCreatePushParserCtxt(&sax, push, NULL, 0, NULL)) == NULL) {
+		free(push);
+		return NULL;
+	}
+	if (fx_parser_init(&push->parser, schema, NULL, push->ctxt->dict) < 0) {
+		xmlFreeParserCtxt(push->ctxt);
+		free(push);
+		return NULL;
+	}
+	return push;
+}
+
+/* parses the next size bytes of the document, terminate marks the last
+ * chunk.  Returns 0 as long as the document is valid and 1 once it is not,
+ * after which the remaining chunks are ignored.
+ */
+int fx_push_chunk(fx_push *push, const char *chunk, int size, int terminate)
+{
+	if (push->failed)
+		return 1;
+	if (xmlParseChunk(push->ctxt, chunk, size, terminate) != 0 || push->failed ||
+	    (terminate && !fx_parser_final(&push->parser))) {
+		push->failed = 1;
+		return 1;
+	}
+	return 0;
+}
 
-IO_error:
-	/* definitive a fatal error ... */
-	return !(ret == 0 && *state >= schema->first_final);
+/* passes the actions of every transition to hook instead of do_actions */
+void fx_push_actions(fx_push *push, fx_action_hook hook, void *data)
+{
+	push->parser.hook = hook;
+	push->parser.hook_data = data;
+}
+
+void fx_push_free(fx_push *push)
+{
+	fx_parser_free(&push->parser);
+	xmlFreeParserCtxt(push->ctxt);
+	free(push);
 }
 
+#ifndef FX_LIBRARY
 const uint16_t test_targets_offsets[] = {
 0, 0, 1, 9, 15, 17, 19, 21, 22, 23, 25, 26, 29, 33, 41, 42, 44, 49, 53, 56, 58, 60, 61, 63, 66, 68, 70, 71, 72, 73, 75, 76, 77, 78, 79, 80, 81, 82, 84, 85, 86, 88, 91, 92, 94, 96, 97, 99, 101, 105, 106, 107, 109, 111, 113, 114, 115, 116, 118, 119, 120, 121, 122, 124, 125, 127, 127
 };
@@ -259,30 +1816,112 @@ const fx_schema testSchema = (fx_schema){
 	test_actions_offsets,
 	test_targets,
 	64,
-	test_do_actions
+	test_do_actions,
+	NULL,
+	NULL,
+	sizeof(test_elements) / sizeof(test_elements[0]),
+	sizeof(test_targets_offsets) / sizeof(test_targets_offsets[0]) - 1,
+	NULL,
+	NULL, NULL, NULL, NULL,
+	0
 };
 
+void print_actions(int len, const uint16_t *actions)
+{
+	int i;
+	for(i=0; i < len; i++)
+		printf("Action %d\n", actions[i]);
+}
+
 int
 main(int argc, char **argv)
 {
-    xmlTextReaderPtr reader;
-    if (argc != 2)
+    xmlTextReaderPtr reader = NULL;
+    const fx_schema *schema = &testSchema;
+    fx_schema **loaded;
+    const char *profile, *root;
+    int i, j, result;
+    if (argc < 2)
         return(1);
 
     LIBXML_TEST_VERSION
 
-    reader = xmlReaderForFile(argv[1], NULL, 0);
-    if (reader == NULL) {
-        fprintf(stderr, "Unable to open %s\n", argv[1]);
+    /* FX_PROFILE names the file to write the hit counts to */
+    profile = getenv("FX_PROFILE");
+    if (profile != NULL)
+        fx_profile_enable(1);
+
+    /* "-" reads the document from stdin with the push parser */
+    if (strcmp(argv[1], "-") != 0) {
+        reader = xmlReaderForFile(argv[1], NULL, 0);
+        if (reader == NULL) {
+            fprintf(stderr, "Unable to open %s\n", argv[1]);
+            return (1);
+        }
+    }
+
+    /* the first tables file is run, all are registered for invocation.
+     * FX_ROOT names the element to run of combined tables, the first one
+     * by default
+     */
+    if ((loaded = calloc(argc, sizeof(*loaded))) == NULL)
         return (1);
+    for (i = 2; i < argc; i++) {
+        if ((loaded[i] = fx_load_schema(argv[i], print_actions)) == NULL) {
+            fprintf(stderr, "Unable to load tables %s\n", argv[i]);
+            return (1);
+        }
+        for (j = 0; j < fx_schema_roots(loaded[i]); j++) {
+            fx_schema *r = fx_schema_root(loaded[i], j);
+            if (r->localname != NULL && fx_register(r) < 0) {
+                fprintf(stderr, "Unable to register tables %s\n", argv[i]);
+                return (1);
+            }
+        }
+    }
+    if (argc > 2) {
+        schema = loaded[2];
+        root = getenv("FX_ROOT");
+        for (j = 0; root != NULL && j < fx_schema_roots(loaded[2]); j++)
+            if (fx_schema_root(loaded[2], j)->localname != NULL &&
+                xmlStrEqual(fx_schema_root(loaded[2], j)->localname, BAD_CAST root))
+                schema = fx_schema_root(loaded[2], j);
     }
 
-    if (fx_parse_xml(reader, &testSchema))
+    if (reader != NULL) {
+        result = fx_parse_xml(reader, schema);
+    } else {
+        char chunk[4096];
+        size_t len;
+        fx_push *push = fx_push_new(schema);
+        if (push == NULL)
+            return (1);
+        do {
+            len = fread(chunk, 1, sizeof(chunk), stdin);
+            result = fx_push_chunk(push, chunk, len, len < sizeof(chunk));
+        } while (result == 0 && len == sizeof(chunk));
+        fx_push_free(push);
+    }
+    if (result)
     	printf("Error parsing document\n");
+    if (profile != NULL) {
+        FILE *out = fopen(profile, "w");
+        if (out == NULL || fx_profile_dump(out) < 0)
+            fprintf(stderr, "Unable to write profile %s\n", profile);
+        if (out != NULL)
+            fclose(out);
+        fx_profile_free();
+    }
+    for (i = 2; i < argc; i++) {
+        for (j = 0; j < fx_schema_roots(loaded[i]); j++)
+            fx_unregister(fx_schema_root(loaded[i], j));
+        fx_free_schema(loaded[i]);
+    }
+    free(loaded);
 
     xmlCleanupParser();
     xmlMemoryDump();
 
     return(0);
 }
-
+#endif
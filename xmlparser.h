@@ -0,0 +1,121 @@
+#ifndef XMLPARSER_H
+#define XMLPARSER_H
+
+#include <stdint.h>
+#include <stdio.h>
+#include <libxml/xmlreader.h>
+
+typedef struct fx_schema fx_schema;
+typedef struct fx_push fx_push;
+
+struct element {
+	uint8_t namespaceId;
+	const xmlChar *localname;
+};
+
+/* occurrence counters for particles with large bounds, indexed by action id */
+enum fx_counter_op {
+	FX_COUNTER_NONE = 0,
+	FX_COUNTER_ENTER,
+	FX_COUNTER_ITERATE,
+	FX_COUNTER_LEAVE
+};
+
+struct fx_counter {
+	uint8_t op;
+	uint32_t bound;		/* 0 means unbounded for FX_COUNTER_ITERATE */
+};
+
+/* initial size of the counter stacks, which grow on demand */
+#define FX_COUNTERS_SIZE 16
+
+/* dense transition lookup: the transition of state s on element e is
+ * next[base[rows[s]] + classes[e]] if the check at that index is rows[s]
+ */
+struct fx_dense {
+	const uint16_t *classes;
+	const uint16_t *rows;
+	const uint16_t *base;
+	const uint16_t *next;
+	const uint16_t *check;
+};
+
+struct fx_schema {
+	int type;				/* 1 if invocations start on the element itself */
+	int start;
+	const struct element *elements;
+	const uint16_t *keys;
+	const uint16_t *keys_offsets;
+	const uint16_t *actions;
+	const uint16_t *actions_offsets;
+	const uint16_t *targets;
+	uint16_t first_final;
+	void (*do_actions)(int, const uint16_t*);
+	const struct fx_counter *counters;
+	const xmlChar *const *namespaces;	/* NULL to match local names only */
+	uint16_t elements_len;
+	uint16_t states_len;			/* entries of keys_offsets - 1 */
+	const struct fx_dense *dense;		/* NULL to search the keys */
+	/* the element the machine is registered for, NULL if none, and the
+	 * head of its substitution group
+	 */
+	const xmlChar *namespace;
+	const xmlChar *localname;
+	const xmlChar *group_namespace;
+	const xmlChar *group;
+	/* if not 0 the tables are an NFA with FX_EPSILON keys, determinized on
+	 * demand while parsing and caching up to this many DFA states
+	 */
+	uint32_t lazy;
+	/* the end of the actions of each transition, whose actions may be a
+	 * suffix of those of another one, NULL if they end where the actions of
+	 * the next transition start
+	 */
+	const uint16_t *actions_ends;
+};
+
+#define FX_EPSILON 0xffff
+
+/* receives the actions of a transition and the index of the element event
+ * taking it, counting open and close events from 0
+ */
+typedef void (*fx_action_hook)(void *data, uint32_t event, int len, const uint16_t *actions);
+
+int fx_parse_xml(xmlTextReaderPtr rd, const fx_schema *schema);
+int fx_parse_xml_actions(xmlTextReaderPtr rd, const fx_schema *schema, fx_action_hook hook, void *data);
+
+/* incremental parsing of documents arriving in chunks, every context holds
+ * the complete state of one document
+ */
+fx_push *fx_push_new(const fx_schema *schema);
+int fx_push_chunk(fx_push *push, const char *chunk, int size, int terminate);
+void fx_push_actions(fx_push *push, fx_action_hook hook, void *data);
+void fx_push_free(fx_push *push);
+
+fx_schema *fx_load_schema(const char *path, void (*do_actions)(int, const uint16_t*));
+void fx_free_schema(fx_schema *schema);
+int fx_schema_roots(const fx_schema *schema);
+fx_schema *fx_schema_root(fx_schema *schema, int i);
+/* machines invoked by '!' keys for provided elements and substitution groups */
+int fx_register(const fx_schema *schema);
+void fx_unregister(const fx_schema *schema);
+const fx_schema *lookupSubstitution(const xmlChar *ns, const xmlChar *localname,
+                                    const xmlChar *head_ns, const xmlChar *head);
+
+/* tracing is compiled in up to level FX_TRACE: 1 traces the events and
+ * transitions, 2 also the states and the compared keys.  The messages go
+ * to the hook if one is set and to stdout otherwise.
+ */
+#ifndef FX_TRACE
+#define FX_TRACE 0
+#endif
+
+typedef void (*fx_trace_hook)(void *data, int level, const char *message);
+void fx_set_trace_hook(fx_trace_hook hook, void *data);
+
+/* hit counts per state and transition of every schema */
+void fx_profile_enable(int enable);
+int fx_profile_dump(FILE *out);
+void fx_profile_free(void);
+
+#endif
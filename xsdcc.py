@@ -2,11 +2,16 @@
 # encoding=UTF-8
 
 from collections import deque
+from itertools import groupby, izip
+from operator import itemgetter
 import libxml2, sys, os, re
 import urlparse, argparse
+import hashlib, tempfile, cPickle, struct, copy
+import multiprocessing, StringIO
+import json, resource, time
 sys.path.append(".")
 sys.setrecursionlimit(10000)
-from fsm import XMLFsm, State
+from fsm import XMLFsm, GlushkovFsm, LazyFsm, CompactFsm, actionTable, repeatableActions, copyCounter
 
 class switch(object):
 	def __init__(self, value):
@@ -26,8 +31,88 @@ class switch(object):
 		else:
 			return False
 
+class SchemaIndex(object):
+	"""The top-level names of a schema file, read without building its tree:
+	its targetNamespace, the (schemaLocation, include) pairs of its includes
+	and imports and the (kind, name, substitution group) triples of its
+	declarations, kind being the name of the declaring element."""
+	__slots__ = ("uri", "targetNamespace", "references", "declarations")
+
+	def __init__(self, uri):
+		self.uri = uri
+		self.targetNamespace = None
+		self.references = []
+		self.declarations = []
+
+	def __getstate__(self):
+		return (self.uri, self.targetNamespace, self.references, self.declarations)
+
+	def __setstate__(self, state):
+		self.uri, self.targetNamespace, self.references, self.declarations = state
+
+def indexSchema(uri):
+	"""Returns the SchemaIndex of the schema file uri, only the children of
+	the schema element are looked at."""
+	index = SchemaIndex(uri)
+	reader = libxml2.newTextReaderFilename(uri)
+	ret = reader.Read()
+	while ret == 1:
+		if reader.NodeType() != 1:
+			ret = reader.Read()
+		elif reader.Depth() == 0:
+			index.targetNamespace = reader.GetAttribute("targetNamespace")
+			ret = reader.Read()
+		else:
+			kind = reader.LocalName()
+			if kind in ("include", "import"):
+				index.references.append((reader.GetAttribute("schemaLocation"), kind == "include"))
+			elif kind in XSCompiler.DECL_TYPES:
+				group = reader.GetAttribute("substitutionGroup")
+				if bool(group):
+					prefix, _, localname = group.rpartition(":")
+					group = "{%s}%s" % (reader.LookupNamespace(prefix or None) or "", localname)
+				index.declarations.append((kind, reader.GetAttribute("name"), group or None))
+			ret = reader.Next()
+	if ret < 0:
+		raise libxml2.treeError("Unable to read %s" % uri)
+	return index
+
+class LazyTable(dict):
+	"""A dictionary filled on demand: looking up a key first loads the schema
+	files listed for it in index."""
+	def __init__(self, load, index, *args):
+		dict.__init__(self, *args)
+		self.load = load
+		self.index = index
+
+	def ensure(self, key):
+		for uri in self.index.get(key, ()):
+			self.load(uri)
+
+	def __contains__(self, key):
+		self.ensure(key)
+		return dict.__contains__(self, key)
+
+	has_key = __contains__
+
+	def __getitem__(self, key):
+		self.ensure(key)
+		return dict.__getitem__(self, key)
+
+	def get(self, key, default=None):
+		self.ensure(key)
+		return dict.get(self, key, default)
+
+
 class XSCompiler:
 	XSC_NS = "urn:application:xsc"
+	TABLES_MAGIC = "FXSM"
+	TABLES_VERSION = 6
+	COUNTER_ACTION = re.compile(r"counter_(enter|iterate|leave)(?:_(\w+))?$")
+	# key of epsilon transitions in the tables of lazily determinized machines
+	EPSILON = 0xffff
+	# the kinds of top-level declarations by the name of the declaring element
+	DECL_TYPES = dict(attribute=0, element=1, complexType=2, attributeGroup=0, group=1, simpleType=2)
 	def __init__(self):
 		self.genElements = set()
 		self.genTypes = set()
@@ -36,8 +121,16 @@ class XSCompiler:
 		self.preservedSubsts = set()
 		self.substs = dict()
 		self.Decls = {0: dict(), 1: dict(), 2: dict()}
-		self.declTypes = dict(attribute=0, element=1, complexType=2, attributeGroup=0, group=1, simpleType=2)
+		self.declTypes = self.DECL_TYPES
 		self.loadedSchemas = set()
+		self.schemaNamespaces = dict()
+		# schema files indexed by indexSchemas: the targetNamespace of each,
+		# the files declaring each name and each substitution group head and
+		# the files parsed so far
+		self.indexNamespaces = dict()
+		self.declIndex = {0: dict(), 1: dict(), 2: dict()}
+		self.substIndex = dict()
+		self.materialized = set()
 		self.definitions = dict()
 		self.namespaces = list()
 		for namespace in ("http://www.w3.org/2001/XMLSchema", "http://www.w3.org/2001/XMLSchema-datatypes"):
@@ -52,7 +145,56 @@ class XSCompiler:
 			self.namespaces.append(namespace)
 		self.elements = [("/")]
 		self.actions = []
+		self.resetRepeatableActions()
 		self.macros = [ ("enter", 0, self.onEnter), ("leave", 0, self.onLeave) ]
+		self.contentModels = dict()
+		self.contentModelHits = 0
+		self.contentModelMisses = 0
+		self.touched = list()
+		self.counterThreshold = None
+		self.verbosity = 0
+		self.stats = None
+		self.minimizations = 0
+		# a content model is reduced once it has this many states more than
+		# the largest reduced content model it contains, reduced[-1] holds
+		# the size of that one for the content model being built
+		self.minimizeThreshold = 64
+		self.reduced = list()
+		# the intermediate reductions of the current target for --stats
+		self.reductions = None
+		# number of DFA states cached by the runtime determinizing the NFA on
+		# demand, 0 to compile DFAs
+		self.lazy = 0
+		# how content models are turned into automata: "thompson" builds
+		# epsilon NFAs to determinize, "glushkov" position automata that
+		# are DFAs already for content models obeying Unique Particle
+		# Attribution
+		self.construction = "thompson"
+
+	def log(self, level, message):
+		"""Prints message if the verbosity is at least level."""
+		if self.verbosity >= level: print message
+
+	def timed(self, stats, phase, f, *args):
+		"""Returns f(*args), adding its wall time and the growth of the peak
+		resident set size to phase in the stats dictionary, unless it is None."""
+		if stats is None: return f(*args)
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		start = time.time()
+		result = f(*args)
+		end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		record = stats.setdefault("phases", dict()).setdefault(phase, dict(seconds=0.0, growth_kb=0))
+		record["seconds"] += time.time() - start
+		record["growth_kb"] += end - peak
+		record["peak_kb"] = end
+		return result
+
+	@staticmethod
+	def fsmSize(fsm):
+		"""Returns the numbers of reachable states and transitions of fsm."""
+		fsm = fsm.compact()
+		states = fsm.reachables()
+		return dict(states=len(states), transitions=sum([len(list(fsm.transitions(state))) for state in states]))
 
 	def expandQName(self, node, qname, defaultNamespace=""):
 		try:
@@ -70,17 +212,16 @@ class XSCompiler:
 		declNames = ("attribute", "element", "type")
 		qname = "{%s}%s" % (targetNamespace, node.prop("name"))
 		self.Decls[self.declTypes[node.name]][qname] = node
-		print "Registered %s %s" % (declNames[self.declTypes[node.name]], qname)
+		self.log(1, "Registered %s %s" % (declNames[self.declTypes[node.name]], qname))
 		subst = node.prop("substitutionGroup")
 		if bool(subst):
 			subst = self.expandQName(node, subst)
-			if not self.substs.has_key(subst): self.substs[subst] = set()
-			self.substs[subst].add(node)
-			print "  added %s as substitut for %s" % (qname, subst)
+			self.substs.setdefault(subst, set()).add(node)
+			self.log(1, "  added %s as substitut for %s" % (qname, subst))
 
 	def loadSchema(self, uri, targetNamespace = None):
 		if uri in self.loadedSchemas: return
-		print "Loading schema file: %s" % uri
+		self.log(1, "Loading schema file: %s" % uri)
 		self.loadedSchemas.add(uri)
 
 		doc = libxml2.readFile(uri, None, options = libxml2.XML_PARSE_NOBLANKS)
@@ -89,23 +230,93 @@ class XSCompiler:
 
 		if targetNamespace is None:
 			targetNamespace = root.prop("targetNamespace")
+		# included schemas without a targetNamespace take the one of the including schema
+		self.schemaNamespaces[doc] = targetNamespace
 
 		result = xpath.xpathEval("/*[local-name()='schema']/*[local-name()='include' or local-name()='import']")
 		for node in result:
 			url = urlparse.urlparse(node.prop("schemaLocation"))
 			if bool(url.scheme):
-				print "  Ignoring non-local resource %s" % node.prop("schemaLocation")
+				self.log(1, "  Ignoring non-local resource %s" % node.prop("schemaLocation"))
 			else:
 				loc = os.path.normpath(os.path.join(os.path.dirname(uri), url.path))
 				self.loadSchema(loc, targetNamespace if node.name == "include" else None)
+		xpath.xpathFreeContext()
+		self.registerDeclarations(doc, targetNamespace)
 
+	def registerDeclarations(self, doc, targetNamespace):
+		"""Registers the top-level declarations of the schema document doc."""
+		xpath = doc.xpathNewContext()
 		result = xpath.xpathEval("/*[local-name()='schema']/*")
 		for node in result:
 			if node.name in self.declTypes:
 				self.importDef(node, targetNamespace)
+		xpath.xpathFreeContext()
+
+	def indexSchemas(self, uris, jobs=1):
+		"""Indexes the schema files uris and the files they include and import
+		without parsing them into trees, reading jobs files in parallel.  A
+		file is parsed and its declarations registered once a name it declares
+		or a member of a substitution group is looked up, so only the files
+		reachable from the compiled elements and types are parsed."""
+		pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+		pending = [(uri, None) for uri in uris]
+		while len(pending) > 0:
+			wave = []
+			for uri, targetNamespace in pending:
+				if uri not in self.loadedSchemas:
+					self.loadedSchemas.add(uri)
+					wave.append((uri, targetNamespace))
+			pending = []
+			indexes = (pool.map if pool is not None else map)(indexSchema, [uri for uri, targetNamespace in wave])
+			for (uri, targetNamespace), index in zip(wave, indexes):
+				self.log(1, "Indexed schema file: %s" % uri)
+				if targetNamespace is None:
+					targetNamespace = index.targetNamespace
+				self.indexNamespaces[uri] = targetNamespace
+				for location, include in index.references:
+					url = urlparse.urlparse(location or "")
+					if bool(url.scheme) or not bool(url.path):
+						self.log(1, "  Ignoring non-local resource %s" % location)
+					else:
+						loc = os.path.normpath(os.path.join(os.path.dirname(uri), url.path))
+						# included schemas without a targetNamespace take the one of the including schema
+						pending.append((loc, targetNamespace if include else None))
+				for kind, name, group in index.declarations:
+					self.declIndex[self.declTypes[kind]].setdefault("{%s}%s" % (targetNamespace, name), []).append(uri)
+					if group is not None:
+						self.substIndex.setdefault(group, []).append(uri)
+		if pool is not None:
+			pool.close()
+			pool.join()
+		if not isinstance(self.substs, LazyTable):
+			for declType in self.Decls:
+				self.Decls[declType] = LazyTable(self.materialize, self.declIndex[declType], self.Decls[declType])
+			self.substs = LazyTable(self.materialize, self.substIndex, self.substs)
+
+	def materialize(self, uri):
+		"""Parses the indexed schema file uri and registers its declarations,
+		unless done before."""
+		if uri in self.materialized: return
+		self.materialized.add(uri)
+		self.log(1, "Loading schema file: %s" % uri)
+		doc = libxml2.readFile(uri, None, options = libxml2.XML_PARSE_NOBLANKS)
+		self.schemaNamespaces[doc] = self.indexNamespaces[uri]
+		self.registerDeclarations(doc, self.indexNamespaces[uri])
 
 	def targetNamespace(self, node):
-		return node.get_doc().getRootElement().prop("targetNamespace")
+		doc = node.get_doc()
+		if doc in self.schemaNamespaces:
+			return self.schemaNamespaces[doc]
+		return doc.getRootElement().prop("targetNamespace")
+
+	def substitutionGroup(self, qname):
+		"""Returns the head of the substitution group of the element qname, None
+		if it is not in a group."""
+		node = self.Decls[1].get(qname)
+		for head, members in self.substs.items():
+			if node in members: return head
+		return None
 
 	def getElementId(self, namespace, localname):
 		try:
@@ -128,8 +339,19 @@ class XSCompiler:
 		except ValueError:
 			actionId = len(self.actions)
 			self.actions.append(action)
+			# every counter instance on a path executes its own operations
+			if self.COUNTER_ACTION.match(action):
+				repeatableActions.add(actionId)
 		return actionId
 
+	def resetRepeatableActions(self):
+		"""Makes the counter operations among the actions of this compiler the
+		repeatable actions of fsm.  These are shared by the process like
+		actionTable, so they are reset whenever the action table of another
+		compiler or of another target takes over."""
+		repeatableActions.clear()
+		repeatableActions.update([actionId for actionId, action in enumerate(self.actions) if self.COUNTER_ACTION.match(action)])
+
 	def mapActions(self, actionStrings):
 		return map(self.getActionId, actionStrings)
 		
@@ -154,12 +376,20 @@ class XSCompiler:
 		l = self.getActions(action)
 		la[:0] = l
 
+	def counter(self, minOccurs, maxOccurs):
+		"""Counter actions (enter, iterate, leave) for a particle whose bounds
+		exceed the counter threshold, None if the particle is to be unrolled."""
+		if self.counterThreshold is None: return None
+		if (minOccurs if maxOccurs == "unbounded" else maxOccurs) <= self.counterThreshold: return None
+		return (self.mapActions(["counter_enter"]), self.mapActions(["counter_iterate_%s" % maxOccurs]),
+		        self.mapActions(["counter_leave_%d" % minOccurs]))
+
 	def addMacro(self, macro):
 		for i in range(0, len(self.macros)):
 			if self.macros[i][1] >= macro[1]: break
-		print "Inserting macro %s with prio %d at %d" % (macro[0], macro[1], i)
+		self.log(2, "Inserting macro %s with prio %d at %d" % (macro[0], macro[1], i))
 		self.macros[i:i] = [macro]
-		print self.macros
+		self.log(2, self.macros)
 
 	def processActions(self, node, ea, la):
 		for macro in self.macros:
@@ -168,55 +398,526 @@ class XSCompiler:
 				continue
 			macro[2](self, action, ea, la)
 
-	def mkTables(self, dfa):
+	def tables(self, dfa, entries=None):
+		"""Returns the start state, the first final state and the targets
+		offsets, targets, keys, actions, actions offsets and actions ends
+		arrays of dfa.  For a machine combined from several ones entries are
+		their entry states and the start state of each is returned as a list
+		instead.  State numbers start with 1, final states are numbered
+		last.  Epsilon transitions of an NFA have the key EPSILON.  The
+		actions of transition t are actions[actions_offsets[t]:actions_ends[t]],
+		equal sequences are stored once and a sequence that is a suffix of
+		another one shares its actions."""
 		keys = []
 		targets = []
 		targets_offsets = [0]
-		Lactions = []
-		Lactions_offsets = []
-		
-		states = sorted(dfa.reachables(), key=lambda state: state in dfa.accepts)
+		sequences = []
+
+		dfa = dfa.compact()
+		states = sorted(dfa.reachables(entries), key=dfa.isFinal)
+		index = dict((state, i) for i, state in enumerate(states))
 		for i in range(0, len(states)):
-			labels = sorted(set([trans.label for trans in states[i].transitions]))
 			targets_offsets.append(len(targets))
-			for label in labels:
-				target, actions = [(states.index(trans.target), trans.actions) for trans in states[i].transitions if trans.label == label][0]
-				targets.append(target + 1)
-				Lactions_offsets.append(len(Lactions))
-				Lactions.extend(actions)
-				keys.append(label)
-				print "State %d, label %s, target %d, actions %s" % (i, label, target, actions)
+			for t in xrange(dfa.offsets[states[i]], dfa.offsets[states[i] + 1]):
+				targets.append(index[dfa.targets[t]] + 1)
+				sequences.append(dfa.actions[t])
+				keys.append(self.EPSILON if dfa.labels[t] is None else dfa.labels[t])
 		targets_offsets.append(len(targets))
-		Lactions_offsets.append(len(Lactions))
+		Lactions, offsets = actionTable.pack(sequences)
+		Lactions_offsets = [offsets[sequence] for sequence in sequences] + [len(Lactions)]
+		Lactions_ends = [offsets[sequence] + len(actionTable[sequence]) for sequence in sequences]
+		first_final = len([s for s in states if not dfa.isFinal(s)]) + 1
+		start = index[dfa.entry] + 1 if entries is None else [index[entry] + 1 for entry in entries]
+		return start, first_final, targets_offsets, targets, keys, Lactions, Lactions_offsets, Lactions_ends
+
+	COUNTER_OPS = ("none", "enter", "iterate", "leave")
+
+	def counters(self):
+		"""Returns the (op, bound) counter table indexed by action id, None if
+		no counter actions are used."""
+		counters = [self.COUNTER_ACTION.match(action) for action in self.actions]
+		if not any(counters): return None
+		return [(0, 0) if m is None else (self.COUNTER_OPS.index(m.group(1)), 0 if m.group(2) in (None, "unbounded") else int(m.group(2)))
+		        for m in counters]
+
+	def denseTables(self, tables):
+		"""Returns the dense layout of tables: the class of every element id,
+		the row of every state and the base, next and check arrays of the
+		comb vector the rows are packed into.  Element ids with the same
+		transitions in every state share a class, states with the same
+		transitions per class share a row.  next holds the index of a sparse
+		transition with the same target and actions, a slot belongs to row r
+		if check is r."""
+		start, first_final, targets_offsets, targets, keys, Lactions, Lactions_offsets, Lactions_ends = tables
+		nstates = len(targets_offsets) - 1
+		cells = [dict() for state in range(0, nstates)]
+		representative = dict()
+		for state in range(1, nstates):
+			for t in range(targets_offsets[state], targets_offsets[state + 1]):
+				cell = (targets[t], tuple(Lactions[Lactions_offsets[t]:Lactions_ends[t]]))
+				representative.setdefault(cell, t)
+				cells[state][keys[t]] = cell
+
+		signatures = dict()
+		classes = []
+		members = []
+		for element in range(0, len(self.elements)):
+			signature = tuple([row.get(element) for row in cells])
+			if signature not in signatures:
+				signatures[signature] = len(members)
+				members.append(element)
+			classes.append(signatures[signature])
+
+		rowIndex = dict()
+		uniqueRows = []
+		rows = []
+		for state in range(0, nstates):
+			row = tuple([representative.get(cells[state].get(element)) for element in members])
+			if row not in rowIndex:
+				rowIndex[row] = len(uniqueRows)
+				uniqueRows.append(row)
+			rows.append(rowIndex[row])
+
+		# first fit packing, densest rows first
+		base = [0] * len(uniqueRows)
+		next = []
+		check = []
+		for r in sorted(range(0, len(uniqueRows)), key=lambda r: -len([t for t in uniqueRows[r] if t is not None])):
+			columns = [c for c, t in enumerate(uniqueRows[r]) if t is not None]
+			b = 0
+			while any([b + c < len(check) and check[b + c] != 0xffff for c in columns]):
+				b += 1
+			base[r] = b
+			if b + len(members) > len(check):
+				next.extend([0] * (b + len(members) - len(check)))
+				check.extend([0xffff] * (b + len(members) - len(check)))
+			for c in columns:
+				next[b + c] = uniqueRows[r][c]
+				check[b + c] = r
+		return classes, rows, base, next, check
+
+	def layoutReport(self, tables, dense):
+		"""Returns a line comparing the size and lookup cost of the sparse and
+		the dense layout."""
+		start, first_final, targets_offsets, targets, keys, Lactions, Lactions_offsets, Lactions_ends = tables
+		classes, rows, base, next, check = dense
+		nstates = len(targets_offsets) - 2
+		sparse = 2 * (len(targets_offsets) + len(keys))
+		packed = 2 * (len(classes) + len(rows) + len(base) + len(next) + len(check))
+		return "Layout: sparse index %d bytes, %.1f keys/state scanned; dense index %d bytes (%d classes, %d rows, unpacked %d bytes), 1 lookup/event" % (
+			sparse, float(len(keys)) / max(nstates, 1), packed, max(classes) + 1, len(base), 2 * (len(targets_offsets) - 1) * (max(classes) + 1))
+
+	def profileReport(self, dfa, profile, entries=None):
+		"""Returns the hit counts of profile, as read by readProfile, mapped to
+		the states, elements and actions of dfa, hottest states first.
+		entries are those of a combined machine, see tables."""
+		start, first_final, targets_offsets, targets, keys, Lactions, Lactions_offsets, Lactions_ends = self.tables(dfa, entries)
+		nstates, ntransitions, stateHits, transitionHits = profile
+		if (nstates, ntransitions) != (len(targets_offsets) - 1, len(keys)):
+			return "Profile: does not match the tables"
+		def label(key):
+			if key == 0: return "/"
+			namespaceId, localname = self.elements[key]
+			namespace = self.namespaces[namespaceId]
+			return localname if not namespace or localname[0] in "*!" else "{%s}%s" % (namespace, localname)
+		lines = ["Profile: %d events, %d of %d transitions never taken" % (
+			sum(stateHits.values()), len([t for t in range(0, len(keys)) if not transitionHits.get(t)]), len(keys))]
+		for state in sorted(stateHits, key=lambda state: (-stateHits[state], state)):
+			lines.append("State %d: %d hits" % (state - 1, stateHits[state]))
+			hits = [t for t in range(targets_offsets[state], targets_offsets[state + 1]) if transitionHits.get(t)]
+			for t in sorted(hits, key=lambda t: (-transitionHits[t], t)):
+				lines.append("  %s -> %d %s: %d" % (label(keys[t]), targets[t] - 1,
+				             [self.actions[a] for a in Lactions[Lactions_offsets[t]:Lactions_ends[t]]], transitionHits[t]))
+		return "\n".join(lines)
+
+	def mkTables(self, dfa, dense=False, entries=None):
+		tables = self.tables(dfa, entries)
+		start, first_final, targets_offsets, targets, keys, Lactions, Lactions_offsets, Lactions_ends = tables
+		for state in range(1, len(targets_offsets) - 1):
+			for t in range(targets_offsets[state], targets_offsets[state + 1]):
+				print "State %d, label %s, target %d, actions %s" % (state - 1, keys[t], targets[t] - 1, Lactions[Lactions_offsets[t]:Lactions_ends[t]])
+		if entries is not None:
+			print "Starts: %s" % start
 		print "Targets_offsets: %s" % targets_offsets
 		print "Targets: %s" % targets
 		print "Keys: %s" % keys
 		print "Actions: %s" % Lactions
 		print "Actions_offsets: %s" % Lactions_offsets
+		print "Actions_ends: %s" % Lactions_ends
+		if self.lazy:
+			print "Lazy: NFA determinized at runtime, caching %d DFA states" % self.lazy
+		else:
+			denseTables = self.denseTables(tables)
+			print self.layoutReport(tables, denseTables)
+		if dense:
+			for name, values in zip(("Classes", "Rows", "Base", "Next", "Check"), denseTables):
+				print "%s: %s" % (name, values)
 		print "{0, \"/\"},"
 		for i in range(1, len(self.elements)):
 			print "{%d, \"%s\"}," % (self.elements[i][0], self.elements[i][1])
 		for idx, action in enumerate(self.actions):
 			print "%s = %d," % (action, idx)
+		counters = self.counters()
+		if counters is not None:
+			print "Counters:"
+			for op, bound in counters:
+				print "{FX_COUNTER_%s, %d}," % (self.COUNTER_OPS[op].upper(), bound)
+
+	def writeTables(self, dfa, path, dense=False, element=None, group=None, roots=None):
+		"""Writes the tables of dfa in the binary format, see packTables."""
+		with open(path, "wb") as f:
+			f.write(self.packTables(dfa, dense, element, group, roots))
+
+	def packTables(self, dfa, dense=False, element=None, group=None, roots=None):
+		"""Returns the tables of dfa in the binary format read by fx_load_schema:
+		a header of magic, version, type, start state, first final state and
+		(offset, count) of each section, followed by the sections aligned to
+		8 bytes.  All numbers are little endian.  The dense sections are empty
+		unless dense is set, the registration section is empty unless the
+		machine is for the element qname element, in the substitution group of
+		group.  The lazy section holds the number of DFA states to cache if dfa
+		is an NFA compiled for lazy determinization and is empty otherwise.  The
+		actions ends section holds the end of the actions of every transition,
+		whose actions may share a suffix with those of other transitions.
+		For a machine combined from several elements roots lists the (entry
+		state, element, group) of each, the roots section holds their start
+		states and registrations and the header describes the first one."""
+		tables = self.tables(dfa, None if roots is None else [entry for entry, element, group in roots])
+		start, first_final, targets_offsets, targets, keys, Lactions, Lactions_offsets, Lactions_ends = tables
+		starts = []
+		if roots is not None:
+			starts, start = start, start[0]
+			element, group = roots[0][1:]
+		denseTables = self.denseTables(tables) if dense else ([], [], [], [], [])
+		strings = bytearray()
+		def string(s):
+			offset = len(strings)
+			strings.extend(s.encode("utf-8") if isinstance(s, unicode) else s)
+			strings.append(0)
+			return offset
+		elements = [(string("/"), 0)] + [(string(localname), namespace) for namespace, localname in self.elements[1:]]
+		namespaces = [string(namespace or "") for namespace in self.namespaces]
+		counters = self.counters() or []
+		def register(element, group):
+			registration = []
+			for qname in (element, group):
+				registration.extend([0xffffffff, 0xffffffff] if qname is None else map(string, splitQName(qname)))
+			return registration
+		registration = register(element, group) if element is not None else []
+		rootsTable = []
+		for (entry, rootElement, rootGroup), rootStart in zip(roots or [], starts):
+			rootsTable.extend([rootStart] + register(rootElement, rootGroup))
+		lazy = [self.lazy] if self.lazy else []
+		for table in (targets_offsets, targets, keys, Lactions, Lactions_offsets, Lactions_ends) + denseTables:
+			if len(table) > 0 and max(table) > 0xffff:
+				raise BaseException("Tables exceed the 16 bit range of the binary format")
+		sections = [
+			struct.pack("<%dH" % len(targets_offsets), *targets_offsets),
+			struct.pack("<%dH" % len(keys), *keys),
+			struct.pack("<%dH" % len(targets), *targets),
+			struct.pack("<%dH" % len(Lactions_offsets), *Lactions_offsets),
+			struct.pack("<%dH" % len(Lactions), *Lactions),
+			"".join([struct.pack("<IB3x", name, namespace) for name, namespace in elements]),
+			struct.pack("<%dI" % len(namespaces), *namespaces),
+			"".join([struct.pack("<B3xI", op, bound) for op, bound in counters]),
+			str(strings)] + [struct.pack("<%dH" % len(table), *table) for table in denseTables] + [
+			struct.pack("<%dI" % len(registration), *registration),
+			struct.pack("<%dI" % len(lazy), *lazy),
+			struct.pack("<%dH" % len(Lactions_ends), *Lactions_ends),
+			struct.pack("<%dI" % len(rootsTable), *rootsTable)]
+		counts = [len(targets_offsets), len(keys), len(targets), len(Lactions_offsets), len(Lactions),
+		          len(elements), len(namespaces), len(counters), len(strings)] + map(len, denseTables) + [len(registration), len(lazy), len(Lactions_ends), len(roots or [])]
+		header = struct.Struct("<4sHHII%dI" % (2 * len(sections)))
+		offset = header.size
+		layout = []
+		for section, count in zip(sections, counts):
+			offset = (offset + 7) & ~7
+			layout.extend((offset, count))
+			offset += len(section)
+		data = bytearray(header.pack(self.TABLES_MAGIC, self.TABLES_VERSION, 1, start, first_final, *layout))
+		for section, sectionOffset in zip(sections, layout[0::2]):
+			data.extend("\0" * (sectionOffset - len(data)))
+			data.extend(section)
+		return str(data)
+
+	def mkSource(self, dfa, prefix, style="table", dense=False, element=None, group=None, roots=None):
+		"""Returns a C unit for dfa.  The table style defines the fx_schema
+		<prefix>_schema for fx_parse_xml, for a machine combined from several
+		elements, whose (entry state, element, group) roots lists, one
+		fx_schema <name>_schema per element named like machineName instead.
+		The goto style defines a function
+		<prefix>_parse(xmlTextReaderPtr) with one label per state that compares
+		the keys and executes the actions inline.  Actions are executed by the
+		FX_ACTION(name) macro, which prints the name unless defined before.
+		With dense, the table style includes the dense layout.  A machine for
+		the element qname element carries its name and substitution group
+		for fx_register.  NFAs compiled for lazy determinization, combined
+		machines and machines invoking others through '!' keys need the table
+		style.  The goto style compares the namespaces of the elements like
+		the interpreter does and grows its counter stack like it."""
+		tables = self.tables(dfa, None if roots is None else [entry for entry, element, group in roots])
+		start, first_final, targets_offsets, targets, keys, Lactions, Lactions_offsets, Lactions_ends = tables
+		counters = self.counters()
+		cArray = lambda values: "{%s}" % ", ".join(map(str, values or [0]))
+		cString = lambda s: '"%s"' % s.replace("\\", "\\\\").replace('"', '\\"')
+		lines = ["/* generated by xsdcc.py, do not edit */",
+		         "#include <stdio.h>",
+		         "#include <stdlib.h>",
+		         "#include \"xmlparser.h\"",
+		         "",
+		         "#ifndef FX_ACTION",
+		         "#define FX_ACTION(name) printf(\"%s\\n\", #name)",
+		         "#endif",
+		         ""]
+		if style == "table":
+			for name, values in (("targets_offsets", targets_offsets), ("targets", targets), ("keys", keys),
+			                     ("actions_offsets", Lactions_offsets), ("actions_ends", Lactions_ends), ("actions", Lactions)):
+				lines.append("static const uint16_t %s_%s[] = %s;" % (prefix, name, cArray(values)))
+			lines.append("static const struct element %s_elements[] = {" % prefix)
+			lines.append("\t{0, BAD_CAST \"/\"},")
+			for namespace, localname in self.elements[1:]:
+				lines.append("\t{%d, BAD_CAST %s}," % (namespace, cString(localname)))
+			lines.append("};")
+			lines.append("static const xmlChar *const %s_namespaces[] = {" % prefix)
+			for namespace in self.namespaces:
+				lines.append("\tBAD_CAST %s," % cString(namespace or ""))
+			lines.append("};")
+			if dense:
+				for name, values in zip(("classes", "rows", "base", "next", "check"), self.denseTables(tables)):
+					lines.append("static const uint16_t %s_%s[] = %s;" % (prefix, name, cArray(values)))
+				lines.append("static const struct fx_dense %s_dense = {" % prefix)
+				lines.append("\t%s_classes, %s_rows, %s_base, %s_next, %s_check" % (prefix, prefix, prefix, prefix, prefix))
+				lines.append("};")
+			if counters is not None:
+				lines.append("static const struct fx_counter %s_counters[] = {" % prefix)
+				for op, bound in counters:
+					lines.append("\t{FX_COUNTER_%s, %d}," % (self.COUNTER_OPS[op].upper(), bound))
+				lines.append("};")
+			lines.append("")
+			if len(self.actions) > 0:
+				lines.append("enum %s_actions {" % prefix)
+				for idx, action in enumerate(self.actions):
+					lines.append("\t%s_%s = %d," % (prefix, action, idx))
+				lines.append("};")
+				lines.append("")
+			lines.append("static void %s_do_actions(int len, const uint16_t *actions)" % prefix)
+			lines.append("{")
+			lines.append("\tint i;")
+			lines.append("\tfor (i = 0; i < len; i++)")
+			lines.append("\t\tswitch (actions[i]) {")
+			for idx, action in enumerate(self.actions):
+				if counters is not None and counters[idx][0] != 0:
+					lines.append("\t\tcase %s_%s: break;" % (prefix, action))
+				else:
+					lines.append("\t\tcase %s_%s: FX_ACTION(%s); break;" % (prefix, action, action))
+			lines.append("\t\tdefault: printf(\"Action %d not implemented!!\\n\", actions[i]);")
+			lines.append("\t\t}")
+			lines.append("}")
+			lines.append("")
+			schemas = [(prefix, start, element, group)] if roots is None else \
+			          [(machineName(element), rootStart, element, group) for (entry, element, group), rootStart in zip(roots, start)]
+			for schemaName, start, element, group in schemas:
+				lines.append("const fx_schema %s_schema = {" % schemaName)
+				lines.append("\t1, %d, %s_elements, %s_keys, %s_targets_offsets, %s_actions, %s_actions_offsets, %s_targets, %d, %s_do_actions, %s," %
+				             (start, prefix, prefix, prefix, prefix, prefix, prefix, first_final, prefix,
+				              "NULL" if counters is None else "%s_counters" % prefix))
+				lines.append("\t%s_namespaces, %d, %d, %s," % (prefix, len(self.elements), len(targets_offsets) - 1,
+				                                             "&%s_dense" % prefix if dense else "NULL"))
+				registration = []
+				for qname in (element, group):
+					registration.extend(["NULL", "NULL"] if qname is None else ["BAD_CAST %s" % cString(name) for name in splitQName(qname)])
+				registration.extend([str(self.lazy), "%s_actions_ends" % prefix])
+				lines.append("\t%s" % ", ".join(registration))
+				lines.append("};")
+			return "\n".join(lines) + "\n"
+		if self.lazy:
+			raise BaseException("Direct-coded machines need a DFA, not an NFA for lazy determinization")
+		if roots is not None:
+			raise BaseException("Direct-coded machines have a single root, combined machines need the table style")
+		for key in set(keys):
+			if key != 0 and self.elements[key][1].startswith("!"):
+				raise BaseException("Direct-coded machines cannot invoke other machines, %s needs the table style" % self.elements[key][1])
+
+		def actionCode(indent, actions):
+			code = []
+			for action in actions:
+				op, bound = (0, 0) if counters is None else counters[action]
+				if op == 1:
+					code.append("if (csp + 1 == *counters_size && %s_grow(counters, counters_size) < 0) return 1;" % prefix)
+					code.append("(*counters)[++csp] = 0;")
+				elif op == 2:
+					code.append("if (csp < 0%s) return 1;" % (" || (*counters)[csp] >= %d" % bound if bound else ""))
+					code.append("(*counters)[csp]++;")
+				elif op == 3:
+					code.append("if (csp < 0 || (*counters)[csp] < %d) return 1;" % bound)
+					code.append("csp--;")
+				else:
+					code.append("FX_ACTION(%s);" % self.actions[action])
+			return [indent + line for line in code]
+
+		lines.append("static int %s_next(xmlTextReaderPtr rd, int *fake_close)" % prefix)
+		lines.append("{")
+		lines.append("\tint ret;")
+		lines.append("\tif (*fake_close) {")
+		lines.append("\t\t*fake_close = 0;")
+		lines.append("\t\treturn XML_READER_TYPE_END_ELEMENT;")
+		lines.append("\t}")
+		lines.append("\tif ((ret = xmlTextReaderRead(rd)) != 1)")
+		lines.append("\t\treturn ret == 0 ? -1 : -2;")
+		lines.append("\treturn xmlTextReaderNodeType(rd);")
+		lines.append("}")
+		lines.append("")
+		if counters is not None:
+			# the counter stack is allocated by the parse function and grown
+			# by the matching function, which returns without freeing it
+			lines.append("static int %s_grow(uint32_t **counters, int *counters_size)" % prefix)
+			lines.append("{")
+			lines.append("\tuint32_t *cs;")
+			lines.append("\tif ((cs = realloc(*counters, 2 * *counters_size * sizeof(*cs))) == NULL)")
+			lines.append("\t\treturn -1;")
+			lines.append("\t*counters = cs;")
+			lines.append("\t*counters_size *= 2;")
+			lines.append("\treturn 0;")
+			lines.append("}")
+			lines.append("")
+			lines.append("static int %s_match(xmlTextReaderPtr rd, uint32_t **counters, int *counters_size);" % prefix)
+			lines.append("")
+			lines.append("int %s_parse(xmlTextReaderPtr rd)" % prefix)
+			lines.append("{")
+			lines.append("\tint counters_size = FX_COUNTERS_SIZE, ret;")
+			lines.append("\tuint32_t *counters;")
+			lines.append("")
+			lines.append("\tif ((counters = malloc(counters_size * sizeof(*counters))) == NULL)")
+			lines.append("\t\treturn 1;")
+			lines.append("\tret = %s_match(rd, &counters, &counters_size);" % prefix)
+			lines.append("\tfree(counters);")
+			lines.append("\treturn ret;")
+			lines.append("}")
+			lines.append("")
+			lines.append("static int %s_match(xmlTextReaderPtr rd, uint32_t **counters, int *counters_size)" % prefix)
+		else:
+			lines.append("int %s_parse(xmlTextReaderPtr rd)" % prefix)
+		lines.append("{")
+		lines.append("\tint ev, fake_close = 0;")
+		lines.append("\tconst xmlChar *name, *ns;")
+		if counters is not None:
+			lines.append("\tint csp = -1;")
+		lines.append("")
+		lines.append("\tgoto s%d;" % start)
+		for state in range(1, len(targets_offsets) - 1):
+			transitions = range(targets_offsets[state], targets_offsets[state + 1])
+			lines.append("")
+			lines.append("s%d:" % state)
+			lines.append("\tif ((ev = %s_next(rd, &fake_close)) < 0)" % prefix)
+			lines.append("\t\treturn %s;" % ("ev != -1" if state >= first_final else "1"))
+			lines.append("\tswitch (ev) {")
+			lines.append("\tcase XML_READER_TYPE_ELEMENT:")
+			lines.append("\t\tfake_close = xmlTextReaderIsEmptyElement(rd);")
+			if any([keys[t] != 0 for t in transitions]):
+				lines.append("\t\tname = xmlTextReaderConstLocalName(rd);")
+				lines.append("\t\tns = xmlTextReaderConstNamespaceUri(rd);")
+			for t in transitions:
+				if keys[t] == 0: continue
+				namespace, localname = self.elements[keys[t]]
+				actions = Lactions[Lactions_offsets[t]:Lactions_ends[t]]
+				if localname == "*":
+					lines.append("\t\t{")
+				else:
+					lines.append("\t\tif (xmlStrEqual(name, BAD_CAST %s) && xmlStrEqual(ns != NULL ? ns : BAD_CAST \"\", BAD_CAST %s)) {" %
+					             (cString(localname), cString(self.namespaces[namespace] or "")))
+				lines.extend(actionCode("\t\t\t", actions))
+				lines.append("\t\t\tgoto s%d;" % targets[t])
+				lines.append("\t\t}")
+				if localname == "*": break
+			lines.append("\t\treturn 1;")
+			lines.append("\tcase XML_READER_TYPE_END_ELEMENT:")
+			for t in transitions[:1]:
+				if keys[t] == 0:
+					lines.extend(actionCode("\t\t", Lactions[Lactions_offsets[t]:Lactions_ends[t]]))
+					lines.append("\t\tgoto s%d;" % targets[t])
+			if len(transitions) == 0 or keys[transitions[0]] != 0:
+				lines.append("\t\treturn 1;")
+			lines.append("\tdefault:")
+			lines.append("\t\tgoto s%d;" % state)
+			lines.append("\t}")
+		lines.append("}")
+		return "\n".join(lines) + "\n"
 
 	def dump(self, nfa):
-		states = sorted(nfa.reachables(), key=lambda state: state in nfa.accepts)
+		nfa = nfa.compact()
+		states = sorted(nfa.reachables(), key=nfa.isFinal)
+		index = dict((state, i) for i, state in enumerate(states))
 		for i in range(0, len(states)):
-			labels = set([trans.label for trans in states[i].transitions])
 			tr = []
-			for label in labels:
-				targets = [trans.target for trans in states[i].transitions if trans.label == label]
+			for label, transitions in groupby(nfa.transitions(states[i]), key=itemgetter(0)):
 				targetStr = []
-				for target in targets:
-					actions = []
-					for list in [trans.actions for trans in states[i].transitions if trans.label == label and trans.target == target]:
-						actions.extend(list)
-					targetStr.append("%s / %s" % (states.index(target), ", ".join([self.actions[a] for a in actions])))
+				for label, target, actions in transitions:
+					targetStr.append("%s / %s" % (index[target], ", ".join([self.actions[a] for a in actions])))
 				tr.append("%s -> %s" % ("€" if label is None else self.elements[label], ", ".join(targetStr)))
 			transStr = ", ".join(tr)
-			line = "%s\t%s%d%s: %s" % ("entry" if states[i] == nfa.entry else "", "[" if states[i] in nfa.accepts else " ", i, "]" if states[i] in nfa.accepts else " ", transStr)
+			line = "%s\t%s%d%s: %s" % ("entry" if states[i] == nfa.entry else "", "[" if nfa.isFinal(states[i]) else " ", i, "]" if nfa.isFinal(states[i]) else " ", transStr)
 			print line
 
+	def contentModelKey(self, node, ea, la):
+		"""Cache key for the content model of a named complexType or group or a
+		global element, None for anonymous components."""
+		if node.name in ("complexType", "group"):
+			if node.prop("name") is None: return None
+		elif node.name != "element" or node.parent is None or node.parent.name != "schema":
+			return None
+		return (node, tuple(ea), tuple(la), tuple([macro[:2] for macro in self.macros]),
+		        frozenset(self.genElements), frozenset(self.genTypes), frozenset(self.providedElements),
+		        frozenset(self.providedTypes), frozenset(self.preservedSubsts))
+
+	def lookupContentModel(self, key, stack):
+		# the recursion checks below a component depend on the nodes on the
+		# stack, so an entry is only valid if the same touched nodes are on it
+		stack = set(stack)
+		for touched, context, provided, fsm in self.contentModels.get(key, []):
+			if touched & stack == context:
+				self.contentModelHits += 1
+				self.providedElements.update(provided[0])
+				self.providedTypes.update(provided[1])
+				if len(self.touched) > 0: self.touched[-1].update(touched)
+				if len(self.reduced) > 0: self.reduced[-1] = max(self.reduced[-1], fsm.countStates())
+				return fsm.copy()
+		return None
+
+	def storeContentModel(self, key, stack, provided, fsm):
+		self.contentModelMisses += 1
+		touched = self.touched.pop()
+		if len(self.touched) > 0: self.touched[-1].update(touched)
+		provided = (self.providedElements - provided[0], self.providedTypes - provided[1])
+		# named components are likely to be reused, so they are always
+		# reduced before they are cached
+		fsm = self.reduce(fsm, key[0], "reuse")
+		if not self.contentModels.has_key(key): self.contentModels[key] = list()
+		self.contentModels[key].append((touched, touched & set(stack), provided, fsm))
+		return fsm.copy()
+
+	def newFsm(self):
+		"""Returns an automaton of the configured construction."""
+		return GlushkovFsm() if self.construction == "glushkov" else XMLFsm()
+
+	def reduce(self, fsm, node, reason):
+		"""Intermediate reduction of the content model of node, logged along
+		with the reason for it.  Only the states in between the entry and the
+		final states are determinized and minimized and position automata
+		merge their equivalent positions, so the actions the surrounding
+		content model adds are executed as they would be without the
+		reduction.  NFAs with actions of their own or with transitions on the
+		same label that can be taken together are left as they are, see
+		CompactFsm.reduce."""
+		states = fsm.countStates()
+		reduced = fsm.reduce(False)
+		self.minimizations += 1
+		name = node.prop("name") or node.prop("ref")
+		self.log(1, "Reduced %s%s at depth %d (%s) from %d to %d states" % (
+			node.name, "" if name is None else " " + name, len(self.reduced), reason, states, reduced.countStates()))
+		if self.reductions is not None:
+			self.reductions.append(dict(node=node.name, name=name, reason=reason, states=states, reduced=reduced.countStates()))
+		return reduced
+
 	def createContentModel(self, node, _stack = list()):
 		name = node.prop("name")
 		minOccurs = node.prop("minOccurs")
@@ -227,14 +928,25 @@ class XSCompiler:
 		ea = list()
 		la = list()
 		self.processActions(node, ea, la)
+		counter = self.counter(minOccurs, maxOccurs)
+		if len(self.touched) > 0: self.touched[-1].add(node)
 		if _stack.count(node) > 0:
 			if node.name != "element" or ("{%s}%s" % (self.targetNamespace(node), name)) not in self.providedElements:
-				print "*** recursion detected ***"
-				return XMLFsm().empty()
+				self.log(1, "*** recursion detected ***")
+				return self.newFsm().empty()
 
 		stack = list(_stack)
 		stack.append(node)
-		print "%s%s: '{%s}%s' (%s, %s) %s | %s" % (len(_stack)* "  ", node.name, self.targetNamespace(node), name, minOccurs, maxOccurs, [self.actions[e] for e in ea], [self.actions[a] for a in la])
+		if self.verbosity >= 2:
+			print "%s%s: '{%s}%s' (%s, %s) %s | %s" % (len(_stack)* "  ", node.name, self.targetNamespace(node), name, minOccurs, maxOccurs, [self.actions[e] for e in ea], [self.actions[a] for a in la])
+		key = self.contentModelKey(node, ea, la)
+		if key is not None:
+			fsm = self.lookupContentModel(key, _stack)
+			if fsm is not None:
+				return fsm
+			self.touched.append(set([node]))
+			provided = (set(self.providedElements), set(self.providedTypes))
+		self.reduced.append(0)
 		for case in switch(node.name):
 			if case("element"):
 				# wenn Referenz, dann verwende das Model des referenzierten Elements und wende Aktionen und Particle-Rule an
@@ -243,7 +955,7 @@ class XSCompiler:
 					if ref is None:
 						raise BaseException("Referenced element not known: %s" % node.prop("ref"))
 #					print "Verwende referenz %s" % node.prop("ref")
-					fsm = self.createContentModel(ref, stack).onenter(ea).onleave(la).particle(minOccurs, maxOccurs)
+					fsm = self.createContentModel(ref, stack).onenter(ea).onleave(la).particle(minOccurs, maxOccurs, counter)
 				else:
 				# sonst, falls nicht abstract, baue das Modell aus dem angegebenen Typ oder den Kind-Elementen
 				#   und erzeuge das Element
@@ -260,12 +972,9 @@ class XSCompiler:
 					   qname in self.elements:
 #						print "Creating call to %s" % name
 						# Einsprung via Element-Name in Zielmaschine; abstract="true" impliziert --preserve-substitution
-						fsm = XMLFsm()
-						fsm.entry = State()
-						leave = State()
-						fsm.entry.addTransition(self.getElementId(self.targetNamespace(node), "%s%s" % ('!' if node.prop("abstract") == "true" else "", name)), leave, ea)
-						fsm.accepts.add(leave)
-						fsm = fsm.particle(minOccurs, maxOccurs)
+						# the interpreter invokes the machine registered for the element or a member of its group,
+						# which executes the actions of the declaration itself
+						fsm = self.newFsm().symbol(self.getElementId(self.targetNamespace(node), "!%s" % name)).particle(minOccurs, maxOccurs, counter)
 					else:
 #						print "%s nicht in %s" % (qname, self.providedElements)
 						if "{%s}%s" % (self.targetNamespace(node), name) in self.genElements:
@@ -289,8 +998,8 @@ class XSCompiler:
 										break
 									child = child.next
 							if content is None:
-								content = XMLFsm().empty()
-							substitutions.append(XMLFsm().element(self.getElementId(self.targetNamespace(node), name), content, ea, la).particle(minOccurs, maxOccurs))
+								content = self.newFsm().empty()
+							substitutions.append(self.newFsm().element(self.getElementId(self.targetNamespace(node), name), content, ea, la))
 #						else:
 #							print "Kein content-model fuer %s, da abstract" % name
 
@@ -299,17 +1008,12 @@ class XSCompiler:
 #								print "Fuege subst %s fuer %s hinzu" % (child.prop("name"), qname)
 								substitutions.append(self.createContentModel(child, stack))
 						if qname in self.preservedSubsts:
-							f = XMLFsm()
-							f.entry = State()
-							leave = State()
-							f.entry.addTransition(self.getElementId(self.targetNamespace(node), "!%s" % name), leave, ea)
-							f.accepts.add(leave)
-							substitutions.append(f)
-						fsm = XMLFsm().empty() if len(substitutions) == 0 else XMLFsm().choice(substitutions).particle(minOccurs, maxOccurs)
+							substitutions.append(self.newFsm().symbol(self.getElementId(self.targetNamespace(node), "!%s" % name), ea))
+						fsm = self.newFsm().empty() if len(substitutions) == 0 else self.newFsm().choice(substitutions).particle(minOccurs, maxOccurs, counter)
 				break
 
 			if case("simpleType", "simpleContent"):
-				fsm = XMLFsm().empty()
+				fsm = self.newFsm().empty()
 				break
 
 			if case("complexType"):
@@ -322,7 +1026,7 @@ class XSCompiler:
 							fsm = self.createContentModel(child, stack).onenter(ea).onleave(la)
 							break
 						child = child.next
-				if fsm is None: fsm = XMLFsm().empty()
+				if fsm is None: fsm = self.newFsm().empty()
 				break
 
 			if case("sequence", "choice"):
@@ -332,10 +1036,10 @@ class XSCompiler:
 					if child.name in ("element", "group", "choice", "sequence", "any"):
 						content.append(self.createContentModel(child, stack))
 					child = child.next
-				fsm = XMLFsm().empty() if len(content) == 0 else (
-					XMLFsm().sequence(content, ea, la) if node.name == "sequence" else
-					XMLFsm().choice(content, ea, la)
-					).particle(minOccurs, maxOccurs)
+				fsm = self.newFsm().empty() if len(content) == 0 else (
+					self.newFsm().sequence(content, ea, la) if node.name == "sequence" else
+					self.newFsm().choice(content, ea, la)
+					).particle(minOccurs, maxOccurs, counter)
 				break
 
 			if case("complexContent"):
@@ -346,7 +1050,7 @@ class XSCompiler:
 						content = self.createContentModel(child, stack)
 						break
 					child = child.next
-				fsm = XMLFsm().empty() if content is None else content
+				fsm = self.newFsm().empty() if content is None else content
 				break
 
 			if case("extension", "restriction"):
@@ -355,9 +1059,9 @@ class XSCompiler:
 					if qname not in self.Decls[2]:
 						raise BaseException("base type %s not known" % qname)
 					base = self.Decls[2][qname]
-					baseContent = XMLFsm().empty() if base is None else self.createContentModel(base, stack)
+					baseContent = self.newFsm().empty() if base is None else self.createContentModel(base, stack)
 				else:
-					baseContent = XMLFsm().empty()
+					baseContent = self.newFsm().empty()
 				content = None
 				child = node.children
 				while child is not None:
@@ -369,7 +1073,7 @@ class XSCompiler:
 				break
 
 			if case("any"):
-				fsm = XMLFsm().element(self.getElementId(self.targetNamespace(node), "*"), XMLFsm().empty(), ea, la).particle(minOccurs, maxOccurs)
+				fsm = self.newFsm().element(self.getElementId(self.targetNamespace(node), "*"), self.newFsm().empty(), ea, la).particle(minOccurs, maxOccurs, counter)
 				break
 
 			if case("group"):
@@ -377,7 +1081,7 @@ class XSCompiler:
 					ref = self.Decls[1][self.expandQName(node, node.prop("ref"))]
 					if ref is None:
 						raise BaseException("Referenced group not known: %s" % node.prop("ref"))
-					fsm = self.createContentModel(ref, stack).onenter(ea).onleave(la).particle(minOccurs, maxOccurs)
+					fsm = self.createContentModel(ref, stack).onenter(ea).onleave(la).particle(minOccurs, maxOccurs, counter)
 				else:
 					content = None
 					child = node.children
@@ -386,16 +1090,422 @@ class XSCompiler:
 							content = self.createContentModel(child, stack)
 							break
 						child = child.next
-					fsm = XMLFsm().empty if content is None else content.onenter(ea).onleave(la)
+					fsm = self.newFsm().empty() if content is None else content.onenter(ea).onleave(la)
 				break
 
 			if case():
 				raise BaseException("Unknown schema object: %s" % node.name)
 #		self.dump(fsm)
 #		print "*" * 32
-		if len(stack) % 5 == 0: fsm = fsm.determinize(False).minimize(False)
+		reduced = self.reduced.pop()
+		if key is not None:
+			fsm = self.storeContentModel(key, _stack, provided, fsm)
+			reduced = fsm.countStates()
+		elif fsm.countStates() - reduced >= self.minimizeThreshold:
+			fsm = self.reduce(fsm, node, "size")
+			reduced = fsm.countStates()
+		if len(self.reduced) > 0: self.reduced[-1] = max(self.reduced[-1], reduced)
 		return fsm
 
+	def compileTarget(self, kind, obj, genElements, providedElements, genTypes, providedTypes):
+		"""Returns the minimized DFA for the element or type obj."""
+		self.genElements = genElements
+		self.providedElements = providedElements
+		self.genTypes = genTypes
+		self.providedTypes = providedTypes
+		stats = None
+		if self.stats is not None:
+			stats = dict(kind=kind, name=obj, phases=dict())
+			self.minimizations = 0
+			self.reductions = list()
+			copyCounter.reset()
+		verbose = self.verbosity > 0
+		nfa = self.timed(stats, "createContentModel", self.createContentModel, self.Decls[1 if kind == "element" else 2][obj])
+		if self.construction == "glushkov":
+			# position automata have no epsilon transitions to contract
+			simplified = self.timed(stats, "simplify", nfa.compact)
+		else:
+			simplified = self.timed(stats, "simplify", nfa.simplify, verbose)
+		if self.lazy:
+			# the runtime determinizes on demand
+			dfa = None
+			minimal = simplified
+		else:
+			if self.construction == "glushkov" and simplified.isDeterministic():
+				dfa = simplified
+			else:
+				dfa = self.timed(stats, "determinize", simplified.determinize, verbose, False)
+			minimal = self.timed(stats, "minimize", dfa.hopcroft, verbose)
+		if stats is not None:
+			stats.update(nfa=self.fsmSize(nfa), simplified=self.fsmSize(simplified), minimal=self.fsmSize(minimal), minimizations=self.minimizations, reductions=self.reductions,
+			             copies=dict(copies=copyCounter.copies, states=copyCounter.states, transitions=copyCounter.transitions))
+			if dfa is not None:
+				stats["dfa"] = self.fsmSize(dfa)
+			self.stats.append(stats)
+		return minimal
+
+	def mergeTables(self, elements, namespaces, actions):
+		"""Adds the element and action tables of another compiler and returns
+		the mappings of its element and action ids to ours."""
+		labels = [0] + [self.getElementId(namespaces[ns], localname) for ns, localname in elements[1:]]
+		return labels, self.mapActions(actions)
+
+class XSMachine(object):
+	"""The transitions of a compiled machine as dictionaries of label to
+	(target, actions id) per state.  An NFA compiled for lazy determinization
+	is run through LazyFsm, caching lazy DFA states like the C runtime."""
+	__slots__ = ("start", "final", "rows", "ordered", "specials", "lazy")
+
+	def __init__(self, fsm, specials, lazy=0):
+		self.specials = specials
+		if lazy:
+			self.lazy = LazyFsm(fsm, lazy)
+			self.start = self.lazy.start()
+			return
+		self.lazy = None
+		fsm = fsm.compact()
+		self.start = fsm.entry
+		self.final = fsm.final
+		self.rows = dict()
+		self.ordered = dict()
+		for state in fsm.reachables():
+			labels = fsm.labels[fsm.offsets[state]:fsm.offsets[state + 1]]
+			self.rows[state] = dict(zip(labels, zip(fsm.targets[fsm.offsets[state]:fsm.offsets[state + 1]],
+			                                        fsm.actions[fsm.offsets[state]:fsm.offsets[state + 1]])))
+			self.ordered[state] = labels if specials.intersection(labels) else None
+
+	def row(self, state):
+		"""Returns the transitions of state and, if it has wildcard or
+		substitution group keys, its labels in key order, None otherwise."""
+		if self.lazy is None:
+			return self.rows[state], self.ordered[state]
+		row = self.lazy.row(state)
+		return row, sorted(row) if self.specials.intersection(row) else None
+
+	def isFinal(self, state):
+		if self.lazy is None:
+			return bool(self.final[state])
+		return self.lazy.isFinal(state)
+
+class XSRunner(object):
+	"""Runs compiled machines on documents in Python, the way fx_parse_xml
+	runs their tables.  An element matches its own key, a '*' key or a '!'
+	key invoking the registered machine of a member of the substitution
+	group, which starts on the element itself and returns to its caller on
+	the first event it rejects in a final state.  Without wildcard and
+	substitution group keys in a state the element is looked up directly,
+	otherwise the keys are tried in order.  Documents are read with a
+	streaming reader, so the memory used does not grow with their size."""
+
+	def __init__(self, compiler, dfa):
+		self.compiler = compiler
+		namespaces = [namespace or None for namespace in compiler.namespaces]
+		self.names = [(None, "/")] + [(namespaces[ns], localname) for ns, localname in compiler.elements[1:]]
+		self.ids = dict((name, i) for i, name in enumerate(self.names) if i > 0)
+		self.specials = set([i for i, (ns, localname) in enumerate(self.names) if localname[0] in "*!"])
+		self.counters = compiler.counters()
+		self.registered = dict()
+		# NFAs are determinized with the repeatable actions of their compiler
+		compiler.resetRepeatableActions()
+		self.root = XSMachine(dfa, self.specials, compiler.lazy)
+		self.valid = None
+
+	def register(self, element, group, dfa):
+		"""Makes dfa, the machine for the element qname element in the
+		substitution group of group, invocable by '!' keys."""
+		self.registered[splitQName(element)] = (XSMachine(dfa, self.specials, self.compiler.lazy),
+		                                         None if group is None else splitQName(group))
+
+	def invoked(self, ns, localname, head):
+		"""Returns the registered machine for the element ns:localname if it is
+		head or a member of its substitution group, like lookupSubstitution."""
+		if (ns or "", localname) not in self.registered:
+			return None
+		machine, group = self.registered[(ns or "", localname)]
+		member = (ns or "", localname)
+		while True:
+			if member == head or group == head:
+				return machine
+			if group is None or group not in self.registered:
+				return None
+			member = group
+			group = self.registered[group][1]
+
+	def count(self, counters, actions):
+		"""Applies the counter operations among actions like fx_count, returns
+		False if a bound is violated."""
+		for action in actions:
+			op, bound = self.counters[action]
+			if op == 1:
+				counters.append(0)
+			elif op == 2:
+				if not counters or (bound and counters[-1] >= bound): return False
+				counters[-1] += 1
+			elif op == 3:
+				if not counters or counters[-1] < bound: return False
+				counters.pop()
+		return True
+
+	def step(self, stack, counters, ns, localname, close):
+		"""Feeds an element event into the machines on stack.  Returns the
+		action sequences of the transitions taken and whether the event was
+		accepted."""
+		fired = []
+		while True:
+			machine, state = stack[-1]
+			row, ordered = machine.row(state)
+			invoke = None
+			if close:
+				transition = row.get(0)
+			elif ordered is None:
+				transition = row.get(self.ids.get((ns, localname)))
+			else:
+				transition = None
+				for label in ordered:
+					keyNs, keyName = self.names[label]
+					if keyName[0] == "/":
+						continue
+					elif keyName[0] == "*":
+						transition = row[label]
+					elif keyName[0] == "!":
+						invoke = self.invoked(ns, localname, (keyNs or "", keyName[1:]))
+						if invoke is not None: transition = row[label]
+					elif (keyNs, keyName) == (ns, localname):
+						transition = row[label]
+					if transition is not None: break
+			if transition is None:
+				# a sub-machine in a final state returns, the event belongs to its caller
+				if machine.isFinal(state) and len(stack) > 1:
+					stack.pop()
+					continue
+				return fired, False
+			target, actions = transition
+			actions = actionTable[actions]
+			if self.counters is not None and not self.count(counters, actions):
+				return fired, False
+			fired.append(actions)
+			stack[-1][1] = target
+			if invoke is None:
+				return fired, True
+			stack.append([invoke, invoke.start])
+
+	def actions(self, path):
+		"""Yields the names of the actions fired while running the document at
+		path.  Once the generator is exhausted valid tells whether the
+		document was accepted."""
+		self.valid = None
+		reader = libxml2.newTextReaderFilename(path)
+		stack = [[self.root, self.root.start]]
+		counters = []
+		accepted = True
+		ret = reader.Read()
+		while ret == 1 and accepted:
+			nodeType = reader.NodeType()
+			if nodeType in (1, 15):
+				ns, localname = reader.NamespaceUri(), reader.LocalName()
+				# empty elements have no separate close event
+				events = [nodeType == 15] + ([True] if nodeType == 1 and reader.IsEmptyElement() else [])
+				for close in events:
+					fired, accepted = self.step(stack, counters, ns, localname, close)
+					for actions in fired:
+						for action in actions:
+							yield self.compiler.actions[action]
+					if not accepted: break
+			if accepted: ret = reader.Read()
+		self.valid = accepted and ret == 0 and stack[-1][0].isFinal(stack[-1][1])
+
+	def validate(self, path):
+		"""Returns whether the document at path is accepted."""
+		for action in self.actions(path): pass
+		return self.valid
+
+# compiler with the schemas loaded, inherited by the forked pool workers,
+# and the state every worker starts from, see workerSnapshot
+workerCompiler = None
+workerState = None
+
+def workerSnapshot(cc):
+	"""Returns a copy of the state compiling a target depends on and changes:
+	the id tables and counts of cc and the action sequences, repeatable
+	actions and copy counts of fsm.  The parent merges the results of the
+	workers into it while workers are still forked from it, so they
+	restore this state instead of inheriting the current one."""
+	return copy.deepcopy((cc.elements, cc.namespaces, cc.actions, cc.contentModelHits, cc.contentModelMisses, cc.stats,
+	                      actionTable.ids, actionTable.sequences, repeatableActions,
+	                      (copyCounter.copies, copyCounter.states, copyCounter.transitions)))
+
+def restoreSnapshot(cc, state):
+	"""Restores the state returned by workerSnapshot."""
+	(cc.elements, cc.namespaces, cc.actions, cc.contentModelHits, cc.contentModelMisses, cc.stats,
+	 actionTable.ids, actionTable.sequences, repeatable, counts) = copy.deepcopy(state)
+	repeatableActions.clear()
+	repeatableActions.update(repeatable)
+	copyCounter.copies, copyCounter.states, copyCounter.transitions = counts
+
+def compileWorker(target):
+	"""Compiles a target in a pool worker, capturing its output.  Returns the
+	content model cache hits and misses of this target alone."""
+	cc = workerCompiler
+	restoreSnapshot(cc, workerState)
+	cc.contentModelHits = cc.contentModelMisses = 0
+	stdout = sys.stdout
+	sys.stdout = StringIO.StringIO()
+	try:
+		dfa = cc.compileTarget(*target)
+		output = sys.stdout.getvalue()
+	finally:
+		sys.stdout = stdout
+	stats = None if cc.stats is None else cc.stats[-1]
+	return output, dfa, cc.elements, cc.namespaces, cc.actions, cc.contentModelHits, cc.contentModelMisses, stats
+
+class CompilationCache(object):
+	"""Content addressed store of compilation results.  The manifest of a
+	configuration lists the schema files it loaded, the entry itself is keyed
+	by the configuration and the hashes of these files.  Configurations
+	include the sources of the compiler, so changing them invalidates the
+	entries.  The least recently used files are evicted once the directory
+	exceeds maxSize bytes."""
+	VERSION = 2
+
+	def __init__(self, directory, maxSize):
+		self.directory = directory
+		self.maxSize = maxSize
+
+	@staticmethod
+	def fileHash(path):
+		with open(path, "rb") as f:
+			return hashlib.sha1(f.read()).hexdigest()
+
+	def path(self, name):
+		return os.path.join(self.directory, name)
+
+	def configHash(self, config):
+		sources = [sys.modules[name].__file__ for name in (CompactFsm.__module__, __name__)]
+		sources = [re.sub(r"\.py[co]$", ".py", path) for path in sources]
+		return hashlib.sha1(repr((self.VERSION, config, map(self.fileHash, sources)))).hexdigest()
+
+	def entryName(self, configHash, files):
+		h = hashlib.sha1(configHash)
+		for path in sorted(files):
+			h.update("\0%s\0%s" % (path, self.fileHash(path)))
+		return h.hexdigest() + ".entry"
+
+	def read(self, name):
+		try:
+			with open(self.path(name), "rb") as f:
+				value = cPickle.load(f)
+			os.utime(self.path(name), None)
+			return value
+		except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+			return None
+
+	def write(self, name, value):
+		try:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+			with os.fdopen(fd, "wb") as f:
+				cPickle.dump(value, f, cPickle.HIGHEST_PROTOCOL)
+			os.rename(tmp, self.path(name))
+		except (IOError, OSError) as e:
+			print "Unable to write cache file '{0}': {1}".format(self.path(name), e)
+
+	def lookup(self, config):
+		configHash = self.configHash(config)
+		files = self.read(configHash + ".manifest")
+		if files is None: return None
+		try:
+			return self.read(self.entryName(configHash, files))
+		except (IOError, OSError):
+			return None
+
+	def store(self, config, files, result):
+		configHash = self.configHash(config)
+		files = sorted(map(os.path.abspath, files))
+		self.write(configHash + ".manifest", files)
+		self.write(self.entryName(configHash, files), result)
+		self.evict()
+
+	def evict(self):
+		entries = []
+		try:
+			names = os.listdir(self.directory)
+		except OSError:
+			return
+		for name in names:
+			try:
+				st = os.stat(self.path(name))
+			except OSError:
+				continue
+			entries.append((st.st_mtime, st.st_size, name))
+		size = sum([e[1] for e in entries])
+		for mtime, fileSize, name in sorted(entries):
+			if size <= self.maxSize: break
+			try:
+				os.unlink(self.path(name))
+			except OSError:
+				pass
+			size -= fileSize
+
+def splitQName(qname):
+	"""Returns the namespace and the local name of "{namespace}localname"."""
+	match = re.match(r"\{(.*)\}(.*)$", qname)
+	return (match.group(1), match.group(2)) if match is not None else ("", qname)
+
+def machineName(qname):
+	"""Returns the name of the files and C symbols of the machine for the
+	element qname."""
+	return re.sub(r"\W", "_", qname.split("}")[-1])
+
+def readProfile(path):
+	"""Reads the hit counts written by fx_profile_dump.  Returns a dict of the
+	root element of every schema to its number of states and transitions and
+	the hits per state and per transition, counts of the same schema are
+	summed up."""
+	profiles = dict()
+	counts = None
+	with open(path) as f:
+		for line in f:
+			fields = line.split()
+			if not fields: continue
+			if fields[0] == "schema":
+				profile = profiles.setdefault(fields[1], (int(fields[3]), int(fields[5]), dict(), dict()))
+			elif fields[0] in ("state", "transition"):
+				counts = profile[2] if fields[0] == "state" else profile[3]
+				counts[int(fields[1])] = counts.get(int(fields[1]), 0) + int(fields[2])
+	return profiles
+
+def formatStats(report, style):
+	"""Returns the statistics collected with --stats as JSON or as a table
+	with one line per target and one for the combined machine."""
+	if style == "json":
+		return json.dumps(report, indent=1, sort_keys=True) + "\n"
+	phases = ("createContentModel", "simplify", "determinize", "minimize", "mkTables")
+	lines = []
+	if "loadSchema" in report["phases"]:
+		phase = report["phases"]["loadSchema"]
+		lines.append("loadSchema: %.3fs, peak %d kB" % (phase["seconds"], phase["peak_kb"]))
+	lines.append("%-40s %s %13s %13s %13s %13s %5s %15s %8s %9s" % ("target", " ".join(["%9s" % phase[:9] for phase in phases]),
+	             "nfa", "simplified", "dfa", "minimal", "min", "copied states", "bytes", "peak kB"))
+	for target in report["targets"]:
+		times = []
+		for phase in phases:
+			times.append("%9s" % ("%.3f" % target["phases"][phase]["seconds"] if phase in target["phases"] else "-"))
+		sizes = []
+		for fsm in ("nfa", "simplified", "dfa", "minimal"):
+			sizes.append("%13s" % ("%d/%d" % (target[fsm]["states"], target[fsm]["transitions"]) if fsm in target else "-"))
+		peak = max([phase["peak_kb"] for phase in target["phases"].values()] or [0])
+		lines.append("%-40s %s %s %5s %15s %8s %9d" % (target["name"], " ".join(times), " ".join(sizes),
+		             target.get("minimizations", "-"), target["copies"]["states"] if "copies" in target else "-",
+		             target["tables"]["bytes"] if "tables" in target else "-", peak))
+	if "combined" in report:
+		combined = report["combined"]
+		lines.append("combined %s: %d roots, %d/%d states/transitions, %d bytes instead of %d, combine %.3fs, mkTables %.3fs" % (
+		             combined["name"], combined["roots"], combined["minimal"]["states"], combined["minimal"]["transitions"], combined["tables"]["bytes"],
+		             sum([target["tables"]["bytes"] for target in report["targets"] if "tables" in target]),
+		             combined["phases"]["combine"]["seconds"], combined["phases"]["mkTables"]["seconds"]))
+	return "\n".join(lines) + "\n"
+
 class myArgumentParser(argparse.ArgumentParser):
 	def __init__(self, **kwargs):
 		super(myArgumentParser, self).__init__(**kwargs)
@@ -407,7 +1517,7 @@ class myArgumentParser(argparse.ArgumentParser):
 
 if __name__ == "__main__":
 	parser = myArgumentParser(description="Turn XML schema objects into finite state machines", fromfile_prefix_chars="@")
-	parser.add_argument("-v", "--verbose", action="count", default="0", dest="verbosity",
+	parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbosity",
 	                    help="increase output verbosity")
 	parser.add_argument("--element", action="append", dest="elements", default=[],
 	                    help="element name to create machine for")
@@ -418,39 +1528,193 @@ if __name__ == "__main__":
 	parser.add_argument("--provide-type", action="append", dest="typesProvided", default=[],
 	                    help="type name that will be provided by other means")
 	parser.add_argument("--preserve-substitution", action="append", dest="preservedSubsts", default=[],
-	                    help="type name that will be provided by other means")
+	                    help="element name whose substitution group members are invoked through their registered machines instead of inlined")
+	parser.add_argument("--counter-threshold", type=int, dest="counterThreshold", default=None,
+	                    help="enforce occurrence bounds above this value with counters instead of unrolling")
+	parser.add_argument("--minimize-threshold", type=int, dest="minimizeThreshold", default=64, metavar="STATES",
+	                    help="reduce a content model to its minimal DFA once it has STATES states more than the largest reduced content model it contains")
+	parser.add_argument("-j", "--jobs", type=int, dest="jobs", default=1,
+	                    help="number of worker processes compiling the requested elements and types")
+	parser.add_argument("--tables-dir", dest="tablesDir", default=None,
+	                    help="directory to write the binary tables <element>.fxt of each element to")
+	parser.add_argument("--source-dir", dest="sourceDir", default=None,
+	                    help="directory to write the C unit <element>.c of each element to")
+	parser.add_argument("--combine", dest="combine", default=None, metavar="NAME",
+	                    help="write the machines of all elements as one, NAME.fxt or NAME.c, with an entry state per element and their common states shared")
+	parser.add_argument("--source-style", dest="sourceStyle", choices=("table", "goto"), default="table",
+	                    help="generate table driven machines for fx_parse_xml or direct-coded ones")
+	parser.add_argument("--dense", action="store_true", dest="dense", default=False,
+	                    help="emit dense tables over element classes, packed into a comb vector")
+	parser.add_argument("--construction", dest="construction", choices=("thompson", "glushkov"), default="thompson",
+	                    help="build epsilon NFAs and determinize them or position automata, which are deterministic for schemas obeying Unique Particle Attribution")
+	parser.add_argument("--lazy", type=int, nargs="?", const=1024, dest="lazy", default=None, metavar="STATES",
+	                    help="emit NFAs that the runtime determinizes on demand, caching up to STATES DFA states (default 1024)")
+	parser.add_argument("--profile", dest="profile", default=None,
+	                    help="annotate the tables with the hit counts written by fx_profile_dump")
+	parser.add_argument("--stats", dest="stats", choices=("table", "json"), default=None,
+	                    help="report phase times, peak memory, state counts and table sizes of every target")
+	parser.add_argument("--stats-file", dest="statsFile", default=None,
+	                    help="file to write the statistics to instead of stderr")
+	parser.add_argument("--no-cache", action="store_true", dest="noCache", default=False,
+	                    help="do not use the compilation cache")
+	parser.add_argument("--cache-dir", dest="cacheDir",
+	                    default=os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "xsdcc"),
+	                    help="directory of the compilation cache")
+	parser.add_argument("--cache-size", type=int, dest="cacheSize", default=64,
+	                    help="maximum size of the compilation cache in MB")
+	parser.add_argument("--index-schemas", action="store_true", dest="indexSchemas", default=False,
+	                    help="index the schema files in parallel and only parse those declaring the names in use")
 	parser.add_argument("--schema", action="append", dest="schemaFiles", default=[],
                         help="XML schema file to import definitions from")
 	arguments = parser.parse_args()
 	#print arguments
+	if arguments.lazy is not None and (arguments.lazy < 1 or arguments.dense or arguments.sourceStyle != "table"):
+		parser.error("--lazy needs a positive number of states and excludes --dense and --source-style goto")
+	if arguments.combine is not None and (arguments.lazy is not None or arguments.sourceStyle != "table" or not arguments.elements):
+		parser.error("--combine needs elements and excludes --lazy and --source-style goto")
+
+	def emit(kind, obj, dfa, group, stats=None):
+		cc.dump(dfa)
+		if kind != "element": return
+		cc.timed(stats, "mkTables", cc.mkTables, dfa, arguments.dense)
+		if stats is not None:
+			stats["tables"] = dict(bytes=len(cc.packTables(dfa, arguments.dense, obj, group)))
+		if arguments.combine is not None: return
+		if profile is not None and obj in profile:
+			print cc.profileReport(dfa, profile[obj])
+		name = machineName(obj)
+		if arguments.tablesDir is not None:
+			cc.writeTables(dfa, os.path.join(arguments.tablesDir, name + ".fxt"), arguments.dense, obj, group)
+		if arguments.sourceDir is not None:
+			with open(os.path.join(arguments.sourceDir, name + ".c"), "w") as f:
+				f.write(cc.mkSource(dfa, name, arguments.sourceStyle, arguments.dense, obj, group))
+
+	def emitCombined(targets):
+		targets = [(obj, dfa, group) for kind, obj, dfa, group in targets if kind == "element"]
+		stats = None
+		if cc.stats is not None:
+			stats = report["combined"] = dict(name=arguments.combine, roots=len(targets), phases=dict())
+		combined, entries = cc.timed(stats, "combine", CompactFsm.combine, [dfa for obj, dfa, group in targets], cc.verbosity > 0)
+		roots = [(entry, obj, group) for entry, (obj, dfa, group) in zip(entries, targets)]
+		cc.timed(stats, "mkTables", cc.mkTables, combined, arguments.dense, entries)
+		if stats is not None:
+			states = combined.reachables(entries)
+			stats["minimal"] = dict(states=len(states), transitions=sum([combined.offsets[s + 1] - combined.offsets[s] for s in states]))
+			stats["tables"] = dict(bytes=len(cc.packTables(combined, arguments.dense, roots=roots)))
+		for obj, dfa, group in targets:
+			if profile is not None and obj in profile:
+				print cc.profileReport(combined, profile[obj], entries)
+		if arguments.tablesDir is not None:
+			cc.writeTables(combined, os.path.join(arguments.tablesDir, arguments.combine + ".fxt"), arguments.dense, roots=roots)
+		if arguments.sourceDir is not None:
+			with open(os.path.join(arguments.sourceDir, arguments.combine + ".c"), "w") as f:
+				f.write(cc.mkSource(combined, arguments.combine, arguments.sourceStyle, arguments.dense, roots=roots))
 
+	def writeStats(report):
+		if arguments.stats is None: return
+		if arguments.statsFile is None:
+			sys.stderr.write(formatStats(report, arguments.stats))
+		else:
+			with open(arguments.statsFile, "w") as f:
+				f.write(formatStats(report, arguments.stats))
+
+	profile = None
+	if arguments.profile is not None:
+		profile = readProfile(arguments.profile)
+
+	cache = None
+	if not arguments.noCache:
+		cache = CompilationCache(arguments.cacheDir, arguments.cacheSize * 1024 * 1024)
 	cc = XSCompiler()
+	cc.verbosity = arguments.verbosity
+	cc.lazy = arguments.lazy or 0
+	cc.construction = arguments.construction
+	report = dict(phases=dict(), targets=[])
+	if arguments.stats is not None:
+		cc.stats = report["targets"]
+	config = (os.getcwd(), sorted([(k, v) for k, v in vars(arguments).items() if k not in ("verbosity", "noCache", "cacheDir", "cacheSize", "tablesDir", "sourceDir", "sourceStyle", "combine", "dense", "profile", "stats", "statsFile", "indexSchemas", "jobs")]),
+	          [macro[:2] for macro in cc.macros])
+	result = None if cache is None else cache.lookup(config)
+	if result is not None:
+		if arguments.verbosity > 0: print "Compilation cache hit"
+		elements, namespaces, actions, targets = result
+		cc.namespaces = namespaces
+		for kind, obj, dfa, group, nElements, nActions in targets:
+			cc.elements = elements[:nElements]
+			cc.actions = actions[:nActions]
+			stats = None
+			if cc.stats is not None:
+				stats = dict(kind=kind, name=obj, phases=dict(), cached=True, minimal=cc.fsmSize(dfa))
+				cc.stats.append(stats)
+			emit(kind, obj, dfa, group, stats)
+		if arguments.combine is not None:
+			cc.elements, cc.actions = elements, actions
+			emitCombined([target[:4] for target in targets])
+		writeStats(report)
+		sys.exit(0)
+
 	cc.preservedSubsts = arguments.preservedSubsts
+	cc.counterThreshold = arguments.counterThreshold
+	cc.minimizeThreshold = arguments.minimizeThreshold
 
-	for file in arguments.schemaFiles:
+	if arguments.indexSchemas:
 		try:
-			cc.loadSchema(os.path.normpath(file))
+			cc.timed(report if cc.stats is not None else None, "loadSchema", cc.indexSchemas,
+			         [os.path.normpath(file) for file in arguments.schemaFiles], arguments.jobs)
 		except libxml2.treeError as e:
-			print "Unable to load schema file '{0}': {1}".format(file, e)
+			print "Unable to index schema files: {0}".format(e)
 			sys.exit(1)
+	else:
+		for file in arguments.schemaFiles:
+			try:
+				cc.timed(report if cc.stats is not None else None, "loadSchema", cc.loadSchema, os.path.normpath(file))
+			except libxml2.treeError as e:
+				print "Unable to load schema file '{0}': {1}".format(file, e)
+				sys.exit(1)
 
-	cc.genTypes = set(arguments.types)
-	cc.providedTypes = set(arguments.typesProvided).union(arguments.types)
+	jobs = []
 	for obj in arguments.elements:
-		cc.genElements = set([obj])
-		cc.providedElements = set(arguments.elementsProvided).union(arguments.elements) - set([obj])
-		nfa = cc.createContentModel(cc.Decls[1][obj])
-		dfa = nfa.determinize().minimize()
-		cc.dump(dfa)
-		cc.mkTables(dfa)
-#		dfa = nfa.determinize().hopcroft()
-#		cc.dump(dfa)
-
-	cc.genElements = set(arguments.elements)
-	cc.providedElements = set(arguments.elementsProvided).union(arguments.elements)
+		jobs.append(("element", obj, set([obj]), set(arguments.elementsProvided).union(arguments.elements) - set([obj]),
+		             set(arguments.types), set(arguments.typesProvided).union(arguments.types)))
 	for obj in arguments.types:
-		cc.genTypes = set([obj])
-		cc.providedTypes = set(arguments.typesProvided).union(arguments.types) - set([obj])
-		nfa = cc.createContentModel(cc.Decls[2][obj])
-		dfa = nfa.determinize().minimize()
-		cc.dump(dfa)
+		jobs.append(("type", obj, set(arguments.elements), set(arguments.elementsProvided).union(arguments.elements),
+		             set([obj]), set(arguments.typesProvided).union(arguments.types) - set([obj])))
+
+	if arguments.jobs > 1:
+		# every target is compiled by a fresh fork of this process, the tables
+		# are merged in target order so that the ids are independent of the
+		# scheduling
+		workerCompiler = cc
+		workerState = workerSnapshot(cc)
+		pool = multiprocessing.Pool(arguments.jobs, maxtasksperchild=1)
+		results = pool.imap(compileWorker, jobs)
+	else:
+		results = ((None, cc.compileTarget(*job)) for job in jobs)
+
+	targets = []
+	for job, result in izip(jobs, results):
+		if arguments.jobs > 1:
+			output, dfa, elements, namespaces, actions, hits, misses, stats = result
+			sys.stdout.write(output)
+			if stats is not None: cc.stats.append(stats)
+			dfa = dfa.relabel(*cc.mergeTables(elements, namespaces, actions))
+			cc.contentModelHits += hits
+			cc.contentModelMisses += misses
+		else:
+			dfa = result[1]
+		group = cc.substitutionGroup(job[1]) if job[0] == "element" else None
+		emit(job[0], job[1], dfa, group, None if cc.stats is None else cc.stats[-1])
+		targets.append((job[0], job[1], dfa, group, len(cc.elements), len(cc.actions)))
+	if arguments.jobs > 1:
+		pool.close()
+		pool.join()
+
+	if arguments.combine is not None:
+		emitCombined([target[:4] for target in targets])
+
+	if cache is not None:
+		cache.store(config, cc.loadedSchemas, (cc.elements, cc.namespaces, cc.actions, targets))
+
+	if arguments.verbosity > 0:
+		print "Content model cache: %d hits, %d misses" % (cc.contentModelHits, cc.contentModelMisses)
+	writeStats(report)